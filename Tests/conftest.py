@@ -0,0 +1,141 @@
+# conftest.py
+
+"""
+Shared database fixtures.
+
+The schema and seed data are built once per session into a template database.
+Every test then gets a fresh copy with CREATE DATABASE ... TEMPLATE, which is a
+file copy instead of six CREATE TABLEs, the indexes and the seed inserts.
+
+The sharded fixture splits the template into two department shards.
+
+Under pytest-xdist (pytest -n auto --dist loadgroup) every worker gets its own
+template and test database, e.g. university_db_gw0.
+"""
+
+import json
+import os
+
+import pytest
+from dotenv import load_dotenv
+from fastapi.testclient import TestClient
+from psycopg2 import sql
+
+import audit
+import partitions
+from main import app
+from setup import create_tables, get_connection, load_config, seed_data
+from sharding import shard_map
+
+load_dotenv(override=True)
+
+DATABASE = os.getenv("DATABASE")
+
+
+def recreate_database(database_name, template=None):
+    """Drops (disconnecting any sessions) and creates a database, optionally from a template."""
+    con = get_connection("postgres")
+    con.autocommit = True
+    try:
+        with con.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE);").format(
+                sql.Identifier(database_name)))
+            if template is None:
+                cursor.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(database_name)))
+            else:
+                cursor.execute(sql.SQL("CREATE DATABASE {} TEMPLATE {} STRATEGY FILE_COPY;").format(
+                    sql.Identifier(database_name), sql.Identifier(template)))
+    finally:
+        con.close()
+
+
+def drop_database(database_name):
+    con = get_connection("postgres")
+    con.autocommit = True
+    try:
+        with con.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE);").format(
+                sql.Identifier(database_name)))
+    finally:
+        con.close()
+
+
+@pytest.fixture(scope="session")
+def test_database():
+    """Name of this worker's test database; the API under TestClient connects to it."""
+    worker = os.getenv("PYTEST_XDIST_WORKER")
+    database_name = f"{DATABASE}_{worker}" if worker else DATABASE
+    os.environ["APP_DATABASE"] = database_name
+    return database_name
+
+
+@pytest.fixture(scope="session")
+def template_database(test_database):
+    """Seeded template database, built once per session (and worker)."""
+    template = f"{test_database}_template"
+    recreate_database(template)
+    create_tables(template)
+    seed_data(template)
+
+    yield template
+
+    drop_database(template)
+
+
+@pytest.fixture
+def setup_db(test_database, template_database):
+    """Fresh copy of the seeded template for every test."""
+    recreate_database(test_database, template=template_database)
+    # The copy only has the template's enrollments partitions
+    partitions.forget()
+    yield test_database
+
+
+@pytest.fixture
+def empty_db(test_database):
+    """An empty database next to the test database, for schema tests."""
+    database_name = f"{test_database}_empty"
+    recreate_database(database_name)
+    yield database_name
+    drop_database(database_name)
+
+
+@pytest.fixture(autouse=True)
+def empty_audit_buffer():
+    """Audit events are queued per process; events of one test must not be written into the next one's database."""
+    audit.discard()
+    yield
+    audit.discard()
+
+
+@pytest.fixture
+def client():
+    return TestClient(app)
+
+
+@pytest.fixture
+def sharded(setup_db, template_database, monkeypatch):
+    """Two department shards cloned from the template: department 1 and department 2."""
+    shards = {}
+    for suffix, department_id in (("a", 1), ("b", 2)):
+        database_name = f"{setup_db}_shard_{suffix}"
+        recreate_database(database_name, template=template_database)
+        con = get_connection(database_name)
+        with con:
+            with con.cursor() as cursor:
+                for table in ("courses", "instructors", "departments"):
+                    cursor.execute(sql.SQL("DELETE FROM {} WHERE department_id <> %s;").format(
+                        sql.Identifier(table)), (department_id,))
+        con.close()
+        shards[database_name] = [department_id]
+
+    monkeypatch.setenv("SHARDS", json.dumps(shards))
+    load_config.cache_clear()
+    shard_map.cache_clear()
+    yield shards
+
+    monkeypatch.delenv("SHARDS")
+    load_config.cache_clear()
+    shard_map.cache_clear()
+    for database_name in shards:
+        drop_database(database_name)
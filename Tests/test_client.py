@@ -1,57 +1,11 @@
 # test_client.py
 
-import pytest
-from fastapi.testclient import TestClient
-from main import app
-from setup import create_tables, get_connection, seed_data
-import os
-from dotenv import load_dotenv
-
-# client-fixturen
-@pytest.fixture
-def client():
-    return TestClient(app)
-
-
-load_dotenv(override=True)
-
-DATABASE = os.getenv("DATABASE")
-BASE_URL = os.getenv("BASE_URL")
-
-
-def drop_all_tables(database_name):
-    """Drop all tables in the test database."""
-    print(f"⚠️ Rensar databasen: {database_name}")
-    with get_connection(database_name) as conn:
-        with conn.cursor() as cursor:
-            cursor.execute("SET session_replication_role = 'replica';")
-            cursor.execute("""
-                DO $$ 
-                DECLARE 
-                    r RECORD;
-                BEGIN
-                    FOR r IN (SELECT tablename FROM pg_tables WHERE schemaname = 'public') LOOP
-                        EXECUTE 'DROP TABLE IF EXISTS ' || quote_ident(r.tablename) || ' CASCADE';
-                    END LOOP;
-                END $$;
-            """)
-            cursor.execute("SET session_replication_role = 'origin';")
-            conn.commit()
-
+import time
 
-@pytest.fixture(scope="function")
-def setup_db():
-    """
-    Setup och teardown för testdatabasen.
-    Drops all tables, recreates them, and seeds test data.
-    """
-    drop_all_tables(DATABASE)
-    create_tables(DATABASE)
-    seed_data(DATABASE)
+import pytest
 
-    yield  
+# client- och setup_db-fixturerna finns i conftest.py
 
-    drop_all_tables(DATABASE)
 
 #------------- Test for courses ---------------------
 
@@ -101,6 +55,87 @@ def test_update_course(client, setup_db):
     assert course["department_id"] == updated_course["department_id"], "Department ID was not updated correctly"
 
 
+@pytest.mark.course
+def test_bulk_delete_courses(client, setup_db):
+    """Test dry run and chunked bulk deletion of a department's courses."""
+    request = {"department_id": 1, "dry_run": True}
+    response = client.post("/courses/bulk-delete", json=request)
+    assert response.status_code == 200
+    report = response.json()
+    assert report["matched"] == 2, "Department 1 has Python and Data Science"
+    assert report["deleted"] == 0
+    assert report["cascaded"] == {"student_courses": 7, "course_prerequisites": 2, "enrollments": 2}
+    assert len(client.get("/departments/1/courses").json()) == 2, "Dry run must not delete"
+
+    response = client.post("/courses/bulk-delete", json={"department_id": 1, "chunk_size": 1})
+    report = response.json()
+    assert report["deleted"] == 2
+    assert report["cascaded"] == {"student_courses": 7, "course_prerequisites": 2, "enrollments": 2}
+    assert client.get("/departments/1/courses").json() == []
+    assert {e["course_name"] for e in client.get("/enrollments").json()} == {"Geometry", "Linear Algebra", "Calculus"}
+
+    response = client.post("/courses/bulk-delete", json={})
+    assert response.status_code == 400
+
+
+def test_bulk_delete_students_frees_seats(client, setup_db):
+    """Test that bulk deleting students removes their enrollments and frees the seats."""
+    before = {c["course_id"]: c["enrolled_count"] for c in client.get("/catalogue").json()[0]["courses"]}
+    response = client.post("/students/bulk-delete", json={"student_ids": [1, 2]})
+    report = response.json()
+    assert report["deleted"] == 2
+    assert report["cascaded"]["enrollments"] == 2
+    assert client.get("/enrollments", params={"course_id": 1}).json() == []
+    after = {c["course_id"]: c["enrolled_count"] for c in client.get("/catalogue").json()[0]["courses"]}
+    assert after[1] == before[1] - 2
+
+def test_filter_and_sort_courses(client, setup_db):
+    courses = client.get("/courses").json()
+    department_id = courses[0]["department_id"]
+
+    response = client.get("/courses", params={"department_id": department_id, "sort": "-credits", "limit": 50})
+    assert response.status_code == 200
+    assert response.json() == sorted(
+        [c for c in courses if c["department_id"] == department_id],
+        key=lambda c: (-c["credits"], c["course_id"]))
+
+    credits = client.get("/courses", params={"credits_min": 5, "credits_max": 5}).json()
+    assert all(c["credits"] == 5 for c in credits)
+
+    assert client.get("/courses", params={"sort": "capacity; DROP TABLE courses"}).status_code == 400
+    assert client.get("/courses", params={"limit": 100_000}).status_code == 422
+
+
+def test_unfiltered_list_is_paged(client, setup_db, monkeypatch):
+    """Test that a list request without filters or limit returns DEFAULT_LIMIT rows and links on."""
+    import filters
+
+    monkeypatch.setattr(filters, "DEFAULT_LIMIT", 2)
+    for path in ("/students", "/courses", "/instructors", "/enrollments"):
+        response = client.get(path)
+        assert len(response.json()) == 2, path
+        assert response.headers["Link"] == f'<{path}?offset=2>; rel="next"'
+
+
+def test_filtered_list_next_page_link(client, setup_db):
+    """Test that a full page links to the next one and the last page does not."""
+    courses = client.get("/courses").json()
+    params = {"sort": "-credits", "limit": 2}
+    pages = []
+    url = "/courses"
+    while url:
+        response = client.get(url, params=params)
+        assert response.status_code == 200
+        pages.append(response.json())
+        link = response.headers.get("Link")
+        url, params = (link[1:link.index(">")], None) if link else (None, None)
+        assert link is None or link.endswith('; rel="next"')
+
+    assert [len(page) for page in pages] == [2, 2, len(courses) - 4]
+    assert [c["course_id"] for page in pages for c in page] == [
+        c["course_id"] for c in sorted(courses, key=lambda c: (-c["credits"], c["course_id"]))]
+
+
 # ------------------ Test for instructors ---------------------------
 
 # def test_get_instructors(setup_db):
@@ -178,6 +213,20 @@ def test_patch_instructor(client,setup_db):
     assert upd_inst["email"] == "patched@email.com", "Email wasn't uppdated"
 
 
+@pytest.mark.instructorpatch
+def test_patch_instructor_by_path(client, setup_db):
+    """Test that PATCH only writes the supplied fields and bumps the version."""
+    before = client.get("/instructors/1").json()
+
+    response = client.patch("/instructors/1", json={"department_id": 1})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    instructor = response.json()
+    assert instructor["department_id"] == 1
+    assert instructor["email"] == before["email"], "Email should be untouched"
+    assert instructor["version"] == before["version"] + 1
+    assert response.headers["ETag"] == f'"{instructor["version"]}"'
+
+
 # ------------------ Test for students ------------------------
 
 @pytest.mark.student
@@ -228,6 +277,32 @@ def test_update_student(client, setup_db):
     assert student["email"] == updated_student["email"]
     assert student["enrollment_date"] == updated_student["enrollment_date"]
 
+@pytest.mark.student
+def test_patch_student(client, setup_db):
+    """Test partially updating a student."""
+    response = client.patch("/students/1", json={"email": "patched_student@yh.se"})
+    assert response.status_code == 200, f"Expected status code 200, got {response.status_code}"
+    student = response.json()
+    assert student["email"] == "patched_student@yh.se"
+    assert student["first_name"] == "Jesper", "First name should be untouched"
+
+    response = client.patch("/students/999", json={"email": "nobody@yh.se"})
+    assert response.status_code == 404
+
+
+@pytest.mark.student
+def test_patch_student_if_match(client, setup_db):
+    """Test that a stale If-Match version is rejected."""
+    etag = client.patch("/students/2", json={"last_name": "First"}).headers["ETag"]
+
+    response = client.patch("/students/2", json={"last_name": "Second"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+
+    response = client.patch("/students/2", json={"last_name": "Third"}, headers={"If-Match": etag})
+    assert response.status_code == 412, "Stale version should be rejected"
+    assert client.get("/students/2").json()["last_name"] == "Second"
+
+
 @pytest.mark.student
 def test_delete_student_by_id(client, setup_db):
     """Test deleting student by id"""
@@ -279,3 +354,913 @@ def test_delete_student_by_name(client, setup_db):
     message = delete_temp.json()
     assert "deleted successfully" in message.get("message", "")
 
+
+@pytest.mark.student
+def test_delete_students_with_same_name(client, setup_db):
+    """Test that deleting by name removes every match and publishes each deletion."""
+    ids = [client.post("/students", json={"first_name": "Twin", "last_name": "Namesake",
+                                          "email": f"twin{i}@yh.se", "enrollment_date": "2024-09-13"}).json()["id"]
+           for i in range(2)]
+    cursor = client.get("/changes").json()["cursor"]
+
+    response = client.delete("/students/?first_name=Twin&last_name=Namesake")
+    assert response.status_code == 200
+    assert sorted(s["student_id"] for s in response.json()["deleted_students"]) == sorted(ids)
+
+    events = client.get(f"/changes?since={cursor}").json()["events"]
+    assert sorted(e["entity_id"] for e in events if e["operation"] == "delete") == sorted(ids)
+
+
+@pytest.mark.student
+def test_list_students_modified_since(client, setup_db):
+    """Test incremental sync with updated_at watermarks and tombstones."""
+    first = client.get("/students", params={"modified_since": "2000-01-01T00:00:00"}).json()
+    assert len(first["changed"]) == 6, "Every seeded student is new"
+    watermark = first["watermark"]
+
+    client.patch("/students/3", json={"last_name": "Synced"})
+    client.delete("/students/4")
+
+    delta = client.get("/students", params={"modified_since": watermark}).json()
+    assert [s["student_id"] for s in delta["changed"]] == [3]
+    assert delta["deleted"][0]["row_key"] == {"student_id": 4}
+
+
+def test_list_students_modified_since_open_transaction(client, setup_db):
+    """Test that a row committed by a transaction open during a sync comes with the next sync."""
+    from setup import get_connection
+
+    writer = get_connection(setup_db)
+    try:
+        with writer.cursor() as cursor:
+            cursor.execute("UPDATE students SET last_name = 'Late' WHERE student_id = 5;")
+
+        first = client.get("/students", params={"modified_since": "2000-01-01T00:00:00"}).json()
+        assert "Late" not in [s["last_name"] for s in first["changed"]]
+        writer.commit()
+    finally:
+        writer.close()
+
+    delta = client.get("/students", params={"modified_since": first["watermark"]}).json()
+    assert [s["last_name"] for s in delta["changed"] if s["student_id"] == 5] == ["Late"]
+
+
+# ------------------ Test for catalogue ------------------------
+
+def test_catalogue(client, setup_db):
+    response = client.get("/catalogue")
+    assert response.status_code == 200
+    departments = response.json()
+    assert departments
+    course = next(c for d in departments for c in d["courses"])
+    assert {"course_id", "name", "credits"} <= course.keys()
+
+    etag = response.headers["ETag"]
+    cached = client.get("/catalogue", headers={"If-None-Match": etag})
+    assert cached.status_code == 304
+
+    client.patch(f"/courses/{course['course_id']}", json={"credits": 7})
+    changed = client.get("/catalogue", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    assert changed.headers["ETag"] != etag
+
+
+
+def test_catalogue_etag_late_commit(client, setup_db):
+    """Test that a change committed after a later one still changes the ETag."""
+    from setup import get_connection
+
+    writer = get_connection(setup_db)
+    try:
+        with writer.cursor() as cursor:
+            cursor.execute("UPDATE courses SET credits = 9 WHERE course_id = 1;")
+        # Committed after the writer started, so it has the newest updated_at
+        client.patch("/courses/2", json={"credits": 8})
+        etag = client.get("/catalogue").headers["ETag"]
+        writer.commit()
+    finally:
+        writer.close()
+
+    changed = client.get("/catalogue", headers={"If-None-Match": etag})
+    assert changed.status_code == 200
+    course = next(c for d in changed.json() for c in d["courses"] if c["course_id"] == 1)
+    assert course["credits"] == 9
+
+# ------------------ Test for enrollments ------------------------
+
+@pytest.mark.enrollment
+def test_enroll_student_capacity(client, setup_db):
+    """Test registration against a course with one free seat."""
+    client.patch("/courses/5", json={"capacity": 1})
+
+    response = client.post("/courses/5/enrollments", json={"student_id": 1})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    assert response.json()["student_id"] == 1
+
+    response = client.post("/courses/5/enrollments", json={"student_id": 2})
+    assert response.status_code == 409, "Course should be full"
+    course = next(c for c in client.get("/courses").json() if c["course_id"] == 5)
+    assert course["enrolled_count"] == 1
+
+
+@pytest.mark.enrollment
+def test_enroll_student_twice(client, setup_db):
+    """Test that double enrollment is rejected and idempotent retries are not."""
+    headers = {"Idempotency-Key": "enroll-1-in-3"}
+    first = client.post("/courses/3/enrollments", json={"student_id": 1}, headers=headers)
+    retry = client.post("/courses/3/enrollments", json={"student_id": 1}, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert first.json() == retry.json(), "Retry should return the stored response"
+
+    response = client.post("/courses/3/enrollments", json={"student_id": 1})
+    assert response.status_code == 409
+
+    response = client.post("/courses/3/enrollments", json={"student_id": 999})
+    assert response.status_code == 404
+
+
+@pytest.mark.enrollment
+def test_enroll_cohort(client, setup_db):
+    """Test enrolling a cohort in one transaction."""
+    client.patch("/courses/5", json={"capacity": 3})
+
+    response = client.post("/courses/5/enrollments/batch", json={"student_ids": [1, 2, 3, 999]})
+    assert response.status_code == 200
+    result = response.json()
+    assert result["enrolled"] == [1, 2, 3]
+    assert result["unknown_students"] == [999]
+
+    response = client.post("/courses/5/enrollments/batch", json={"student_ids": [1, 4]})
+    assert response.status_code == 409, "Student 4 does not fit"
+
+
+@pytest.mark.enrollment
+def test_enrollment_partitions(client, setup_db):
+    """Test that enrolling in a year without a partition creates it, and date filters prune."""
+    import partitions
+    from setup import get_connection
+
+    partitions.forget()
+    response = client.post("/courses/3/enrollments", json={"student_id": 1, "enrollment_date": "2019-08-20"})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+
+    con = get_connection(setup_db)
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT relkind FROM pg_class WHERE relname = ANY(%s) ORDER BY relname;",
+                           (["enrollments", "enrollments_2019", "student_courses"],))
+            assert [row[0] for row in cursor.fetchall()] == ["p", "r", "p"]
+            cursor.execute("""
+                EXPLAIN (FORMAT JSON) SELECT * FROM enrollments
+                WHERE enrollment_date >= '2019-01-01' AND enrollment_date <= '2019-12-31';
+            """)
+            plan = str(cursor.fetchone()[0])
+            assert "enrollments_2019" in plan and "enrollments_2024" not in plan
+    con.close()
+
+    response = client.get("/enrollments", params={"enrollment_date_from": "2019-01-01",
+                                                  "enrollment_date_to": "2019-12-31"})
+    assert [e["enrollment_date"] for e in response.json()] == ["2019-08-20"]
+
+
+@pytest.mark.enrollment
+def test_enrollment_date_defaults_to_partition_date(client, setup_db, monkeypatch):
+    """Test that an enrollment without a date gets the date its partition was created for."""
+    from datetime import date
+    import partitions
+
+    class FutureDate(date):
+        @classmethod
+        def today(cls):
+            return cls(2031, 6, 1)
+
+    monkeypatch.setattr(partitions, "date", FutureDate)
+    partitions.forget()
+    response = client.post("/courses/3/enrollments", json={"student_id": 1})
+    assert response.status_code == 200, response.text
+    assert response.json()["enrollment_date"] == "2031-06-01"
+
+    response = client.post("/courses/4/enrollments/batch", json={"student_ids": [1, 2]})
+    assert response.status_code == 200, response.text
+    dates = client.get("/enrollments", params={"enrollment_date_from": "2031-01-01"}).json()
+    assert [e["enrollment_date"] for e in dates] == ["2031-06-01"] * 3
+
+def test_unpartitioned_enrollments_stay_unique(empty_db):
+    """Test that a database created before partitioning keeps its unique index until migrated."""
+    import partitions
+    import psycopg2
+    from setup import create_tables, get_connection
+
+    con = get_connection(empty_db)
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("""
+                CREATE TABLE enrollments (enrollment_id SERIAL PRIMARY KEY, student_id INT, course_id INT,
+                                          enrollment_date DATE, grade CHAR(1));
+            """)
+    create_tables(empty_db)
+
+    def student_course_indexes():
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute("""
+                    SELECT indexname FROM pg_indexes
+                    WHERE tablename = 'enrollments' AND indexdef LIKE '%(student_id, course_id)'
+                """)
+                return [row[0] for row in cursor.fetchall()]
+
+    try:
+        assert student_course_indexes() == ["uq_enrollments_student_course"]
+        with pytest.raises(psycopg2.errors.UniqueViolation):
+            with con:
+                with con.cursor() as cursor:
+                    cursor.execute("INSERT INTO enrollments (student_id, course_id, enrollment_date) "
+                                   "VALUES (1, 1, '2025-01-01'), (1, 1, '2025-02-01');")
+
+        partitions.migrate(empty_db)
+        assert student_course_indexes() == ["idx_enrollments_student_course"]
+    finally:
+        con.close()
+
+
+# ------------------ Test for grades ------------------------
+
+@pytest.mark.grades
+def test_submit_grades(client, setup_db):
+    """Test bulk grade posting with per-row outcomes and updated averages."""
+    grades = [
+        {"student_id": 1, "grade": 5},      # new
+        {"student_id": 2, "grade": 2},      # was 4
+        {"student_id": 3, "grade": 3},      # unchanged
+        {"student_id": 4, "grade": 3.5},    # not allowed
+        {"student_id": 999, "grade": 4},    # unknown student
+        {"student_id": 1, "grade": 4},      # second row for student 1
+    ]
+    response = client.post("/courses/5/grades", json={"grades": grades})
+    assert response.status_code == 200, f"Expected 200, got {response.status_code}"
+    outcomes = [r["outcome"] for r in response.json()["results"]]
+    assert outcomes == ["created", "updated", "unchanged", "invalid_grade",
+                        "student_not_found", "duplicate"]
+
+    # Student 2 had 4, 4, 5, 3 and now 2 instead of 4 in course 5
+    average = client.get("/students/2/average-grade").json()["average_grade"]
+    assert average == 3.5
+    assert client.get("/students/1/average-grade").json()["average_grade"] == 5.0
+
+    assert client.post("/courses/999/grades", json={"grades": grades}).status_code == 404
+
+
+# ------------------ Test for change feed ------------------------
+
+def test_changes_since_cursor(client, setup_db):
+    """Test that writes show up in the change feed exactly once."""
+    response = client.get("/changes")
+    assert response.status_code == 200
+    cursor = response.json()["cursor"]
+
+    created = client.post("/students", json={
+        "first_name": "Feed", "last_name": "Student",
+        "email": "feed@yh.se", "enrollment_date": "2024-09-01",
+    }).json()
+    client.patch(f"/students/{created['id']}", json={"last_name": "Patched"})
+    client.delete(f"/students/{created['id']}")
+
+    # Events are held back while older transactions (e.g. in other test workers) are open
+    events = []
+    for _ in range(50):
+        changes = client.get(f"/changes?since={cursor}").json()
+        events += changes["events"]
+        cursor = changes["cursor"]
+        if len(events) >= 3:
+            break
+        time.sleep(0.1)
+
+    assert [e["operation"] for e in events] == ["create", "update", "delete"]
+    assert all(e["entity"] == "students" and e["entity_id"] == created["id"] for e in events)
+    assert events[1]["payload"]["last_name"] == "Patched"
+
+    assert client.get(f"/changes?since={cursor}").json()["events"] == []
+    assert client.get("/changes?since=abc").status_code == 400
+
+
+def test_changes_held_back_only_by_this_database(client, setup_db):
+    """Test that open transactions elsewhere on the server do not hold back the feed, ours do."""
+    from setup import get_connection
+
+    cursor = client.get("/changes").json()["cursor"]
+    elsewhere = get_connection("postgres")
+    here = get_connection(setup_db)
+    try:
+        with elsewhere.cursor() as other:
+            other.execute("SELECT txid_current();")
+        client.patch("/students/1", json={"last_name": "Feed"})
+        events = client.get(f"/changes?since={cursor}").json()["events"]
+        assert [e["entity_id"] for e in events] == [1]
+        cursor = events[-1]["cursor"]
+
+        with here.cursor() as open_write:
+            open_write.execute("SELECT txid_current();")
+        client.patch("/students/2", json={"last_name": "Feed"})
+        assert client.get(f"/changes?since={cursor}").json()["events"] == []
+        here.rollback()
+        assert [e["entity_id"] for e in client.get(f"/changes?since={cursor}").json()["events"]] == [2]
+    finally:
+        elsewhere.close()
+        here.close()
+
+
+def test_history_retention(client, setup_db):
+    """Test that pruned change events and tombstones turn old cursors and watermarks away with 410."""
+    from datetime import datetime, timedelta, timezone
+    import retention
+    from setup import get_connection
+
+    created = client.post("/students", json={
+        "first_name": "Old", "last_name": "History",
+        "email": "old.history@yh.se", "enrollment_date": "2024-09-01",
+    }).json()
+    cursor = client.get("/changes").json()["cursor"]
+    client.delete(f"/students/{created['id']}")
+
+    con = get_connection(setup_db)
+    with con:
+        with con.cursor() as backdate:
+            backdate.execute("UPDATE change_events SET created_at = created_at - interval '40 days';")
+            backdate.execute("UPDATE tombstones SET deleted_at = deleted_at - interval '40 days';")
+    con.close()
+    client.patch("/students/1", json={"last_name": "Recent"})
+
+    assert retention.prune(days=30) == {"change_events": 2, "tombstones": 1}
+    assert retention.prune(days=30) == {"change_events": 0, "tombstones": 0}
+
+    assert client.get("/changes", params={"since": cursor}).status_code == 410
+    assert client.get("/changes/stream", params={"since": cursor}).status_code == 410
+    fresh = client.get("/changes")
+    assert fresh.status_code == 200
+    assert [e["entity_id"] for e in fresh.json()["events"]] == [1], "0-0 starts at the oldest retained event"
+    assert client.get("/changes", params={"since": fresh.json()["cursor"]}).status_code == 200
+
+    now = datetime.now(timezone.utc)
+    assert client.get("/students", params={"modified_since": (now - timedelta(days=45)).isoformat()}).status_code == 410
+    assert client.get("/students", params={"modified_since": (now - timedelta(days=35)).isoformat()}).status_code == 200
+
+def test_change_stream_limit(client, setup_db, monkeypatch):
+    """Test that streams beyond CHANGE_STREAMS_MAX are refused and free their slot when dropped."""
+    import changefeed
+    from setup import load_config
+
+    monkeypatch.setenv("CHANGE_STREAMS_MAX", "1")
+    load_config.cache_clear()
+    try:
+        stream = changefeed.stream_changes()
+        assert client.get("/changes/stream").status_code == 503
+        del stream
+        assert changefeed.open_streams() == 0
+    finally:
+        load_config.cache_clear()
+
+
+def test_health_ready_after_startup(setup_db):
+    from main import app
+    from fastapi.testclient import TestClient
+
+    assert TestClient(app).get("/health/ready").status_code == 503
+    with TestClient(app) as started:
+        assert started.get("/health/live").status_code == 200
+        assert started.get("/health/ready").json() == {"status": "ready"}
+        assert started.get("/students/4/recommendations").status_code == 200, "Model loaded by warm_up"
+        # Pooled connections are handed back and reused
+        for _ in range(30):
+            assert started.get("/students").status_code == 200
+
+
+
+def test_main_does_not_import_numpy():
+    """Test that numpy and scipy (the recommendation model) are left out of the API's import."""
+    import os
+    import subprocess
+    import sys
+
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    loaded = subprocess.run(
+        [sys.executable, "-c", "import sys, main; print(sorted({'numpy', 'scipy'} & set(sys.modules)))"],
+        cwd=root, capture_output=True, text=True, check=True).stdout
+    assert loaded.strip() == "[]"
+
+# ------------------ Test for export ------------------------
+
+def test_parquet_export_incremental(client, setup_db, tmp_path):
+    import pyarrow.dataset as ds
+    from export import export
+
+    counts = export(setup_db, tmp_path)
+    students = client.get("/students").json()
+    assert counts["students"] == len(students)
+    exported = ds.dataset(tmp_path / "students", format="parquet", partitioning="hive")
+    assert exported.count_rows() == len(students)
+    assert "year" in exported.schema.names
+
+    time.sleep(0.01)
+    client.patch(f"/students/{students[0]['student_id']}", json={"last_name": "Exported"})
+    counts = export(setup_db, tmp_path)
+    assert counts["students"] == 1
+    assert counts["courses"] == 0
+    exported = ds.dataset(tmp_path / "students", format="parquet", partitioning="hive")
+    assert exported.count_rows() == len(students) + 1
+
+
+# ------------------ Test for serving ------------------------
+
+def test_serve_pool_sizes_fit_budget():
+    from serve import pool_sizes
+
+    assert pool_sizes(4, 87, 2, 20) == (2, 17)
+    assert pool_sizes(2, 87, 2, 20) == (2, 20)
+    assert pool_sizes(4, 87, 2, 20, pools=3) == (2, 5), "Shard pools share the worker's connections"
+    assert pool_sizes(4, 87, 2, 20, dedicated=11) == (2, 6), "Room for the LISTEN and SSE connections"
+    with pytest.raises(ValueError):
+        pool_sizes(8, 5, 2, 20)
+    with pytest.raises(ValueError):
+        pool_sizes(4, 87, 2, 20, pools=20)
+    with pytest.raises(ValueError):
+        pool_sizes(4, 87, 2, 20, dedicated=17)
+
+
+# ------------------ Test for profiling ------------------------
+
+def test_admin_profiling(client, setup_db, monkeypatch):
+    import threading
+    from setup import load_config
+
+    monkeypatch.setenv("ADMIN_TOKEN", "test-token")
+    load_config.cache_clear()
+    try:
+        headers = {"X-Admin-Token": "test-token"}
+        assert client.get("/admin/profile/routes").status_code == 403
+        client.delete("/admin/profile", headers=headers)
+
+        for _ in range(3):
+            client.get("/students/1")
+        routes = {r["route"]: r for r in client.get("/admin/profile/routes", headers=headers).json()}
+        student = routes["GET /students/{student_id}"]
+        assert student["requests"] == 3
+        assert student["cpu_ms"] <= student["wall_ms"]
+
+        hot = client.get("/admin/profile/hot-ids", params={"top": 1}, headers=headers).json()
+        assert hot["students"] == [{"id": 1, "requests": 3}]
+
+        done = threading.Event()
+
+        def busy():
+            while not done.is_set():
+                client.get("/enrollments")
+
+        worker = threading.Thread(target=busy)
+        worker.start()
+        try:
+            stacks = client.get("/admin/profile/stacks", params={"seconds": 1, "interval_ms": 2},
+                                headers=headers).text
+        finally:
+            done.set()
+            worker.join()
+        assert "main.py:list_enrollments" in stacks
+    finally:
+        load_config.cache_clear()
+
+
+def test_route_statement_timeout(client, setup_db, monkeypatch):
+    import timeouts
+    from setup import get_connection, load_config
+
+    monkeypatch.setenv("ADMIN_TOKEN", "test-token")
+    monkeypatch.setitem(timeouts.ROUTE_TIMEOUTS_MS, "GET /students/filter", 200)
+    load_config.cache_clear()
+    headers = {"X-Admin-Token": "test-token"}
+    try:
+        client.delete("/admin/profile", headers=headers)
+        locker = get_connection()
+        try:
+            with locker.cursor() as cursor:
+                cursor.execute("LOCK TABLE students IN ACCESS EXCLUSIVE MODE;")
+            started = time.perf_counter()
+            response = client.get("/students/filter", params={"name": "ar"})
+            assert response.status_code == 504
+            assert time.perf_counter() - started < 5, "The query should stop at the route's timeout"
+        finally:
+            locker.rollback()
+            locker.close()
+
+        assert client.get("/students/filter", params={"name": "ar"}).status_code == 200
+        stats = client.get("/admin/queries", headers=headers).json()
+        assert stats["timeouts"] == {"GET /students/filter": 1}
+    finally:
+        load_config.cache_clear()
+
+
+def test_disconnect_cancels_query(setup_db, monkeypatch):
+    """Test that a GET whose client goes away no longer runs in PostgreSQL."""
+    import asyncio
+    import timeouts
+    from main import app
+    from setup import get_connection
+
+    monkeypatch.setitem(timeouts.ROUTE_TIMEOUTS_MS, "GET /students/filter", 60_000)
+
+    def waiting_queries():
+        with watcher.cursor() as cursor:
+            cursor.execute("""
+                SELECT query FROM pg_stat_activity
+                WHERE datname = current_database() AND pid <> pg_backend_pid()
+                  AND state = 'active' AND query LIKE '%%FROM students%%';
+            """)
+            return [row[0] for row in cursor.fetchall()]
+
+    async def request_and_leave():
+        requested = False
+        gone = asyncio.Event()
+        sent = []
+
+        async def receive():
+            nonlocal requested
+            if not requested:
+                requested = True
+                return {"type": "http.request", "body": b"", "more_body": False}
+            await gone.wait()
+            return {"type": "http.disconnect"}
+
+        async def send(message):
+            sent.append(message)
+
+        scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": "1.1", "method": "GET",
+                 "scheme": "http", "path": "/students/filter", "raw_path": b"/students/filter",
+                 "root_path": "", "query_string": b"name=ar", "headers": [],
+                 "client": ("127.0.0.1", 50000), "server": ("testserver", 80)}
+        handler = asyncio.create_task(app(scope, receive, send))
+        for _ in range(100):
+            if await asyncio.to_thread(waiting_queries):
+                break
+            await asyncio.sleep(0.05)
+        else:
+            raise AssertionError("The query never reached PostgreSQL")
+        gone.set()
+        # The lock is still held: the query can only leave by being cancelled
+        for _ in range(100):
+            remaining = await asyncio.to_thread(waiting_queries)
+            if not remaining:
+                break
+            await asyncio.sleep(0.05)
+        await asyncio.to_thread(locker.rollback)
+        await asyncio.wait_for(handler, 10)
+        return remaining, sent
+
+    locker = get_connection(setup_db)
+    watcher = get_connection(setup_db)
+    watcher.autocommit = True
+    try:
+        with locker.cursor() as cursor:
+            cursor.execute("LOCK TABLE students IN ACCESS EXCLUSIVE MODE;")
+        remaining, sent = asyncio.run(request_and_leave())
+        assert remaining == [], "The query kept running after the client disconnected"
+        assert sent[0]["status"] == 499
+    finally:
+        locker.rollback()
+        locker.close()
+        watcher.close()
+
+def test_route_timeouts_name_existing_routes():
+    from main import app
+    from timeouts import ROUTE_TIMEOUTS_MS
+
+    labels = {f"{method} {route.path}" for route in app.routes for method in getattr(route, "methods", ())}
+    assert set(ROUTE_TIMEOUTS_MS) <= labels, f"Unknown routes: {set(ROUTE_TIMEOUTS_MS) - labels}"
+
+
+# ------------------ Test for sharding ------------------------
+
+def test_sharded_department_routing(client, sharded):
+    courses = client.get("/departments/1/courses").json()
+    assert {c["name"] for c in courses} == {"Python", "Data Science"}
+    assert client.get("/departments/99/courses").json() == []
+
+    everything = client.get("/courses").json()
+    assert len(everything) == 5
+    assert {c["department_id"] for c in everything} == {1, 2}
+
+    response = client.get("/courses", params={"sort": "-credits,name", "limit": 3})
+    expected = sorted(everything, key=lambda c: (-c["credits"], c["name"], c["course_id"]))
+    assert [c["name"] for c in response.json()] == [c["name"] for c in expected[:3]]
+    assert "offset=3" in response.headers["Link"]
+    last = client.get("/courses", params={"sort": "-credits,name", "limit": 3, "offset": 3})
+    assert [c["name"] for c in last.json()] == [c["name"] for c in expected[3:]]
+    assert "Link" not in last.headers
+
+    only_math = client.get("/courses", params={"department_id": 2}).json()
+    assert {c["department_id"] for c in only_math} == {2}
+
+    catalogue = client.get("/catalogue").json()
+    assert [d["department_id"] for d in catalogue] == [1, 2]
+
+
+def test_sharded_unmapped_department(client, setup_db, sharded):
+    """Test that a department no shard holds is read from the API database, not dropped."""
+    from setup import get_connection
+
+    con = get_connection(setup_db)
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("INSERT INTO departments (department_id, name) VALUES (3, 'Physics');")
+            cursor.execute("INSERT INTO courses (name, credits, department_id) VALUES ('Mechanics', 5, 3);")
+    con.close()
+
+    assert [c["name"] for c in client.get("/departments/3/courses").json()] == ["Mechanics"]
+    mixed = client.get("/courses", params={"department_id": [1, 3]}).json()
+    assert sorted(c["name"] for c in mixed) == ["Data Science", "Mechanics", "Python"]
+    everything = client.get("/courses").json()
+    assert len(everything) == 6 and len({c["course_id"] for c in everything}) == 6
+    assert [d["department_id"] for d in client.get("/departments").json()] == [1, 2, 3]
+    assert sorted(d["department_id"] for d in client.get("/catalogue").json()) == [1, 2, 3]
+    assert [c["name"] for c in client.get("/instructors", params={"department_id": 3}).json()] == []
+
+
+def test_merged_text_sort_is_bytewise(client, setup_db):
+    """Test that text sort columns are compared in code point order when pages are merged."""
+    from psycopg2 import sql
+    from filters import build_list_query
+    from setup import get_connection
+
+    query, _ = build_list_query(sql.SQL("SELECT * FROM courses"), [], {"name": "name", "credits": "credits"},
+                                "course_id", "-credits,name", bytewise=("name",))
+    con = get_connection(setup_db)
+    try:
+        assert 'ORDER BY "credits" DESC, "name" COLLATE "C" ASC, "course_id" ASC' in query.as_string(con)
+    finally:
+        con.close()
+
+
+def test_sharded_text_sort_ignores_collation(client, sharded):
+    """Test that merged text sorts page correctly when a shard's collation disagrees with code point order."""
+    import psycopg2
+    from setup import get_connection
+
+    shard_a, shard_b = sharded
+    con = get_connection(shard_a)
+    try:
+        with con:
+            with con.cursor() as cursor:
+                cursor.execute('ALTER TABLE courses ALTER COLUMN name TYPE VARCHAR(150) COLLATE "unicode";')
+    except psycopg2.errors.FeatureNotSupported:
+        pytest.skip("PostgreSQL is built without ICU")
+    finally:
+        con.close()
+
+    for database_name, statements in (
+        (shard_a, ["UPDATE courses SET name = 'apple' WHERE name = 'Python';",
+                   "UPDATE courses SET name = 'Zoo' WHERE name = 'Data Science';",
+                   "INSERT INTO courses (name, credits, department_id) VALUES ('Åsa', 5, 1), ('berry', 5, 1);"]),
+        (shard_b, ["UPDATE courses SET name = 'x ' || name;"]),
+    ):
+        con = get_connection(database_name)
+        with con:
+            with con.cursor() as cursor:
+                for statement in statements:
+                    cursor.execute(statement)
+        con.close()
+
+    names = []
+    for offset in range(0, 7, 2):
+        page = client.get("/courses", params={"sort": "name", "limit": 2, "offset": offset}).json()
+        names += [c["name"] for c in page]
+    assert names == sorted(names) and len(set(names)) == 7
+    assert names[0] == "Zoo"
+
+
+# ------------------ Test for autocomplete ------------------------
+
+def test_student_autocomplete(setup_db):
+    import autocomplete
+    from main import app
+    from fastapi.testclient import TestClient
+
+    def caught_up():
+        """Waits until the index has applied every change committed so far."""
+        position = started.get("/changes", params={"limit": 5000}).json()["cursor"]
+        assert autocomplete.student_index.wait_for(position, timeout=10), "The index did not follow the feed"
+
+    with TestClient(app) as started:
+        matches = started.get("/students/autocomplete", params={"q": "JES"}).json()
+        assert [m["email"] for m in matches] == ["jesper.nilsson@yh.se"]
+        assert {m["last_name"] for m in started.get("/students/autocomplete", params={"q": "ar"}).json()} \
+            == {"Charlesston", "Gustavsson"}
+
+        created = started.post("/students", json={"first_name": "Jessica", "last_name": "Typeahead",
+                                                  "email": "jessica@yh.se", "enrollment_date": "2025-01-01"})
+        student_id = created.json()["id"]
+        caught_up()
+        assert len(started.get("/students/autocomplete", params={"q": "jes"}).json()) == 2
+
+        started.delete(f"/students/{student_id}")
+        caught_up()
+        assert started.get("/students/autocomplete", params={"q": "typeahead"}).json() == []
+
+
+def test_student_autocomplete_without_index(client, setup_db):
+    import autocomplete
+
+    matches = client.get("/students/autocomplete", params={"q": "jes"}).json()
+    assert [m["email"] for m in matches] == ["jesper.nilsson@yh.se"]
+
+    # Both paths fold case the same way, beyond ASCII too
+    client.post("/students", json={"first_name": "Åsa", "last_name": "Große",
+                                   "email": "asa.grosse@yh.se", "enrollment_date": "2025-01-01"})
+    index = autocomplete.PrefixIndex(max_terms=1000)
+    index.load([(1, "Åsa", "Große", "asa.grosse@yh.se")])
+    for q in ("ÅSA G", "grosse", "GROẞE"):
+        assert [m["email"] for m in client.get("/students/autocomplete", params={"q": q}).json()] \
+            == [m["email"] for m in index.search(q)] == ["asa.grosse@yh.se"], q
+
+
+def test_student_autocomplete_max_terms(setup_db, monkeypatch):
+    import autocomplete
+    from main import app
+    from fastapi.testclient import TestClient
+    from setup import load_config
+
+    index = autocomplete.PrefixIndex(max_terms=6)
+    index.load([(1, "Ada", "Lovelace", "ada@yh.se"), (2, "Alan", "Turing", "alan@yh.se")])
+    assert index.ready and len(index) == 2
+    index.upsert(3, "Grace", "Hopper", "grace@yh.se")
+    assert not index.ready and len(index) == 0, "An index growing past max_terms is dropped"
+    index.upsert(3, "Grace", "Hopper", "grace@yh.se")
+    assert len(index) == 0
+
+    index.load([(1, "Ada", "Lovelace", "ada@yh.se")] * 3)
+    assert not index.ready
+
+    # Too many students for the index: the API answers from the database
+    monkeypatch.setenv("AUTOCOMPLETE_MAX_TERMS", "5")
+    load_config.cache_clear()
+    try:
+        with TestClient(app) as started:
+            assert not autocomplete.student_index.ready
+            matches = started.get("/students/autocomplete", params={"q": "JES"}).json()
+            assert [m["email"] for m in matches] == ["jesper.nilsson@yh.se"]
+    finally:
+        load_config.cache_clear()
+
+
+def test_create_student_idempotency_key(client, setup_db):
+    import idempotency
+    from setup import get_connection
+
+    student = {"first_name": "Retry", "last_name": "Safe", "email": "retry@yh.se",
+               "enrollment_date": "2025-01-01"}
+    headers = {"Idempotency-Key": "create-retry-safe"}
+    first = client.post("/students", json=student, headers=headers)
+    retry = client.post("/students", json=student, headers=headers)
+    assert first.status_code == retry.status_code == 200
+    assert first.json() == retry.json(), "Retry should return the stored response"
+    response = client.get("/students/filter", params={"name": "Retry"})
+    assert response.status_code == 200
+    assert [s["email"] for s in response.json()] == ["retry@yh.se"], "The retry must not create a second student"
+
+    other = dict(student, email="other@yh.se")
+    response = client.post("/students", json=other, headers=headers)
+    assert response.status_code == 422, "Key reused for a different request"
+
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute("UPDATE idempotency_keys SET expires_at = now() - interval '1 second';")
+    response = client.post("/students", json=other, headers=headers)
+    assert response.status_code == 200, "Expired keys can be reused"
+    assert response.json()["id"] != first.json()["id"]
+
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute("UPDATE idempotency_keys SET expires_at = now() - interval '1 second';")
+    assert idempotency.evict_expired() == 1
+
+
+# ------------------ Test for recommendations ------------------------
+
+def test_course_prerequisites(client, setup_db):
+    response = client.get("/courses/5/prerequisites")
+    assert response.json() == {"course_id": 5, "prerequisites": [1, 3], "all_prerequisites": [1, 3, 4]}
+
+    response = client.put("/courses/4/prerequisites", json={"prerequisite_ids": [5]})
+    assert response.status_code == 409, "Calculus -> Data Science -> Linear Algebra -> Calculus is a cycle"
+
+    response = client.put("/courses/2/prerequisites", json={"prerequisite_ids": [4, 999]})
+    assert response.status_code == 404
+
+    response = client.put("/courses/2/prerequisites", json={"prerequisite_ids": [4]})
+    assert response.json()["all_prerequisites"] == [4]
+
+
+def test_student_recommendations(client, setup_db):
+    import recommend
+    from setup import get_connection
+
+    def recommended(student_id):
+        return [c["course_id"] for c in client.get(f"/students/{student_id}/recommendations").json()]
+
+    def refresh():
+        # What the background refresher does; requests never load or rebuild the model
+        con = get_connection(setup_db)
+        try:
+            with con:
+                recommend.course_model.refresh(con)
+        finally:
+            con.close()
+
+    recommend.course_model.clear()
+    try:
+        assert client.get("/students/4/recommendations").status_code == 503
+        refresh()
+        # Taken courses are left out, Linear Algebra needs Calculus first
+        assert recommended(4) == [4]
+        assert recommended(3) == [3, 2]
+        # No history: most popular first
+        assert recommended(1) == [1, 2, 4]
+        assert client.get("/students/999/recommendations").status_code == 404
+
+        client.post("/courses/4/grades", json={"grades": [{"student_id": 4, "grade": 4}]})
+        assert recommended(4) == [4], "Unchanged until the next refresh"
+        refresh()
+        assert recommended(4) == [3], "Refreshed incrementally after the new grade"
+
+        batch = dict(recommend.course_model.recommend_all(limit=5))
+        assert [course_id for course_id, _ in batch[4]] == [3]
+        assert sorted(batch) == [2, 3, 4, 6]
+    finally:
+        recommend.course_model.clear()
+
+
+def test_recommendation_model_late_commit(setup_db):
+    """Test that a grade committed by a transaction open during a refresh comes with the next one."""
+    import recommend
+    from setup import get_connection
+
+    model = recommend.CourseModel()
+    reader = get_connection(setup_db)
+    writer = get_connection(setup_db)
+    try:
+        with reader:
+            model.refresh(reader)
+        with writer.cursor() as cursor:
+            cursor.execute("INSERT INTO student_courses (student_id, course_id, grade) VALUES (1, 1, 4);")
+        with reader:
+            model.refresh(reader)
+        assert 1 not in model._history
+        writer.commit()
+
+        with reader:
+            model.refresh(reader)
+        assert model._history[1] == {1: True}
+    finally:
+        writer.close()
+        reader.close()
+
+
+# ------------------ Test for the audit log ------------------------
+
+def test_audit_log(client, setup_db, monkeypatch):
+    import audit
+    import psycopg2
+    from setup import get_connection, load_config
+
+    monkeypatch.setenv("ADMIN_TOKEN", "test-token")
+    load_config.cache_clear()
+    headers = {"X-Admin-Token": "test-token", "X-Actor": "registrar"}
+    try:
+        audit.flush()
+        client.put("/students/4", json={"first_name": "Arina", "last_name": "Gustavsson",
+                                        "email": "arina.g@yh.se", "enrollment_date": "2025-01-28"},
+                   headers=headers)
+        client.patch("/students/4", json={"email": "arina@yh.se"}, headers=headers)
+        client.delete("/students/4", headers=headers)
+        client.put("/students/999", json={"first_name": "No", "last_name": "One",
+                                          "email": "no@yh.se", "enrollment_date": "2025-01-28"})
+        assert audit.flush() == 3, "Failed requests are not audited"
+
+        events = client.get("/admin/audit", params={"entity": "students", "entity_id": 4},
+                            headers=headers).json()
+        assert [e["operation"] for e in events] == ["delete", "update", "update"]
+        assert {e["actor"] for e in events} == {"registrar"}
+        put = events[2]
+        assert put["before"]["email"] == "arina@yh.se" and put["after"]["email"] == "arina.g@yh.se"
+        assert events[0]["before"]["email"] == "arina@yh.se" and events[0]["after"] is None
+
+        assert client.get("/admin/audit", params={"since": "2020-01-01"}, headers=headers).status_code == 400
+
+        for i in range(2):
+            client.post("/students", json={"first_name": "Audit", "last_name": "Twin",
+                                           "email": f"audit.twin{i}@yh.se", "enrollment_date": "2025-01-28"})
+        client.delete("/students/?first_name=Audit&last_name=Twin")
+        assert audit.flush() == 4, "Both creates and both deletions by name"
+
+        with get_connection() as con:
+            with con.cursor() as cursor:
+                with pytest.raises(psycopg2.errors.RaiseException):
+                    cursor.execute("DELETE FROM audit_log;")
+    finally:
+        load_config.cache_clear()
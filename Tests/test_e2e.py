@@ -5,58 +5,36 @@ import pytest
 import requests
 from dotenv import load_dotenv
 
-from setup import create_tables, get_connection, seed_data
+from setup import clear_data, create_tables, seed_data
 
 load_dotenv(override=True)
 
 DATABASE = os.getenv("DATABASE")
 BASE_URL = os.getenv("BASE_URL")
 
-def drop_all_tables(database_name):
-    """Drop all tables in the test database."""
-    with get_connection(database_name) as conn:
-        with conn.cursor() as cursor:
-            # Disable foreign key checks while dropping tables
-            cursor.execute("SET session_replication_role = 'replica';")
-
-            # Drop all tables
-            cursor.execute("""
-                DO $$ 
-                DECLARE 
-                    r RECORD;
-                BEGIN
-                    FOR r IN (SELECT tablename FROM pg_tables WHERE schemaname = 'public') LOOP
-                        EXECUTE 'DROP TABLE IF EXISTS ' || quote_ident(r.tablename) || ' CASCADE';
-                    END LOOP;
-                END $$;
-            """)
-
-            # Re-enable foreign key checks
-            cursor.execute("SET session_replication_role = 'origin';")
-            conn.commit()
+# The API server runs in its own process against DATABASE, so these tests share one
+# database and must not run in parallel (pytest -n auto --dist loadgroup keeps them together).
+pytestmark = pytest.mark.xdist_group("e2e")
+
+
+@pytest.fixture(scope="session")
+def e2e_schema():
+    """Creates the schema in the server's database once per session."""
+    create_tables(DATABASE)
 
 
 @pytest.fixture(scope="function")
-def setup_db():
+def setup_db(e2e_schema):
     """
-    Setup and teardown logic for the test database.
-    Drops all tables, recreates them, and seeds test data.
+    Resets the test data before every test.
+    Only truncates and re-seeds, the tables themselves are kept between tests.
     In a real environment, we might even copy the development or production database
     """
-    # Drop all existing tables
-    drop_all_tables(DATABASE)
-
-    # Create fresh tables
-    create_tables(DATABASE)
-
-    # Seed with test data
+    clear_data(DATABASE)
     seed_data(DATABASE)
 
     yield  # Tests run here
 
-    # Cleanup after tests
-    drop_all_tables(DATABASE)
-
 # --------------- Test GET -------------------
 
 @pytest.mark.instructors
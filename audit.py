@@ -0,0 +1,171 @@
+# audit.py
+
+"""
+Audit log of who changed which student, course and instructor.
+
+Write paths in main.py call record() with the before and after images they
+already get back from INSERT/UPDATE/DELETE ... RETURNING, so auditing adds no
+statement to the request's transaction. The event is queued when that
+transaction commits (nothing is logged for rolled back changes) and a
+background writer inserts the queue in batches into audit_log.
+
+audit_log is append-only (a trigger rejects UPDATE and DELETE) and range
+partitioned by month on recorded_at. Partitions are created on demand by the
+writer (ensure_audit_partition in setup.py); old months can be detached or
+dropped as a whole. History queries always carry a time window so only the
+partitions of that window are scanned.
+
+The actor is the X-Actor header of the request (ActorMiddleware), falling
+back to the client address. Events still queued when a process dies are lost;
+the queue is flushed on shutdown.
+"""
+
+import contextvars
+import json
+import logging
+import queue
+import threading
+from datetime import datetime, timezone
+
+from psycopg2.extras import Json, execute_values
+
+from setup import get_connection
+
+logger = logging.getLogger(__name__)
+
+BUFFER_SIZE = 100_000
+BATCH_SIZE = 1_000
+FLUSH_SECONDS = 1.0
+ACTOR_HEADER = b"x-actor"
+
+current_actor = contextvars.ContextVar("current_actor", default=None)
+
+_buffer = queue.Queue(maxsize=BUFFER_SIZE)
+_flush_lock = threading.Lock()
+_partitions = set()
+
+
+def _dumps(value):
+    return json.dumps(value, default=str)
+
+
+def record(con, entity, entity_id, operation, before=None, after=None):
+    """Queues an audit event for when the current transaction of con commits."""
+    event = (datetime.now(timezone.utc), current_actor.get(), entity, entity_id, operation,
+             None if before is None else dict(before), None if after is None else dict(after))
+    con.on_commit(lambda: _enqueue(event))
+
+
+def record_many(con, entity, operation, images, key_column):
+    """record() for many rows at once; images are the before (delete) or after (create) rows."""
+    for image in images:
+        before, after = (image, None) if operation == "delete" else (None, image)
+        record(con, entity, image[key_column], operation, before, after)
+
+
+def _enqueue(event):
+    try:
+        # A full buffer slows writers down rather than losing events
+        _buffer.put(event, timeout=5)
+    except queue.Full:
+        logger.error("Audit buffer full, dropped %s %s %s", event[2], event[3], event[4])
+
+
+def pending():
+    return _buffer.qsize()
+
+
+def discard():
+    """Drops the queued events without writing them (tests, database switches). Returns how many."""
+    dropped = 0
+    with _flush_lock:
+        while True:
+            try:
+                _buffer.get_nowait()
+            except queue.Empty:
+                break
+            dropped += 1
+        _partitions.clear()
+    return dropped
+
+
+def flush(max_events=None):
+    """Writes queued events in batches. Returns the number written."""
+    written = 0
+    with _flush_lock:
+        while max_events is None or written < max_events:
+            batch = []
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(_buffer.get_nowait())
+                except queue.Empty:
+                    break
+            if not batch:
+                break
+            try:
+                _write(batch)
+            except Exception:
+                # Back into the queue for the next attempt
+                for event in batch:
+                    _enqueue(event)
+                raise
+            written += len(batch)
+    return written
+
+
+def _write(batch):
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            months = {event[0].replace(day=1, hour=0, minute=0, second=0, microsecond=0) for event in batch}
+            for month in months - _partitions:
+                cursor.execute("SELECT ensure_audit_partition(%s);", (month,))
+            execute_values(
+                cursor,
+                """INSERT INTO audit_log (recorded_at, actor, entity, entity_id, operation, before, after)
+                   VALUES %s;""",
+                [(recorded_at, actor, entity, entity_id, operation,
+                  None if before is None else Json(before, dumps=_dumps),
+                  None if after is None else Json(after, dumps=_dumps))
+                 for recorded_at, actor, entity, entity_id, operation, before, after in batch])
+    # Only after the commit, a rolled back CREATE TABLE must be retried
+    _partitions.update(months)
+
+
+def start_writer(interval=FLUSH_SECONDS):
+    """
+    Starts the background writer, flushing every interval seconds. Set the
+    returned Event to stop it (and call flush() for what is left).
+    """
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                flush()
+            except Exception:
+                logger.exception("Writing the audit log failed, retrying")
+
+    threading.Thread(target=run, name="audit-writer", daemon=True).start()
+    return stop
+
+
+class ActorMiddleware:
+    """ASGI middleware setting current_actor from the X-Actor header (or the client address)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        actor = dict(scope["headers"]).get(ACTOR_HEADER)
+        if actor is not None:
+            actor = actor.decode("latin-1")[:255]
+        elif scope.get("client"):
+            actor = scope["client"][0]
+        token = current_actor.set(actor)
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            current_actor.reset(token)
@@ -0,0 +1,225 @@
+# autocomplete.py
+
+"""
+In-memory prefix index for student typeahead.
+
+Every student is indexed under three case-folded terms: "first last", "last"
+and the email address. The terms live in one sorted list (with the matching
+student ids in a parallel array), so a lookup is a bisect plus a short scan.
+
+The index is built at startup (main.lifespan) and then follows the change
+feed, which every student write path in main.py publishes to, so it stays
+fresh in every worker process, not just the one that handled the write.
+The index remembers the feed cursor it has applied up to; wait_for() blocks
+until a given cursor (e.g. from GET /changes after a write) is reached.
+
+The index holds at most AUTOCOMPLETE_MAX_TERMS terms. A larger student table
+is not indexed (and an index that grows past it is dropped until the next
+start); the API then matches in the database, with the same normalize() and
+matches() so both paths find the same students.
+"""
+
+import bisect
+import logging
+import threading
+from array import array
+
+from changefeed import iter_changes, parse_cursor
+from setup import get_connection, load_config
+
+logger = logging.getLogger(__name__)
+
+MAX_TERM_LENGTH = 64
+MAX_RESULTS = 50
+
+
+def normalize(text):
+    """Case-folded and cut to MAX_TERM_LENGTH, for terms and queries alike."""
+    return text.casefold()[:MAX_TERM_LENGTH]
+
+
+def _terms(first_name, last_name, email):
+    names = [f"{first_name or ''} {last_name or ''}".strip(), last_name or "", email or ""]
+    return {normalize(name) for name in names if name}
+
+
+def matches(prefix, first_name, last_name, email):
+    """Whether a student has a term starting with prefix (already normalized)."""
+    return any(term.startswith(prefix) for term in _terms(first_name, last_name, email))
+
+
+class PrefixIndex:
+    def __init__(self, max_terms=None):
+        self.max_terms = max_terms
+        self._lock = threading.Lock()
+        self._advanced = threading.Condition(self._lock)
+        self._terms = []
+        self._ids = array("i")
+        self._students = {}
+        self.cursor = None
+        self.ready = False
+
+    def clear(self):
+        with self._lock:
+            self._terms = []
+            self._ids = array("i")
+            self._students = {}
+            self.cursor = None
+            self.ready = False
+
+    def __len__(self):
+        return len(self._students)
+
+    def _max_terms(self):
+        return load_config()["autocomplete_max_terms"] if self.max_terms is None else self.max_terms
+
+    def _overflow(self):
+        """Empties the index; searches go to the database until the next load."""
+        logger.warning("The autocomplete index exceeds %d terms, searching the database instead",
+                       self._max_terms())
+        self._terms = []
+        self._ids = array("i")
+        self._students = {}
+        self.ready = False
+
+    def load(self, students):
+        """
+        Replaces the contents with (student_id, first_name, last_name, email) rows.
+        Leaves the index empty and not ready when they have more than max_terms terms.
+        """
+        max_terms = self._max_terms()
+        entries = []
+        records = {}
+        for student_id, first_name, last_name, email in students:
+            records[student_id] = (first_name, last_name, email)
+            entries.extend((term, student_id) for term in _terms(first_name, last_name, email))
+            if len(entries) > max_terms:
+                with self._lock:
+                    self._overflow()
+                return
+        entries.sort()
+        with self._lock:
+            self._terms = [term for term, _ in entries]
+            self._ids = array("i", (student_id for _, student_id in entries))
+            self._students = records
+            self.ready = True
+
+    def _remove(self, student_id):
+        record = self._students.pop(student_id, None)
+        if record is None:
+            return
+        for term in _terms(*record):
+            position = bisect.bisect_left(self._terms, term)
+            while position < len(self._terms) and self._terms[position] == term:
+                if self._ids[position] == student_id:
+                    del self._terms[position]
+                    del self._ids[position]
+                    break
+                position += 1
+
+    def upsert(self, student_id, first_name, last_name, email):
+        terms = _terms(first_name, last_name, email)
+        with self._lock:
+            if not self.ready:
+                return
+            self._remove(student_id)
+            if len(self._terms) + len(terms) > self._max_terms():
+                self._overflow()
+                return
+            self._students[student_id] = (first_name, last_name, email)
+            for term in terms:
+                position = bisect.bisect_left(self._terms, term)
+                self._terms.insert(position, term)
+                self._ids.insert(position, student_id)
+
+    def remove(self, student_id):
+        with self._lock:
+            self._remove(student_id)
+
+    def search(self, prefix, limit=10):
+        """Students with a term starting with prefix, in term order, at most limit."""
+        prefix = normalize(prefix)
+        results = []
+        seen = set()
+        with self._lock:
+            position = bisect.bisect_left(self._terms, prefix)
+            while (position < len(self._terms) and len(results) < limit
+                   and self._terms[position].startswith(prefix)):
+                student_id = self._ids[position]
+                if student_id not in seen:
+                    seen.add(student_id)
+                    first_name, last_name, email = self._students[student_id]
+                    results.append({"student_id": student_id, "first_name": first_name,
+                                    "last_name": last_name, "email": email})
+                position += 1
+        return results
+
+    def apply(self, event):
+        """Applies one change-feed event (only students change the index) and advances the cursor."""
+        if event["entity"] == "students":
+            student_id = int(event["entity_id"])
+            if event["operation"] == "delete":
+                self.remove(student_id)
+            elif event["payload"]:
+                row = event["payload"]
+                self.upsert(student_id, row.get("first_name"), row.get("last_name"), row.get("email"))
+        self.advance(event["cursor"])
+
+    def advance(self, cursor):
+        with self._lock:
+            self.cursor = cursor
+            self._advanced.notify_all()
+
+    def wait_for(self, cursor, timeout=None):
+        """Waits until the events up to cursor are applied. Returns False on timeout."""
+        position = parse_cursor(cursor)
+        with self._lock:
+            return self._advanced.wait_for(
+                lambda: self.cursor is not None and parse_cursor(self.cursor) >= position, timeout)
+
+
+student_index = PrefixIndex()
+
+
+def build(index=student_index):
+    """
+    Loads all students and returns the change-feed cursor to follow from. The
+    cursor starts before every transaction that was still open, so no change is
+    missed; replayed ones are harmless.
+    """
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT txid_snapshot_xmin(txid_current_snapshot()) - 1;")
+            since = f"{cursor.fetchone()[0]}-{2 ** 62}"
+            cursor.execute("SELECT student_id, first_name, last_name, email FROM students;")
+            index.load(cursor.fetchall())
+    index.advance(since)
+    return since
+
+
+def follow(since, index=student_index):
+    """
+    Starts a daemon thread that applies change-feed events to the index.
+    Returns an Event; set it to stop following (checked at least every keepalive).
+    """
+    stop = threading.Event()
+
+    def run():
+        cursor = since
+        while not stop.is_set():
+            events = iter_changes(cursor)
+            try:
+                for event in events:
+                    if stop.is_set():
+                        return
+                    if event is not None:
+                        index.apply(event)
+                        cursor = event["cursor"]
+            except Exception:
+                logger.exception("Autocomplete change feed failed, reconnecting")
+                stop.wait(1)
+            finally:
+                events.close()
+
+    threading.Thread(target=run, name="autocomplete-follow", daemon=True).start()
+    return stop
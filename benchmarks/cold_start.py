@@ -0,0 +1,79 @@
+# cold_start.py
+
+"""
+Cold-start measurement for the API.
+
+Starts a fresh uvicorn process and records how long it takes until the process
+answers /health/live, until /health/ready reports ready, and how long the first
+and second GET /students take. Run it before and after a change to startup code.
+
+Usage:
+    python benchmarks/cold_start.py --runs 5
+"""
+
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def wait_for(url, started, timeout):
+    """Polls url until it answers 200. Returns seconds since started."""
+    deadline = started + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if requests.get(url, timeout=1).status_code == 200:
+                return time.perf_counter() - started
+        except requests.RequestException:
+            pass
+        time.sleep(0.01)
+    raise TimeoutError(f"{url} not ready after {timeout}s")
+
+
+def timed_get(url):
+    started = time.perf_counter()
+    requests.get(url).raise_for_status()
+    return time.perf_counter() - started
+
+
+def measure(port, timeout):
+    base_url = f"http://127.0.0.1:{port}"
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--port", str(port)],
+        cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        return {
+            "live": wait_for(f"{base_url}/health/live", started, timeout),
+            "ready": wait_for(f"{base_url}/health/ready", started, timeout),
+            "first_request": timed_get(f"{base_url}/students"),
+            "second_request": timed_get(f"{base_url}/students"),
+        }
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure API cold start.")
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--port", type=int, default=8099)
+    parser.add_argument("--timeout", type=float, default=30)
+    args = parser.parse_args(argv)
+
+    runs = [measure(args.port, args.timeout) for _ in range(args.runs)]
+    for name in runs[0]:
+        values = [run[name] * 1000 for run in runs]
+        print(f"{name:>15}: median {statistics.median(values):8.1f} ms  "
+              f"(min {min(values):.1f}, max {max(values):.1f})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,115 @@
+# enrollment_concurrency.py
+
+"""
+Concurrency benchmark for course registration.
+
+Fires registrations for many students (each one twice, to also provoke double
+enrollment) at one course with a limited capacity, all at the same time, against
+a running API server. Afterwards it checks in the database that the course is
+not overbooked, that nobody is enrolled twice and that the seat counter matches.
+
+Usage (server running on BASE_URL against DATABASE):
+    python benchmarks/enrollment_concurrency.py --students 2000 --capacity 500 --threads 64
+"""
+
+import argparse
+import os
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from dotenv import load_dotenv
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from setup import get_connection  # noqa: E402
+
+load_dotenv(override=True)
+
+
+def prepare(database_name, students, capacity):
+    """Creates a fresh course and the students that will compete for its seats."""
+    con = get_connection(database_name)
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO courses (name, credits, department_id, capacity)
+                VALUES ('Benchmark ' || clock_timestamp(), 5, 1, %s)
+                RETURNING course_id;
+            """, (capacity,))
+            course_id = cursor.fetchone()[0]
+
+            cursor.execute("""
+                INSERT INTO students (first_name, last_name, email, enrollment_date)
+                SELECT 'Bench', 'No' || s, 'bench' || s || '.' || %s || '@yh.se', CURRENT_DATE
+                FROM generate_series(1, %s) AS s
+                RETURNING student_id;
+            """, (course_id, students))
+            student_ids = [row[0] for row in cursor.fetchall()]
+    con.close()
+    return course_id, student_ids
+
+
+def verify(database_name, course_id, capacity):
+    """Returns a list of problems found in the database (empty when consistent)."""
+    con = get_connection(database_name)
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT COUNT(*), COUNT(DISTINCT student_id) FROM enrollments WHERE course_id = %s;",
+                           (course_id,))
+            enrolled, distinct_students = cursor.fetchone()
+            cursor.execute("SELECT enrolled_count FROM courses WHERE course_id = %s;", (course_id,))
+            counter = cursor.fetchone()[0]
+    con.close()
+
+    problems = []
+    if enrolled > capacity:
+        problems.append(f"overbooked: {enrolled} enrollments for {capacity} seats")
+    if enrolled != distinct_students:
+        problems.append(f"double enrollment: {enrolled} rows for {distinct_students} students")
+    if counter != enrolled:
+        problems.append(f"seat counter {counter} does not match {enrolled} enrollments")
+    return problems, enrolled
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Concurrent registration benchmark.")
+    parser.add_argument("--base-url", default=os.getenv("BASE_URL", "http://localhost:8000"))
+    parser.add_argument("--database", default=os.getenv("DATABASE", "university_db"))
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--capacity", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=64)
+    args = parser.parse_args(argv)
+
+    course_id, student_ids = prepare(args.database, args.students, args.capacity)
+    url = f"{args.base_url}/courses/{course_id}/enrollments"
+    attempts = student_ids * 2
+
+    session = requests.Session()
+    session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=args.threads))
+
+    def enroll(student_id):
+        try:
+            return session.post(url, json={"student_id": student_id}).status_code
+        except requests.RequestException:
+            return "connection error"
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as executor:
+        statuses = Counter(executor.map(enroll, attempts))
+    elapsed = time.perf_counter() - started
+
+    problems, enrolled = verify(args.database, course_id, args.capacity)
+
+    print(f"{len(attempts)} requests in {elapsed:.2f}s ({len(attempts) / elapsed:.0f} req/s), "
+          f"status codes: {dict(sorted(statuses.items(), key=str))}")
+    print(f"course {course_id}: {enrolled} enrolled, capacity {args.capacity}")
+    for problem in problems:
+        print(f"FAIL {problem}")
+    return 1 if problems else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,168 @@
+# partitioning.py
+
+"""
+Plain tables vs partitioned enrollments/student_courses.
+
+Builds a benchmark database with the large generated dataset (partitioned, as
+create_tables makes it) and plain copies of both tables with the same
+indexes (enrollments_heap, student_courses_heap), then times the same work on
+both:
+
+    year report      aggregate over one year of enrollments
+    month page       first page of a one month date filter (GET /enrollments)
+    one student      student_courses rows of one student (one hash partition)
+    50 students      the same for 50 students (spread over all partitions)
+    drop a year      DELETE of a year vs DETACH + DROP of its partition (rolled back)
+    vacuum           VACUUM after regrading the latest year: the whole table
+                     vs the one partition that changed
+
+Usage:
+    python benchmarks/partitioning.py --students 1000000 --runs 5
+"""
+
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+from psycopg2 import sql
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from setup import create_tables, get_connection, seed_large_data  # noqa: E402
+
+HEAP_COPIES = """
+    CREATE TABLE enrollments_heap (LIKE enrollments INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+    INSERT INTO enrollments_heap SELECT * FROM enrollments;
+    ALTER TABLE enrollments_heap ADD PRIMARY KEY (enrollment_id);
+    CREATE INDEX ON enrollments_heap (student_id);
+    CREATE INDEX ON enrollments_heap (course_id);
+    CREATE INDEX ON enrollments_heap (enrollment_date);
+    CREATE INDEX ON enrollments_heap (updated_at);
+    CREATE INDEX ON enrollments_heap (student_id, course_id);
+
+    CREATE TABLE student_courses_heap (LIKE student_courses INCLUDING DEFAULTS INCLUDING CONSTRAINTS);
+    INSERT INTO student_courses_heap SELECT * FROM student_courses;
+    ALTER TABLE student_courses_heap ADD PRIMARY KEY (student_id, course_id);
+    CREATE INDEX ON student_courses_heap (course_id);
+    CREATE INDEX ON student_courses_heap (updated_at);
+"""
+
+QUERIES = {
+    "year report": ("""
+        SELECT course_id, COUNT(*), COUNT(*) FILTER (WHERE grade = 'A') FROM {enrollments}
+        WHERE enrollment_date >= '2022-01-01' AND enrollment_date < '2023-01-01'
+        GROUP BY course_id;
+    """, lambda students: ()),
+    "month page": ("""
+        SELECT * FROM {enrollments}
+        WHERE enrollment_date >= '2022-03-01' AND enrollment_date <= '2022-03-31'
+        ORDER BY enrollment_id LIMIT 100;
+    """, lambda students: ()),
+    "one student": ("""
+        SELECT * FROM {student_courses} WHERE student_id = %s;
+    """, lambda students: (random.randint(1, students),)),
+    "50 students": ("""
+        SELECT * FROM {student_courses} WHERE student_id = ANY(%s);
+    """, lambda students: (random.sample(range(1, students + 1), 50),)),
+}
+
+
+def recreate_database(database_name):
+    con = get_connection("postgres", pooled=False)
+    con.autocommit = True
+    try:
+        with con.cursor() as cursor:
+            cursor.execute(sql.SQL("DROP DATABASE IF EXISTS {} WITH (FORCE);").format(sql.Identifier(database_name)))
+            cursor.execute(sql.SQL("CREATE DATABASE {};").format(sql.Identifier(database_name)))
+    finally:
+        con.close()
+
+
+def prepare(database_name, students):
+    recreate_database(database_name)
+    create_tables(database_name)
+    seed_large_data(database_name, students=students)
+    con = get_connection(database_name, pooled=False)
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute(HEAP_COPIES)
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute("VACUUM ANALYZE;")
+    con.close()
+
+
+def timed(cursor, statement, params=()):
+    started = time.perf_counter()
+    cursor.execute(statement, params)
+    if cursor.description is not None:
+        cursor.fetchall()
+    return (time.perf_counter() - started) * 1000
+
+
+def measure(con, students, runs):
+    """{name: (heap ms, partitioned ms)}, medians over runs."""
+    layouts = {
+        "heap": {"enrollments": "enrollments_heap", "student_courses": "student_courses_heap"},
+        "partitioned": {"enrollments": "enrollments", "student_courses": "student_courses"},
+    }
+    results = {}
+    with con.cursor() as cursor:
+        for name, (query, params) in QUERIES.items():
+            times = {layout: [] for layout in layouts}
+            for _ in range(runs):
+                arguments = params(students)
+                for layout, tables in layouts.items():
+                    times[layout].append(timed(cursor, query.format(**tables), arguments))
+            con.rollback()
+            results[name] = tuple(statistics.median(times[layout]) for layout in layouts)
+
+        # Retention: both rolled back, so every run starts from the same data
+        heap, partitioned = [], []
+        for _ in range(runs):
+            heap.append(timed(cursor, "DELETE FROM enrollments_heap "
+                                      "WHERE enrollment_date >= '2020-01-01' AND enrollment_date < '2021-01-01';"))
+            con.rollback()
+            partitioned.append(timed(cursor, "ALTER TABLE enrollments DETACH PARTITION enrollments_2020; "
+                                             "DROP TABLE enrollments_2020;"))
+            con.rollback()
+        results["drop a year"] = (statistics.median(heap), statistics.median(partitioned))
+
+    # Regrade the latest year in both layouts, then vacuum what changed
+    with con.cursor() as cursor:
+        for table in ("enrollments_heap", "enrollments"):
+            cursor.execute(f"UPDATE {table} SET grade = 'B' WHERE enrollment_date >= '2025-01-01';")
+        con.commit()
+        con.autocommit = True
+        results["vacuum"] = (timed(cursor, "VACUUM enrollments_heap;"), timed(cursor, "VACUUM enrollments_2025;"))
+        con.autocommit = False
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Compare plain and partitioned enrollments/student_courses.")
+    parser.add_argument("--database", default="partition_bench")
+    parser.add_argument("--students", type=int, default=100_000)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--keep", action="store_true", help="reuse the database of an earlier run")
+    args = parser.parse_args(argv)
+
+    if not args.keep:
+        prepare(args.database, args.students)
+    con = get_connection(args.database, pooled=False)
+    try:
+        results = measure(con, args.students, args.runs)
+    finally:
+        con.close()
+
+    print(f"{'':>15}  {'heap':>10}  {'partitioned':>12}")
+    for name, (heap, partitioned) in results.items():
+        print(f"{name:>15}: {heap:7.1f} ms  {partitioned:9.1f} ms  ({heap / partitioned:.1f}x)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,87 @@
+# serve_scaling.py
+
+"""
+Throughput of serve.py by number of worker processes.
+
+For every worker count, starts serve.py, waits for /health/ready, then lets
+--clients threads request PATH (default /enrollments, which is dominated by
+JSON serialisation) for --duration seconds and prints requests per second.
+
+Usage:
+    python benchmarks/serve_scaling.py --workers 1 2 4 8 --clients 32
+"""
+
+import argparse
+import os
+import subprocess
+import sys
+import threading
+import time
+
+import requests
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def wait_ready(base_url, timeout=60):
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        try:
+            if requests.get(f"{base_url}/health/ready", timeout=1).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.1)
+    raise TimeoutError("server did not become ready")
+
+
+def load(url, clients, duration):
+    """Returns (completed requests, errors) for clients threads hitting url for duration seconds."""
+    stop = time.perf_counter() + duration
+    counts = [0] * clients
+    errors = [0] * clients
+
+    def run(index):
+        session = requests.Session()
+        while time.perf_counter() < stop:
+            try:
+                session.get(url).raise_for_status()
+                counts[index] += 1
+            except requests.RequestException:
+                errors[index] += 1
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sum(counts), sum(errors)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Measure throughput by worker count.")
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10)
+    parser.add_argument("--path", default="/enrollments")
+    parser.add_argument("--port", type=int, default=8098)
+    args = parser.parse_args(argv)
+
+    base_url = f"http://127.0.0.1:{args.port}"
+    print(f"{os.cpu_count()} cores, {args.clients} clients, GET {args.path}")
+    for workers in args.workers:
+        server = subprocess.Popen(
+            [sys.executable, "serve.py", "--workers", str(workers), "--port", str(args.port)],
+            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        try:
+            wait_ready(base_url)
+            completed, errors = load(base_url + args.path, args.clients, args.duration)
+        finally:
+            server.terminate()
+            server.wait()
+        print(f"{workers:>3} workers: {completed / args.duration:8.1f} req/s  ({errors} errors)")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,206 @@
+# changefeed.py
+
+"""
+Change-data feed for students, courses and instructors.
+
+Every write path in main.py records its change in the change_events outbox table
+inside the same transaction and sends a NOTIFY on the entity_changes channel,
+which Postgres delivers on commit. Consumers either poll GET /changes?since=<cursor>
+or keep GET /changes/stream (server-sent events) open.
+
+A cursor is "<txid>-<event_id>". Events are only handed out once every transaction
+of this database that could still insert an older event has finished, so a consumer
+never skips an event that commits late. Transactions in other databases of the
+server do not hold events back (see _oldest_open_txid).
+
+Each stream holds a threadpool thread and a dedicated connection, so at most
+CHANGE_STREAMS_MAX (default 10) streams are open per process; more raise
+TooManyStreams (503 in main.py).
+"""
+
+import json
+import select
+import threading
+import weakref
+
+from psycopg2.extras import Json, RealDictCursor, execute_values
+
+from setup import get_connection, load_config
+
+CHANNEL = "entity_changes"
+KEEPALIVE_SECONDS = 15
+# Re-poll delays while committed events are held back by an open transaction
+HELD_BACK_POLL_SECONDS = (0.05, 0.1, 0.2, 0.5, 1.0)
+
+_streams_lock = threading.Lock()
+_open_streams = 0
+
+
+class TooManyStreams(RuntimeError):
+    pass
+
+
+def _dumps(value):
+    return json.dumps(value, default=str)
+
+
+def record_changes(cursor, changes):
+    """
+    Writes (entity, entity_id, operation, payload) tuples to the outbox using the
+    caller's cursor, so the events commit or roll back together with the change.
+    """
+    if not changes:
+        return
+    execute_values(
+        cursor,
+        "INSERT INTO change_events (entity, entity_id, operation, payload) VALUES %s;",
+        [(entity, entity_id, operation, Json(payload, dumps=_dumps))
+         for entity, entity_id, operation, payload in changes])
+    cursor.execute(f"NOTIFY {CHANNEL};")
+
+
+def record_change(cursor, entity, entity_id, operation, payload=None):
+    """Writes a single change event, see record_changes."""
+    record_changes(cursor, [(entity, entity_id, operation, payload)])
+
+
+def parse_cursor(value):
+    """Parses "<txid>-<event_id>" into a tuple. Raises ValueError for bad input."""
+    txid, event_id = value.split("-", 1)
+    return int(txid), int(event_id)
+
+
+def _oldest_open_txid(cursor):
+    """
+    (oldest txid of an open transaction in this database or None, next txid).
+    pg_stat_activity reports 32-bit xids; they are widened with the epoch of the
+    snapshot taken by the same statement.
+    """
+    cursor.execute("""
+        SELECT txid_snapshot_xmax(txid_current_snapshot()) AS next_txid,
+               ARRAY(SELECT backend_xid::text::bigint FROM pg_stat_activity
+                     WHERE datname = current_database() AND backend_xid IS NOT NULL
+                     UNION ALL
+                     SELECT transaction::text::bigint FROM pg_prepared_xacts
+                     WHERE database = current_database()) AS xids;
+    """)
+    row = cursor.fetchone()
+    next_txid = row["next_txid"]
+    epoch = next_txid >> 32 << 32
+    txids = [(epoch | xid) if (epoch | xid) < next_txid else (epoch | xid) - 2 ** 32 for xid in row["xids"]]
+    return min(txids, default=None), next_txid
+
+
+def fetch_changes(con, since="0-0", limit=500):
+    """Returns (events, next_cursor) for the events committed after the cursor."""
+    events, next_cursor, _ = _fetch(con, since, limit)
+    return events, next_cursor
+
+
+def _fetch(con, since, limit):
+    """fetch_changes, plus whether committed events were held back by an open transaction."""
+    txid, event_id = parse_cursor(since)
+    with con.cursor(cursor_factory=RealDictCursor) as cursor:
+        oldest, started = _oldest_open_txid(cursor)
+        # This statement's snapshot is newer: transactions that got their txid since the
+        # one above (any database) are open in it, the older ones in this database were seen
+        cursor.execute("""
+            WITH horizon AS (
+                SELECT LEAST(%s::bigint,
+                             (SELECT MIN(xip) FROM txid_snapshot_xip(txid_current_snapshot()) AS xip
+                              WHERE xip >= %s),
+                             txid_snapshot_xmax(txid_current_snapshot())) AS txid
+            )
+            SELECT event_id, change_events.txid, entity, entity_id, operation, payload, created_at,
+                   change_events.txid >= horizon.txid AS held_back
+            FROM change_events, horizon
+            WHERE (change_events.txid, event_id) > (%s, %s)
+            ORDER BY change_events.txid, event_id
+            LIMIT %s;
+        """, (oldest, started, txid, event_id, limit + 1))
+        rows = cursor.fetchall()
+
+    held_back = any(row["held_back"] for row in rows)
+    events = []
+    for row in rows[:limit]:
+        if row.pop("held_back"):
+            break
+        row["cursor"] = f"{row.pop('txid')}-{row['event_id']}"
+        events.append(row)
+    next_cursor = events[-1]["cursor"] if events else since
+    return events, next_cursor, held_back
+
+
+def iter_changes(since="0-0", batch_size=500):
+    """
+    Generator of change events as they commit, forever. Holds one dedicated (non
+    pooled) connection that LISTENs on the channel. Yields None after
+    KEEPALIVE_SECONDS without changes, so callers can do housekeeping.
+    Events held back by an open transaction are re-polled after a short backoff,
+    their NOTIFY has already been delivered.
+    """
+    con = get_connection(pooled=False)
+    con.autocommit = True
+    try:
+        with con.cursor() as cursor:
+            cursor.execute(f"LISTEN {CHANNEL};")
+
+        retries = 0
+        while True:
+            events, since, held_back = _fetch(con, since, batch_size)
+            yield from events
+            if len(events) == batch_size:
+                continue
+
+            if held_back:
+                timeout = HELD_BACK_POLL_SECONDS[min(retries, len(HELD_BACK_POLL_SECONDS) - 1)]
+                retries += 1
+            else:
+                timeout = KEEPALIVE_SECONDS
+                retries = 0
+            if select.select([con], [], [], timeout) == ([], [], []):
+                if not held_back:
+                    yield None
+            else:
+                con.poll()
+                con.notifies.clear()
+    finally:
+        con.close()
+
+
+def _release_stream():
+    global _open_streams
+    with _streams_lock:
+        _open_streams -= 1
+
+
+def stream_changes(since="0-0", batch_size=500):
+    """
+    Generator of server-sent events for the changes after since (see iter_changes).
+    Raises TooManyStreams when CHANGE_STREAMS_MAX streams are already open; the slot
+    is freed when the generator is closed or dropped, even if it never started.
+    """
+    global _open_streams
+    with _streams_lock:
+        if _open_streams >= load_config()["change_streams_max"]:
+            raise TooManyStreams(f"{_open_streams} change streams are open")
+        _open_streams += 1
+    stream = _stream_events(since, batch_size)
+    weakref.finalize(stream, _release_stream)
+    return stream
+
+
+def open_streams():
+    return _open_streams
+
+
+def _stream_events(since, batch_size):
+    events = iter_changes(since, batch_size)
+    try:
+        for event in events:
+            if event is None:
+                yield ": keepalive\n\n"
+            else:
+                yield f"id: {event['cursor']}\nevent: change\ndata: {_dumps(event)}\n\n"
+    finally:
+        events.close()
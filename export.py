@@ -0,0 +1,214 @@
+# export.py
+
+"""
+Analytical export of the university dataset to partitioned Parquet.
+
+Reads students, courses, instructors, departments, enrollments, student_courses
+and the deletion tombstones with server-side cursors, converts every chunk to an
+Arrow record batch and streams the batches into a Parquet dataset:
+
+    <output>/enrollments/year=2021/part-<run>-0.parquet
+    <output>/courses/part-<run>-0.parquet
+    <output>/_watermark.json
+
+Memory use is bounded by --batch-size. All tables are read from one snapshot.
+The watermark (see main.list_modified) is stored after a successful run, and the
+next run only exports rows with updated_at at or after it, as new part files (rows
+of a transaction that was open during the previous run carry the watermark itself).
+A row can appear in more than one run; keep the one with the latest updated_at per key.
+When tombstones after the stored watermark have been pruned (see retention.py) an
+incremental run would miss deletions, so it stops; export with --full into a new
+directory instead.
+
+Usage:
+    python export.py --output export/             # incremental
+    python export.py --output export/ --full      # everything again
+"""
+
+import argparse
+import json
+import os
+import sys
+from datetime import datetime
+
+import psycopg2.extensions
+import pyarrow as pa
+import pyarrow.dataset as ds
+from psycopg2 import sql
+
+from retention import HistoryExpired, check_watermark
+from setup import get_connection, load_config
+
+BATCH_SIZE = 50_000
+WATERMARK_FILE = "_watermark.json"
+
+# table -> (date column to partition by year, or None; column the watermark applies to)
+EXPORTS = {
+    "students": ("enrollment_date", "updated_at"),
+    "courses": (None, "updated_at"),
+    "instructors": (None, "updated_at"),
+    "departments": (None, "updated_at"),
+    "enrollments": ("enrollment_date", "updated_at"),
+    "student_courses": (None, "updated_at"),
+    "tombstones": (None, "deleted_at"),
+}
+
+# Postgres type oid -> Arrow type
+ARROW_TYPES = {
+    16: pa.bool_(),
+    20: pa.int64(),
+    21: pa.int16(),
+    23: pa.int32(),
+    25: pa.string(),
+    700: pa.float32(),
+    701: pa.float64(),
+    1042: pa.string(),
+    1043: pa.string(),
+    1082: pa.date32(),
+    1114: pa.timestamp("us"),
+    1184: pa.timestamp("us", tz="UTC"),
+    114: pa.string(),
+    3802: pa.string(),
+}
+JSON_TYPES = {114, 3802}
+
+
+def arrow_schema(description):
+    """Builds the Arrow schema for a cursor description."""
+    fields = []
+    for column in description:
+        if column.type_code == 1700:
+            if column.precision:
+                arrow_type = pa.decimal128(column.precision, column.scale or 0)
+            else:
+                arrow_type = pa.float64()
+        else:
+            arrow_type = ARROW_TYPES.get(column.type_code, pa.string())
+        fields.append(pa.field(column.name, arrow_type))
+    return pa.schema(fields)
+
+
+def to_batch(rows, schema, description):
+    """Converts a list of row tuples into an Arrow record batch."""
+    columns = []
+    for index, (field, column) in enumerate(zip(schema, description)):
+        values = [row[index] for row in rows]
+        if column.type_code in JSON_TYPES:
+            values = [None if value is None else json.dumps(value) for value in values]
+        elif column.type_code == 1700 and pa.types.is_floating(field.type):
+            values = [None if value is None else float(value) for value in values]
+        columns.append(pa.array(values, type=field.type))
+    return pa.RecordBatch.from_arrays(columns, schema=schema)
+
+
+def read_watermark(output):
+    path = os.path.join(output, WATERMARK_FILE)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return datetime.fromisoformat(json.load(f)["watermark"])
+
+
+def write_watermark(output, watermark):
+    path = os.path.join(output, WATERMARK_FILE)
+    with open(path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({"watermark": watermark.isoformat()}, f)
+    os.replace(path + ".tmp", path)
+
+
+def export_table(con, table, since, output, run_id, batch_size=BATCH_SIZE):
+    """Streams one table (rows changed at or after since) into its Parquet dataset. Returns the row count."""
+    partition_column, watermark_column = EXPORTS[table]
+    columns = [sql.SQL("*")]
+    if partition_column:
+        columns.append(sql.SQL("EXTRACT(YEAR FROM {})::int AS year").format(sql.Identifier(partition_column)))
+    query = sql.SQL("SELECT {} FROM {}").format(sql.SQL(", ").join(columns), sql.Identifier(table))
+    params = []
+    if since is not None:
+        query = sql.SQL("{} WHERE {} >= %s").format(query, sql.Identifier(watermark_column))
+        params.append(since)
+
+    # Named cursor: rows are fetched from the server batch_size at a time
+    with con.cursor(name=f"export_{table}") as cursor:
+        cursor.itersize = batch_size
+        cursor.execute(query, params)
+        rows = cursor.fetchmany(batch_size)
+        if not rows:
+            return 0
+        description = cursor.description
+        schema = arrow_schema(description)
+        count = 0
+
+        def batches():
+            nonlocal rows, count
+            while rows:
+                count += len(rows)
+                yield to_batch(rows, schema, description)
+                rows = cursor.fetchmany(batch_size)
+
+        ds.write_dataset(
+            batches(),
+            os.path.join(output, table),
+            schema=schema,
+            format="parquet",
+            partitioning=ds.partitioning(pa.schema([("year", pa.int32())]), flavor="hive")
+            if partition_column else None,
+            basename_template=f"part-{run_id}-{{i}}.parquet",
+            # Write each batch out as its own row group instead of buffering
+            max_rows_per_group=batch_size,
+            existing_data_behavior="overwrite_or_ignore",
+        )
+    return count
+
+
+def export(database_name, output, full=False, batch_size=BATCH_SIZE):
+    """Exports every table in EXPORTS. Returns {table: rows written}."""
+    os.makedirs(output, exist_ok=True)
+    since = None if full else read_watermark(output)
+
+    con = get_connection(database_name, pooled=False)
+    try:
+        # One snapshot for all tables and the watermark
+        con.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_REPEATABLE_READ)
+        con.set_session(readonly=True)
+        with con.cursor() as cursor:
+            cursor.execute("""
+                SELECT LEAST(now(), MIN(xact_start)) AS watermark, now()
+                FROM pg_stat_activity
+                WHERE datname = current_database() AND pid <> pg_backend_pid();
+            """)
+            watermark, started = cursor.fetchone()
+        if since is not None:
+            check_watermark(con, since)
+
+        # Not the watermark: two runs held back by the same open transaction share it
+        run_id = started.strftime("%Y%m%dT%H%M%S%f")
+        counts = {table: export_table(con, table, since, output, run_id, batch_size) for table in EXPORTS}
+        con.rollback()
+    finally:
+        con.close()
+
+    write_watermark(output, watermark)
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export the university dataset to Parquet.")
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--output", default="export")
+    parser.add_argument("--full", action="store_true", help="ignore the stored watermark")
+    parser.add_argument("--batch-size", type=int, default=BATCH_SIZE)
+    args = parser.parse_args(argv)
+
+    try:
+        counts = export(args.database or load_config()["database"], args.output, args.full, args.batch_size)
+    except HistoryExpired as e:
+        print(f"{e}: run with --full into a new directory", file=sys.stderr)
+        return 1
+    for table, count in counts.items():
+        print(f"{table}: {count} rows")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
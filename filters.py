@@ -0,0 +1,120 @@
+# filters.py
+
+"""
+Declarative filtering, sorting and paging for the list endpoints.
+
+Handlers describe their filters as (column, operator, value) conditions and the
+columns a client may sort by; build_list_query compiles them into one
+parameterised statement. Column names only ever come from the handlers, never
+from the request, and every filtered query is bounded by a LIMIT.
+
+    conditions = [("department_id", "in", [1, 2]), ("credits", ">=", 5)]
+    sortable = {"course_id": "course_id", "credits": "credits"}
+    query, params = build_list_query(sql.SQL("SELECT * FROM courses"), conditions,
+                                     sortable, "course_id", sort="-credits")
+"""
+
+from psycopg2 import sql
+
+DEFAULT_LIMIT = 100
+MAX_LIMIT = 1000
+MAX_OFFSET = 10_000
+MAX_IN_VALUES = 500
+MAX_SORT_KEYS = 3
+
+OPERATORS = {
+    "=": "{} = %s",
+    "in": "{} = ANY(%s)",
+    # Set by the API (shard routing), not by clients; rows without a value are kept
+    "not in": "({0} IS NULL OR {0} <> ALL(%s))",
+    ">=": "{} >= %s",
+    "<=": "{} <= %s",
+}
+
+
+class FilterError(ValueError):
+    pass
+
+
+def _identifier(column):
+    return sql.Identifier(*column.split("."))
+
+
+def sort_columns(sort, sortable, key):
+    """
+    Parses "name,-credits" into [(column, descending)]. Only names in sortable
+    are allowed. The key column is always added last so paging is stable.
+    """
+    columns = []
+    names = [name.strip() for name in sort.split(",") if name.strip()] if sort else []
+    if len(names) > MAX_SORT_KEYS:
+        raise FilterError(f"At most {MAX_SORT_KEYS} sort columns are allowed")
+    for name in names:
+        descending = name.startswith("-")
+        name = name.lstrip("-")
+        if name not in sortable:
+            raise FilterError(f"Cannot sort by '{name}', allowed: {', '.join(sorted(sortable))}")
+        columns.append((sortable[name], descending))
+    columns.append((key, False))
+    return columns
+
+
+def parse_sort(sort, sortable, key, bytewise=()):
+    """
+    ORDER BY items for sort (see sort_columns). The text columns in bytewise
+    are compared with COLLATE "C", in code point order like sort_rows.
+    """
+    items = []
+    for column, descending in sort_columns(sort, sortable, key):
+        item = _identifier(column)
+        if column in bytewise:
+            item = sql.SQL('{} COLLATE "C"').format(item)
+        items.append(sql.SQL("{} DESC" if descending else "{} ASC").format(item))
+    return items
+
+
+def sort_rows(rows, sort, sortable, key):
+    """
+    Sorts result rows (dicts) the way ORDER BY sort would, NULLs last ascending
+    and first descending. Used to merge pages from several databases, which
+    must have sorted their text columns bytewise (see parse_sort): Python
+    compares strings by code point, not by the database collation.
+    """
+    for column, descending in reversed(sort_columns(sort, sortable, key)):
+        name = column.rsplit(".", 1)[-1]
+        rows.sort(key=lambda row: (row[name] is None, row[name]), reverse=descending)
+    return rows
+
+
+def build_list_query(base, conditions, sortable, key, sort=None, limit=None, offset=0, bytewise=()):
+    """
+    Returns (query, params) for base ("SELECT ... FROM ...") filtered by the
+    conditions whose value is not None, sorted (see parse_sort) and limited.
+    Raises FilterError when the request exceeds the complexity limits.
+    """
+    limit = DEFAULT_LIMIT if limit is None else limit
+    if not 1 <= limit <= MAX_LIMIT:
+        raise FilterError(f"limit must be between 1 and {MAX_LIMIT}")
+    if not 0 <= offset <= MAX_OFFSET:
+        raise FilterError(f"offset must be between 0 and {MAX_OFFSET}")
+
+    where, params = [], []
+    in_values = 0
+    for column, operator, value in conditions:
+        if value is None:
+            continue
+        if operator in ("in", "not in"):
+            value = list(value)
+        if operator == "in":
+            in_values += len(value)
+        where.append(sql.SQL(OPERATORS[operator]).format(_identifier(column)))
+        params.append(value)
+    if in_values > MAX_IN_VALUES:
+        raise FilterError(f"At most {MAX_IN_VALUES} values are allowed in list filters")
+
+    query = base
+    if where:
+        query = sql.SQL("{} WHERE {}").format(query, sql.SQL(" AND ").join(where))
+    query = sql.SQL("{} ORDER BY {} LIMIT %s OFFSET %s;").format(
+        query, sql.SQL(", ").join(parse_sort(sort, sortable, key, bytewise)))
+    return query, params + [limit, offset]
@@ -0,0 +1,124 @@
+# idempotency.py
+
+"""
+Idempotency keys for retry-safe writes.
+
+A request that carries an Idempotency-Key claims the key inside its own
+transaction. A retry with the same key waits for the first request to finish
+and then gets the stored response instead of writing again. If the first
+request fails, its transaction (and the claim) is rolled back and the retry
+runs normally.
+
+Each key stores a fingerprint of the request it was first used with; reusing a
+key for a different request raises KeyReused. Keys expire after
+IDEMPOTENCY_TTL_SECONDS (default 24 hours) and are evicted in the background
+(see start_evictor). A retry of a finished request is answered from a single
+SELECT, without writing anything.
+"""
+
+import hashlib
+import json
+import logging
+import threading
+
+from fastapi.encoders import jsonable_encoder
+from psycopg2.extras import Json
+
+from setup import get_connection, load_config
+
+logger = logging.getLogger(__name__)
+
+EVICT_BATCH_SIZE = 1000
+
+
+class KeyReused(ValueError):
+    pass
+
+
+def fingerprint(operation, payload):
+    """16-byte digest of an operation (e.g. "POST /students") and its JSON payload."""
+    body = json.dumps(jsonable_encoder(payload), sort_keys=True, separators=(",", ":"))
+    return hashlib.blake2b(f"{operation}\n{body}".encode(), digest_size=16).digest()
+
+
+def _check(key, stored_fingerprint, request_fingerprint):
+    if (request_fingerprint is not None and stored_fingerprint is not None
+            and bytes(stored_fingerprint) != request_fingerprint):
+        raise KeyReused(f"Idempotency-Key {key!r} was already used for a different request")
+
+
+def claim(con, key, request_fingerprint=None):
+    """
+    Claims the key in the current transaction of con.
+    Returns None for a new (or expired) key, otherwise the response stored for it.
+    Raises KeyReused when the key belongs to a different request.
+    """
+    with con.cursor() as cursor:
+        # Fast path for retries of finished requests: read only
+        cursor.execute("""
+            SELECT response, fingerprint FROM idempotency_keys
+            WHERE idempotency_key = %s AND expires_at > now() AND response IS NOT NULL;
+        """, (key,))
+        row = cursor.fetchone()
+        if row:
+            _check(key, row[1], request_fingerprint)
+            return row[0]
+
+        cursor.execute("""
+            INSERT INTO idempotency_keys (idempotency_key, fingerprint, expires_at)
+            VALUES (%s, %s, now() + make_interval(secs => %s))
+            ON CONFLICT (idempotency_key) DO UPDATE
+                SET response = NULL, fingerprint = EXCLUDED.fingerprint,
+                    created_at = now(), expires_at = EXCLUDED.expires_at
+                WHERE idempotency_keys.expires_at <= now()
+            RETURNING idempotency_key;
+        """, (key, request_fingerprint, load_config()["idempotency_ttl"]))
+        if cursor.fetchone():
+            return None
+
+        # Claimed by a request that has committed in the meantime
+        cursor.execute("SELECT response, fingerprint FROM idempotency_keys WHERE idempotency_key = %s;", (key,))
+        response, stored_fingerprint = cursor.fetchone()
+        _check(key, stored_fingerprint, request_fingerprint)
+        return response
+
+
+def store(con, key, response):
+    """Stores the response for a claimed key and returns it JSON encoded."""
+    response = jsonable_encoder(response)
+    with con.cursor() as cursor:
+        cursor.execute("UPDATE idempotency_keys SET response = %s WHERE idempotency_key = %s;",
+                       (Json(response), key))
+    return response
+
+
+def evict_expired(batch_size=EVICT_BATCH_SIZE):
+    """Deletes expired keys in batches (one transaction each). Returns the number deleted."""
+    deleted = 0
+    while True:
+        with get_connection() as con:
+            with con.cursor() as cursor:
+                cursor.execute("""
+                    DELETE FROM idempotency_keys WHERE idempotency_key IN (
+                        SELECT idempotency_key FROM idempotency_keys
+                        WHERE expires_at <= now() LIMIT %s
+                        FOR UPDATE SKIP LOCKED);
+                """, (batch_size,))
+                deleted += cursor.rowcount
+                if cursor.rowcount < batch_size:
+                    return deleted
+
+
+def start_evictor(interval=60):
+    """Starts a daemon thread evicting expired keys every interval seconds. Set the returned Event to stop it."""
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                evict_expired()
+            except Exception:
+                logger.exception("Evicting expired idempotency keys failed")
+
+    threading.Thread(target=run, name="idempotency-evictor", daemon=True).start()
+    return stop
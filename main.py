@@ -1,12 +1,31 @@
 # main.py
 
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Header, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from contextlib import asynccontextmanager
+import hashlib
+import hmac
 from psycopg2.extras import RealDictCursor
+from psycopg2 import sql
 import psycopg2
-from dotenv import load_dotenv
-from setup import get_connection
+from setup import get_connection, open_pool, close_pool, load_config, current_queries
+import schemas
+from changefeed import (record_change, record_changes, fetch_changes, stream_changes, parse_cursor,
+                        TooManyStreams)
+import audit
+import idempotency
+import partitions
+import profiling
+import autocomplete
+import retention
+import sharding
+import timeouts
+from sharding import shard_map
+from filters import build_list_query, sort_rows, FilterError, MAX_LIMIT, MAX_OFFSET
 import os
 from typing import List, Optional
+from datetime import date, datetime, timedelta, timezone
 from fastapi import Query
 from schemas import (
     CourseCreate,
@@ -16,27 +35,396 @@ from schemas import (
     InstructorUpdate,
     InstructorCreate,
     AverageGradeResponse,
-    InstructorPatch
+    InstructorPatch,
+    StudentPatch,
+    CoursePatch,
+    StudentBulkDelete,
+    CourseBulkDelete,
+    EnrollmentCreate,
+    CohortEnrollment,
+    GradeSubmission,
+    PrerequisiteUpdate
 )
 
-app = FastAPI()
+def warm_up():
+    """
+    Everything the first requests would otherwise pay for: opening the pooled
+    connections, the student autocomplete index, the recommendation model,
+    building the OpenAPI document and the JSON schemas of the models.
+    """
+    open_pool()
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT 1;")
+    app.state.autocomplete_stop = autocomplete.follow(autocomplete.build())
+    app.state.idempotency_stop = idempotency.start_evictor()
+    app.state.retention_stop = retention.start_pruner()
+    # numpy and scipy are imported here, not with main
+    import recommend
+    with get_connection() as con:
+        recommend.course_model.refresh(con)
+    app.state.recommend_stop = recommend.start_refresher()
+    app.state.audit_stop = audit.start_writer()
 
+    for model in vars(schemas).values():
+        if isinstance(model, type) and issubclass(model, schemas.BaseModel) and model is not schemas.BaseModel:
+            model.model_json_schema()
+    app.openapi()
 
-# ----------------------  students  -------------------------
 
-# Fetch all students
-@app.get("/students", status_code=status.HTTP_200_OK)
-def list_students():
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.ready = False
+    await run_in_threadpool(warm_up)
+    app.state.ready = True
+    yield
+    app.state.ready = False
+    app.state.autocomplete_stop.set()
+    app.state.idempotency_stop.set()
+    app.state.retention_stop.set()
+    app.state.audit_stop.set()
+    app.state.recommend_stop.set()
+    audit.flush()
+    autocomplete.student_index.clear()
+    import recommend
+    recommend.course_model.clear()
+    partitions.forget()
+    sharding.close_pools()
+    close_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+app.state.ready = False
+app.add_middleware(timeouts.QueryControlMiddleware)
+app.add_middleware(audit.ActorMiddleware)
+
+
+@app.exception_handler(psycopg2.errors.QueryCanceled)
+async def query_canceled(request, exc):
+    """Statement timeout (504) or a query cancelled because the client went away."""
+    queries = current_queries.get()
+    cancelled = queries is not None and queries.cancelled
+    timeouts.query_stats.record(timeouts.route_label(request.scope), cancelled)
+    if cancelled:
+        return JSONResponse(status_code=499, content={"detail": "Client closed request"})
+    return JSONResponse(status_code=504, content={"detail": "Query timed out"})
+
+
+# ----------------------  health  -------------------------
+
+@app.get("/health/live", tags=["health"])
+def liveness():
+    """The process is up and serving requests."""
+    return {"status": "alive"}
+
+
+@app.get("/health/ready", tags=["health"])
+def readiness():
+    """Ready for traffic only once startup (pool and warm-up) has finished."""
+    if not app.state.ready:
+        return JSONResponse(status_code=503, content={"status": "starting"})
+    return {"status": "ready"}
+
+
+# ----------------------  helpers  -------------------------
+
+def parse_if_match(if_match: Optional[str]) -> Optional[int]:
+    """Parses an If-Match header ('3', '"3"' or 'W/"3"') into a row version."""
+    if if_match is None:
+        return None
+    value = if_match.strip()
+    if value.startswith("W/"):
+        value = value[2:]
+    try:
+        return int(value.strip('"'))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="If-Match must be a row version")
+
+
+def patch_row(table: str, key_column: str, key: int, changes: dict,
+              expected_version: Optional[int], response: Response, not_found: str):
+    """
+    Writes only the supplied columns with a single UPDATE ... RETURNING *, which also
+    returns the row as it was before (for the audit log).
+    With an expected version the update only applies if the row is unchanged (412 otherwise).
+    Sets the ETag header to the new row version.
+    """
+    params = [key]
+    if changes:
+        assignments = [sql.SQL("{} = %s").format(sql.Identifier(column)) for column in changes]
+        assignments.append(sql.SQL("version = t.version + 1"))
+        query = sql.SQL(
+            "WITH previous AS (SELECT * FROM {table} WHERE {key} = %s FOR UPDATE) "
+            "UPDATE {table} AS t SET {assignments} FROM previous WHERE t.{key} = previous.{key}").format(
+            table=sql.Identifier(table), key=sql.Identifier(key_column),
+            assignments=sql.SQL(", ").join(assignments))
+        params.extend(changes.values())
+    else:
+        # Nothing to write, just return the current row
+        query = sql.SQL("SELECT * FROM {} AS t WHERE t.{} = %s").format(
+            sql.Identifier(table), sql.Identifier(key_column))
+
+    if expected_version is not None:
+        query += sql.SQL(" AND t.version = %s")
+        params.append(expected_version)
+    if changes:
+        query += sql.SQL(" RETURNING t.*, to_jsonb(previous) AS audit_before")
+
+    with get_connection() as con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query, params)
+            row = cursor.fetchone()
+
+            if row and changes:
+                before = row.pop("audit_before")
+                record_change(cursor, table, key, "update", row)
+                audit.record(con, table, key, "update", before, row)
+
+            if not row:
+                if expected_version is not None:
+                    cursor.execute(
+                        sql.SQL("SELECT 1 FROM {} WHERE {} = %s").format(
+                            sql.Identifier(table), sql.Identifier(key_column)),
+                        (key,))
+                    if cursor.fetchone():
+                        raise HTTPException(status_code=412, detail="Version mismatch, reload and retry")
+                raise HTTPException(status_code=404, detail=not_found)
+
+    response.headers["ETag"] = f'"{row["version"]}"'
+    return row
+
+
+def list_modified(query, table: str, modified_since: datetime):
+    """
+    Incremental sync: returns the rows changed after modified_since (query takes it as its
+    only parameter), tombstones for rows deleted since then, and the watermark to use as
+    modified_since next time. The watermark is held back to the start of the oldest open
+    transaction, so rows committed late are not missed: their updated_at (the now() of that
+    transaction) can equal the watermark, hence >= in the queries. Rows at the watermark are
+    sent again on the next call; clients upsert by key. Always runs on the API database,
+    shards are replicas that do not see its open transactions (see sharding.py).
+    A watermark older than the retained tombstones gets 410 (see retention.py).
+    """
     con = get_connection()
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            query = """
-            SELECT * FROM STUDENTS;
-            """
-            cursor.execute(query)
-            result = cursor.fetchall()
+            cursor.execute("""
+                SELECT LEAST(now(), MIN(xact_start)) AS watermark
+                FROM pg_stat_activity
+                WHERE datname = current_database() AND pid <> pg_backend_pid();
+            """)
+            watermark = cursor.fetchone()["watermark"]
 
-    return result
+            cursor.execute(query, (modified_since,))
+            changed = cursor.fetchall()
+
+            cursor.execute("""
+                SELECT row_key, deleted_at FROM tombstones
+                WHERE table_name = %s AND deleted_at >= %s
+                ORDER BY deleted_at;
+            """, (table, modified_since))
+            deleted = cursor.fetchall()
+            try:
+                retention.check_watermark(con, modified_since)
+            except retention.HistoryExpired as e:
+                raise HTTPException(status_code=410, detail=str(e))
+
+    return {"changed": changed, "deleted": deleted, "watermark": watermark}
+
+
+# Rows that go with a deleted row: {table: [(dependent table, referencing columns)]}.
+# student_courses and course_prerequisites cascade in the schema; enrollments are
+# partitioned without foreign keys and would otherwise be left behind.
+DEPENDENT_ROWS = {
+    "students": [("student_courses", ["student_id"]), ("enrollments", ["student_id"])],
+    "courses": [("student_courses", ["course_id"]), ("course_prerequisites", ["course_id", "prerequisite_id"]),
+                ("enrollments", ["course_id"])],
+}
+
+
+def bulk_delete(table: str, key_column: str, conditions: list, params: list,
+                dry_run: bool, chunk_size: int):
+    """
+    Deletes all rows matching the conditions in chunks of chunk_size, one transaction per chunk,
+    so locks are only held for one chunk at a time.
+    Returns the number of matched and deleted rows, and per table the rows deleted with
+    them (DEPENDENT_ROWS). Deleted students' enrollments free their seats (enrolled_count).
+    """
+    def dependent(statement, dependent_table, columns, ids):
+        return sql.SQL(statement).format(
+            table=sql.Identifier(dependent_table),
+            where=sql.SQL(" OR ").join(sql.SQL("{} = ANY(%s)").format(sql.Identifier(column))
+                                       for column in columns)), [ids] * len(columns)
+
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute(
+                sql.SQL("SELECT {key} FROM {table} WHERE {where} ORDER BY {key};").format(
+                    key=sql.Identifier(key_column), table=sql.Identifier(table),
+                    where=sql.SQL(" AND ").join(conditions)),
+                params)
+            ids = [row[0] for row in cursor.fetchall()]
+
+            if dry_run:
+                cascaded = {}
+                for dependent_table, columns in DEPENDENT_ROWS[table]:
+                    cursor.execute(*dependent("SELECT COUNT(*) FROM {table} WHERE {where};",
+                                              dependent_table, columns, ids))
+                    cascaded[dependent_table] = cursor.fetchone()[0]
+                return {"dry_run": True, "matched": len(ids), "deleted": 0, "cascaded": cascaded}
+
+    deleted = 0
+    cascaded = {dependent_table: 0 for dependent_table, _ in DEPENDENT_ROWS[table]}
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        with get_connection() as con:
+            with con.cursor() as cursor:
+                # Same effect as ON DELETE CASCADE, but lets us count the rows
+                for dependent_table, columns in DEPENDENT_ROWS[table]:
+                    if (table, dependent_table) == ("students", "enrollments"):
+                        # The courses stay, so each removed enrollment frees a seat
+                        cursor.execute("""
+                            WITH removed AS (
+                                DELETE FROM enrollments WHERE student_id = ANY(%s) RETURNING course_id
+                            ), freed AS (
+                                UPDATE courses SET enrolled_count = enrolled_count - seats.freed
+                                FROM (SELECT course_id, COUNT(*) AS freed FROM removed GROUP BY course_id) AS seats
+                                WHERE courses.course_id = seats.course_id
+                            )
+                            SELECT COUNT(*) FROM removed;
+                        """, (chunk,))
+                        cascaded[dependent_table] += cursor.fetchone()[0]
+                        continue
+                    cursor.execute(*dependent("DELETE FROM {table} WHERE {where};", dependent_table, columns, chunk))
+                    cascaded[dependent_table] += cursor.rowcount
+                cursor.execute(
+                    sql.SQL("DELETE FROM {table} WHERE {key} = ANY(%s) RETURNING {key}, to_jsonb({table});").format(
+                        table=sql.Identifier(table), key=sql.Identifier(key_column)),
+                    (chunk,))
+                rows = cursor.fetchall()
+                removed = [row[0] for row in rows]
+                record_changes(cursor, [(table, removed_id, "delete", None) for removed_id in removed])
+                audit.record_many(con, table, "delete", [row[1] for row in rows], key_column)
+                deleted += len(removed)
+
+    return {"dry_run": False, "matched": len(ids), "deleted": deleted, "cascaded": cascaded}
+
+
+def claim_idempotency_key(con, key: Optional[str], operation: str, payload):
+    """
+    Claims an Idempotency-Key for this request (see idempotency.py). Returns the
+    stored response of an earlier request with the key, or None to go ahead.
+    """
+    if not key:
+        return None
+    try:
+        return idempotency.claim(con, key, idempotency.fingerprint(operation, payload))
+    except idempotency.KeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
+
+def has_filters(conditions, sort, limit, offset) -> bool:
+    """True when a list request uses any filter, sort or paging parameter."""
+    return (any(value is not None for _, _, value in conditions)
+            or sort is not None or limit is not None or offset != 0)
+
+
+def department_routes(department_ids, column="department_id"):
+    """
+    [(database, extra conditions)] for a list over the departments (None = all),
+    see ShardMap.routes; the argument for filtered_list.
+    """
+    return [(database, [] if condition is None else [(column, *condition)])
+            for database, condition in shard_map().routes(department_ids)]
+
+
+def department_statements(query, params=None):
+    """
+    [(database, query, params)] for sharding.fetch_each, for a query over all
+    departments. On the API database it must skip the departments the shards
+    hold, given as %(skip)s (NULL on the shards):
+    (%(skip)s::int[] IS NULL OR department_id <> ALL(%(skip)s))
+    """
+    return [(database, query, {**(params or {}), "skip": condition[1] if condition else None})
+            for database, condition in shard_map().routes(None)]
+
+
+def filtered_list(base, conditions, sortable: dict, key: str,
+                  sort: Optional[str], limit: Optional[int], offset: int,
+                  request: Request, response: Response, routes=((None, ()),), text_columns=()):
+    """
+    Runs a filtered, sorted and limited list query (see filters.py) on every
+    database of routes (see department_routes), each with its extra conditions.
+    With several each returns its first offset + limit rows and the pages are merged;
+    the sortable text_columns are then sorted in code point order ("B" before "a").
+    One row more than the page is read: when there is one, the response gets a
+    Link header (rel="next") with the offset of the next page, unless that is
+    beyond MAX_OFFSET (narrow the filters instead).
+    """
+    statements = []
+    bytewise = text_columns if len(routes) > 1 else ()
+    try:
+        for database, extra in routes:
+            query, params = build_list_query(sql.SQL(base), [*conditions, *extra], sortable, key,
+                                             sort, limit, offset, bytewise)
+            statements.append((database, query, params))
+    except FilterError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limit, offset = params[-2:]
+    if len(statements) == 1:
+        params[-2] = limit + 1
+        rows = sharding.fetch_each(statements)
+    else:
+        for _, _, params in statements:
+            params[-2:] = [offset + limit + 1, 0]
+        rows = sort_rows(sharding.fetch_each(statements), sort, sortable, key)[offset:]
+
+    if len(rows) > limit and offset + limit <= MAX_OFFSET:
+        next_page = request.url.include_query_params(offset=offset + limit)
+        response.headers["Link"] = f'<{next_page.path}?{next_page.query}>; rel="next"'
+    return rows[:limit]
+
+
+# ----------------------  students  -------------------------
+
+# Fetch all students
+@app.get("/students", status_code=status.HTTP_200_OK)
+def list_students(request: Request, response: Response,
+                  modified_since: Optional[datetime] = None,
+                  student_id: Optional[List[int]] = Query(None),
+                  email: Optional[str] = None,
+                  last_name: Optional[str] = None,
+                  enrollment_date_from: Optional[date] = None,
+                  enrollment_date_to: Optional[date] = None,
+                  sort: Optional[str] = None,
+                  limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT),
+                  offset: int = Query(0, ge=0, le=MAX_OFFSET)):
+    """
+    Fetch students, one page at a time (limit, default 100; a Link header points to the next page).
+    With modified_since only changed students and deletions are returned (incremental sync).
+    Filters, sort (e.g. sort=-enrollment_date,last_name) and limit/offset return one page.
+    Example usage: /students?enrollment_date_from=2024-01-01&sort=last_name&limit=50
+    """
+    conditions = [
+        ("student_id", "in", student_id),
+        ("email", "=", email),
+        ("last_name", "=", last_name),
+        ("enrollment_date", ">=", enrollment_date_from),
+        ("enrollment_date", "<=", enrollment_date_to),
+    ]
+    if modified_since is not None:
+        if has_filters(conditions, sort, limit, offset):
+            raise HTTPException(status_code=400, detail="modified_since cannot be combined with filters")
+        return list_modified(
+            "SELECT * FROM students WHERE updated_at >= %s ORDER BY updated_at;",
+            "students", modified_since)
+
+    # Unfiltered requests get the first DEFAULT_LIMIT rows too, see filtered_list
+    return filtered_list(
+        "SELECT * FROM students", conditions,
+        {"student_id": "student_id", "first_name": "first_name",
+         "last_name": "last_name", "enrollment_date": "enrollment_date"},
+        "student_id", sort, limit, offset, request, response)
 
 # Search a student by using query parameter
 @app.get("/students/filter", status_code=status.HTTP_200_OK)
@@ -59,6 +447,36 @@ def search_students(name: str = Query(..., min_length=1)):
 
 
 
+# Typeahead for the student picker
+@app.get("/students/autocomplete", status_code=status.HTTP_200_OK)
+def autocomplete_students(q: str = Query(..., min_length=1, max_length=autocomplete.MAX_TERM_LENGTH),
+                          limit: int = Query(10, ge=1, le=autocomplete.MAX_RESULTS)):
+    """
+    Students whose "first last" name, last name or email starts with q, served
+    from the in-memory prefix index, or from the database when it is not built
+    or too large (AUTOCOMPLETE_MAX_TERMS).
+    Example usage: /students/autocomplete?q=jes
+    """
+    if autocomplete.student_index.ready:
+        return autocomplete.student_index.search(q, limit)
+
+    # Matched here with the index's casefold(): lower() in PostgreSQL only folds ASCII
+    # under the C collation, and never "ß" to "ss"
+    prefix = autocomplete.normalize(q)
+    results = []
+    con = get_connection()
+    with con:
+        with con.cursor(name="autocomplete_students", cursor_factory=RealDictCursor) as cursor:
+            cursor.itersize = 2_000
+            cursor.execute("SELECT student_id, first_name, last_name, email FROM students ORDER BY student_id;")
+            for row in cursor:
+                if autocomplete.matches(prefix, row["first_name"], row["last_name"], row["email"]):
+                    results.append(row)
+                    if len(results) == limit:
+                        break
+    return results
+
+
 # Fetch a specific student by ID
 @app.get("/students/{student_id}")
 def get_student(student_id: int):
@@ -81,10 +499,12 @@ def delete_student(student_id: int):
     con = get_connection()
     with con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("DELETE FROM students WHERE student_id = %s RETURNING student_id;", (student_id,))
+            cursor.execute("DELETE FROM students WHERE student_id = %s RETURNING *;", (student_id,))
             deleted = cursor.fetchone()
             if not deleted:
                 raise HTTPException(status_code=404, detail="Student not found")
+            record_change(cursor, "students", student_id, "delete")
+            audit.record(con, "students", student_id, "delete", before=deleted)
     return {"message": f"Student with ID {student_id} deleted successfully."}
 
 
@@ -92,54 +512,90 @@ def delete_student(student_id: int):
 @app.delete("/students/")
 def delete_student_by_name(first_name: str, last_name: str):
     """
-    Deletes a student by their first and last name.
+    Deletes every student with the given first and last name.
+    deleted_student is the first of them, deleted_students lists all.
     """
     with get_connection() as con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             cursor.execute("""
                 DELETE FROM students 
                 WHERE first_name = %s AND last_name = %s 
-                RETURNING student_id, first_name, last_name;
+                RETURNING *;
             """, (first_name, last_name))
             
-            deleted = cursor.fetchone()
+            deleted = cursor.fetchall()
             
             if not deleted:
                 raise HTTPException(status_code=404, detail="Student not found")
+            record_changes(cursor, [("students", row["student_id"], "delete", None) for row in deleted])
+            audit.record_many(con, "students", "delete", deleted, "student_id")
     
-    return {"message": f"Student '{first_name} {last_name}' deleted successfully.", "deleted_student": deleted}
+    deleted_students = [{column: row[column] for column in ("student_id", "first_name", "last_name")}
+                        for row in deleted]
+    return {"message": f"Student '{first_name} {last_name}' deleted successfully.",
+            "deleted_student": deleted_students[0], "deleted_students": deleted_students}
+
+
+# Delete many students by ids and/or enrollment date
+@app.post("/students/bulk-delete")
+def bulk_delete_students(request: StudentBulkDelete):
+    """
+    Deletes all students matching the given ids and/or enrolled before a date.
+    Runs in chunked transactions. With dry_run only the affected counts are returned.
+    """
+    conditions, params = [], []
+    if request.student_ids is not None:
+        conditions.append(sql.SQL("student_id = ANY(%s)"))
+        params.append(request.student_ids)
+    if request.enrolled_before is not None:
+        conditions.append(sql.SQL("enrollment_date < %s"))
+        params.append(request.enrolled_before)
+    if not conditions:
+        raise HTTPException(status_code=400, detail="Provide student_ids or enrolled_before")
+
+    return bulk_delete("students", "student_id", conditions, params,
+                       request.dry_run, request.chunk_size)
 
 
 # Create a student
 @app.post("/students")
-def create_student(student_input: StudentCreate):
+def create_student(student_input: StudentCreate, idempotency_key: Optional[str] = Header(None)):
     """
     Create a new student in the 'students' table.
     Returns the newly created student object with its ID.
+    Retries with the same Idempotency-Key return the first response.
     """
     with get_connection() as con:
+        previous = claim_idempotency_key(con, idempotency_key, "POST /students", student_input.model_dump())
+        if previous is not None:
+            return previous
+
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             try:
                 cursor.execute(
                     """
                     INSERT INTO students (first_name, last_name, email, enrollment_date)
                     VALUES (%s, %s, %s, %s)
-                    RETURNING student_id;
+                    RETURNING *;
                     """,
                     (student_input.first_name, student_input.last_name, 
                      student_input.email, student_input.enrollment_date)
                 )
                 inserted = cursor.fetchone()
+                record_change(cursor, "students", inserted["student_id"], "create", inserted)
+                audit.record(con, "students", inserted["student_id"], "create", after=inserted)
             except psycopg2.errors.UniqueViolation:
                 raise HTTPException(status_code=400, detail="Student already exists.")
-
-    return {
-        "id": inserted["student_id"],
-        "first_name": student_input.first_name,
-        "last_name": student_input.last_name,
-        "email": student_input.email,
-        "enrollment_date": student_input.enrollment_date
-    }
+        result = {
+            "id": inserted["student_id"],
+            "first_name": student_input.first_name,
+            "last_name": student_input.last_name,
+            "email": student_input.email,
+            "enrollment_date": student_input.enrollment_date
+        }
+        if idempotency_key:
+            return idempotency.store(con, idempotency_key, result)
+    return result
 
 
 # Update a student
@@ -152,16 +608,21 @@ def update_student(student_id: int, student_update: StudentUpdate):
     with get_connection() as con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             try:
-                cursor.execute("""UPDATE students SET first_name = %s, last_name = %s, 
-                                  email = %s, enrollment_date = %s 
-                                  WHERE student_id = %s RETURNING *;""", 
-                               (student_update.first_name, student_update.last_name, 
-                                student_update.email, student_update.enrollment_date, student_id))
+                cursor.execute("""WITH previous AS (SELECT * FROM students WHERE student_id = %s FOR UPDATE)
+                                  UPDATE students AS s SET first_name = %s, last_name = %s, 
+                                  email = %s, enrollment_date = %s, version = s.version + 1
+                                  FROM previous WHERE s.student_id = previous.student_id
+                                  RETURNING s.*, to_jsonb(previous) AS audit_before;""", 
+                               (student_id, student_update.first_name, student_update.last_name, 
+                                student_update.email, student_update.enrollment_date))
                 
                 updated_student = cursor.fetchone()
                 
                 if not updated_student:
                     raise HTTPException(status_code=404, detail="Student not found")
+                before = updated_student.pop("audit_before")
+                record_change(cursor, "students", student_id, "update", updated_student)
+                audit.record(con, "students", student_id, "update", before, updated_student)
             except psycopg2.errors.ForeignKeyViolation:
                 raise HTTPException(status_code=400, detail="Provided enrollment_date not valid")
             except psycopg2.errors.UniqueViolation:
@@ -170,6 +631,22 @@ def update_student(student_id: int, student_update: StudentUpdate):
     return updated_student
 
 
+# Partially update a student
+@app.patch("/students/{student_id}")
+def patch_student(student_id: int, student_patch: StudentPatch, response: Response,
+                  if_match: Optional[str] = Header(None)):
+    """
+    Updates only the supplied fields of a student.
+    Send If-Match with the row version (ETag) to avoid overwriting concurrent changes.
+    """
+    try:
+        return patch_row("students", "student_id", student_id,
+                         student_patch.model_dump(exclude_unset=True),
+                         parse_if_match(if_match), response, "Student not found")
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=400, detail="Email already exists")
+
+
 # Avrerage grade for a student
 @app.get("/students/{student_id}/average-grade", response_model=AverageGradeResponse)
 def get_average_grade(student_id: int):
@@ -178,12 +655,14 @@ def get_average_grade(student_id: int):
     """
     with get_connection() as con:
         with con.cursor() as cursor:
+            # Maintained incrementally by triggers on student_courses
             cursor.execute("""
-                SELECT AVG(grade) 
-                FROM student_courses 
+                SELECT grade_sum / NULLIF(grade_count, 0)
+                FROM student_grade_stats
                 WHERE student_id = %s;
             """, (student_id,))
-            avg_grade = cursor.fetchone()[0]
+            row = cursor.fetchone()
+            avg_grade = row[0] if row else None
 
             if avg_grade is None:
                 raise HTTPException(status_code=404, detail="Not found grade for this student")
@@ -197,27 +676,49 @@ def get_average_grade(student_id: int):
 
 # Fetch all courses
 @app.get("/courses",status_code=status.HTTP_200_OK)
-def list_course():
-    """Fetch all courses from the database."""
-    con = get_connection()
-    with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM courses;")
-            result = cursor.fetchall()
-    return result
+def list_course(request: Request, response: Response,
+                modified_since: Optional[datetime] = None,
+                course_id: Optional[List[int]] = Query(None),
+                department_id: Optional[List[int]] = Query(None),
+                credits_min: Optional[int] = None,
+                credits_max: Optional[int] = None,
+                sort: Optional[str] = None,
+                limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT),
+                offset: int = Query(0, ge=0, le=MAX_OFFSET)):
+    """
+    Fetch courses, one page at a time (limit, default 100; a Link header points to the next page).
+    With modified_since only changed courses and deletions are returned (incremental sync).
+    Filters, sort and limit/offset return one page.
+    Example usage: /courses?department_id=1&department_id=2&credits_min=5&sort=-credits
+    """
+    conditions = [
+        ("course_id", "in", course_id),
+        ("department_id", "in", department_id),
+        ("credits", ">=", credits_min),
+        ("credits", "<=", credits_max),
+    ]
+    if modified_since is not None:
+        if has_filters(conditions, sort, limit, offset):
+            raise HTTPException(status_code=400, detail="modified_since cannot be combined with filters")
+        return list_modified(
+            "SELECT * FROM courses WHERE updated_at >= %s ORDER BY updated_at;",
+            "courses", modified_since)
+
+    # Unfiltered requests get the first DEFAULT_LIMIT rows too, see filtered_list
+    return filtered_list(
+        "SELECT * FROM courses", conditions,
+        {"course_id": "course_id", "name": "name", "credits": "credits",
+         "department_id": "department_id"},
+        "course_id", sort, limit, offset, request, response, department_routes(department_id), ("name",))
 
 
 
 # Fetch all courses from a specific department
 @app.get("/departments/{department_id}/courses")
 def list_courses_by_department(department_id: int):
-    """Fetch all courses for a specific department."""
-    con = get_connection()
-    with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM courses WHERE department_id = %s;", (department_id,))
-            results = cursor.fetchall()
-    return results
+    """Fetch all courses for a specific department (from the department's shard, or the API database)."""
+    return sharding.fetch_all([shard_map().database_for(department_id)],
+                              "SELECT * FROM courses WHERE department_id = %s;", (department_id,))
 
 
 # Delete a course by ID
@@ -228,43 +729,76 @@ def delete_course(course_id: int):
     """
     with get_connection() as con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("DELETE FROM courses WHERE course_id = %s RETURNING course_id;", (course_id,))
+            cursor.execute("DELETE FROM courses WHERE course_id = %s RETURNING *;", (course_id,))
             deleted = cursor.fetchone()
             if not deleted:
                 raise HTTPException(status_code=404, detail="Course not found")
+            record_change(cursor, "courses", course_id, "delete")
+            audit.record(con, "courses", course_id, "delete", before=deleted)
     return {"message": f"Course with ID {course_id} deleted successfully."}
 
 
 
+# Delete many courses by ids and/or department
+@app.post("/courses/bulk-delete")
+def bulk_delete_courses(request: CourseBulkDelete):
+    """
+    Deletes all courses matching the given ids and/or department.
+    Runs in chunked transactions. With dry_run only the affected counts are returned.
+    """
+    conditions, params = [], []
+    if request.course_ids is not None:
+        conditions.append(sql.SQL("course_id = ANY(%s)"))
+        params.append(request.course_ids)
+    if request.department_id is not None:
+        conditions.append(sql.SQL("department_id = %s"))
+        params.append(request.department_id)
+    if not conditions:
+        raise HTTPException(status_code=400, detail="Provide course_ids or department_id")
+
+    return bulk_delete("courses", "course_id", conditions, params,
+                       request.dry_run, request.chunk_size)
+
+
 # Create a course
 @app.post("/courses")
-def create_course(course_input: CourseCreate):
+def create_course(course_input: CourseCreate, idempotency_key: Optional[str] = Header(None)):
     """
     Create a new course in the 'courses' table.
     Returns the newly created course object with its ID.
+    Retries with the same Idempotency-Key return the first response.
     """
     with get_connection() as con:
+        previous = claim_idempotency_key(con, idempotency_key, "POST /courses", course_input.model_dump())
+        if previous is not None:
+            return previous
+
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             try:
                 cursor.execute(
                     """
-                    INSERT INTO courses (name, credits, department_id)
-                    VALUES (%s, %s, %s)
-                    RETURNING course_id;
+                    INSERT INTO courses (name, credits, department_id, capacity)
+                    VALUES (%s, %s, %s, %s)
+                    RETURNING *;
                     """,
                     (course_input.name, course_input.credits, 
-                     course_input.department_id)
+                     course_input.department_id, course_input.capacity)
                 )
                 inserted = cursor.fetchone()
+                record_change(cursor, "courses", inserted["course_id"], "create", inserted)
+                audit.record(con, "courses", inserted["course_id"], "create", after=inserted)
             except psycopg2.errors.UniqueViolation:
                 raise HTTPException(status_code=400, detail="Course already exists.")
-
-    return {
-        "id": inserted["course_id"],
-        "name": course_input.name,
-        "credits": course_input.credits,
-        "department_id": course_input.department_id,
-    }
+        result = {
+            "id": inserted["course_id"],
+            "name": course_input.name,
+            "credits": course_input.credits,
+            "department_id": course_input.department_id,
+            "capacity": course_input.capacity,
+        }
+        if idempotency_key:
+            return idempotency.store(con, idempotency_key, result)
+    return result
 
 
 # Update a course
@@ -277,15 +811,21 @@ def update_course(course_id: int, course_update: CourseUpdate):
     with get_connection() as con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             try:
-                cursor.execute("""UPDATE courses SET name = %s, credits = %s, 
-                                  department_id = %s WHERE course_id = %s RETURNING *;""", 
-                               (course_update.name, course_update.credits, 
-                                course_update.department_id, course_id))
+                cursor.execute("""WITH previous AS (SELECT * FROM courses WHERE course_id = %s FOR UPDATE)
+                                  UPDATE courses AS c SET name = %s, credits = %s, 
+                                  department_id = %s, version = c.version + 1
+                                  FROM previous WHERE c.course_id = previous.course_id
+                                  RETURNING c.*, to_jsonb(previous) AS audit_before;""", 
+                               (course_id, course_update.name, course_update.credits, 
+                                course_update.department_id))
                 
                 updated_course = cursor.fetchone()
                 
                 if not updated_course:
                     raise HTTPException(status_code=404, detail="Course not found")
+                before = updated_course.pop("audit_before")
+                record_change(cursor, "courses", course_id, "update", updated_course)
+                audit.record(con, "courses", course_id, "update", before, updated_course)
             except psycopg2.errors.ForeignKeyViolation:
                 raise HTTPException(status_code=400, detail="Provided department_id not valid")
             except psycopg2.errors.UniqueViolation:
@@ -294,19 +834,57 @@ def update_course(course_id: int, course_update: CourseUpdate):
     return updated_course
 
 
+# Partially update a course
+@app.patch("/courses/{course_id}")
+def patch_course(course_id: int, course_patch: CoursePatch, response: Response,
+                 if_match: Optional[str] = Header(None)):
+    """
+    Updates only the supplied fields of a course.
+    Send If-Match with the row version (ETag) to avoid overwriting concurrent changes.
+    """
+    try:
+        return patch_row("courses", "course_id", course_id,
+                         course_patch.model_dump(exclude_unset=True),
+                         parse_if_match(if_match), response, "Course not found")
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=400, detail="Course name already exists")
+
+
 
 # ----------------------- Instructors  ---------------------------
 
 # Fetch all instructors
 @app.get("/instructors", status_code=status.HTTP_200_OK)
-def list_instructors():
-    """Fetch all instructors from the database."""
-    con = get_connection()
-    with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM instructors;")
-            result = cursor.fetchall()
-    return result
+def list_instructors(request: Request, response: Response,
+                     modified_since: Optional[datetime] = None,
+                     department_id: Optional[List[int]] = Query(None),
+                     last_name: Optional[str] = None,
+                     sort: Optional[str] = None,
+                     limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT),
+                     offset: int = Query(0, ge=0, le=MAX_OFFSET)):
+    """
+    Fetch instructors, one page at a time (limit, default 100; a Link header points to the next page).
+    With modified_since only changed instructors and deletions are returned (incremental sync).
+    Filters, sort and limit/offset return one page.
+    """
+    conditions = [
+        ("department_id", "in", department_id),
+        ("last_name", "=", last_name),
+    ]
+    if modified_since is not None:
+        if has_filters(conditions, sort, limit, offset):
+            raise HTTPException(status_code=400, detail="modified_since cannot be combined with filters")
+        return list_modified(
+            "SELECT * FROM instructors WHERE updated_at >= %s ORDER BY updated_at;",
+            "instructors", modified_since)
+
+    # Unfiltered requests get the first DEFAULT_LIMIT rows too, see filtered_list
+    return filtered_list(
+        "SELECT * FROM instructors", conditions,
+        {"instructor_id": "instructor_id", "last_name": "last_name",
+         "department_id": "department_id"},
+        "instructor_id", sort, limit, offset, request, response, department_routes(department_id),
+        ("last_name",))
 
 @app.get("/instructors/{instructor_id}")
 def get_instructor(instructor_id: int):
@@ -323,35 +901,44 @@ def get_instructor(instructor_id: int):
 
 # Create an instructor
 @app.post("/instructors")
-def create_instructor(instructor_input: InstructorCreate):
+def create_instructor(instructor_input: InstructorCreate, idempotency_key: Optional[str] = Header(None)):
     """
     Create a new instructor in the 'instructors' table.
     Returns the newly created instructor object with its ID.
+    Retries with the same Idempotency-Key return the first response.
     """
     with get_connection() as con:
+        previous = claim_idempotency_key(con, idempotency_key, "POST /instructors", instructor_input.model_dump())
+        if previous is not None:
+            return previous
+
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             try:
                 cursor.execute(
                     """
                     INSERT INTO instructors (first_name, last_name, email, department_id)
                     VALUES (%s, %s, %s, %s)
-                    RETURNING instructor_id;
+                    RETURNING *;
                     """,
                     (instructor_input.first_name, instructor_input.last_name, 
                      instructor_input.email, instructor_input.department_id
                 ))
                 inserted = cursor.fetchone()
+                record_change(cursor, "instructors", inserted["instructor_id"], "create", inserted)
+                audit.record(con, "instructors", inserted["instructor_id"], "create", after=inserted)
             except psycopg2.errors.UniqueViolation as e:
                 print(f"❌ UNIQUE CONSTRAINT ERROR: {e}")
                 raise HTTPException(status_code=400, detail="Instructor already exists.")
-
-    return {
-        "id": inserted["instructor_id"],
-        "first_name": instructor_input.first_name,
-        "last_name": instructor_input.last_name,
-        "email": instructor_input.email,
-        "department_id": instructor_input.department_id,
-    }
+        result = {
+            "id": inserted["instructor_id"],
+            "first_name": instructor_input.first_name,
+            "last_name": instructor_input.last_name,
+            "email": instructor_input.email,
+            "department_id": instructor_input.department_id,
+        }
+        if idempotency_key:
+            return idempotency.store(con, idempotency_key, result)
+    return result
 
 
 # Update instructor
@@ -364,15 +951,21 @@ def update_instructor(instructor_id: int, instructor_update: InstructorUpdate):
     with get_connection() as con:
         with con.cursor(cursor_factory=RealDictCursor) as cursor:
             try:
-                cursor.execute("""UPDATE instructors SET first_name = %s, last_name = %s, 
-                                  email = %s, department_id = %s WHERE instructor_id = %s RETURNING *;""", 
-                               (instructor_update.first_name, instructor_update.last_name, 
-                                instructor_update.email, instructor_update.department_id, instructor_id))
+                cursor.execute("""WITH previous AS (SELECT * FROM instructors WHERE instructor_id = %s FOR UPDATE)
+                                  UPDATE instructors AS i SET first_name = %s, last_name = %s, 
+                                  email = %s, department_id = %s, version = i.version + 1
+                                  FROM previous WHERE i.instructor_id = previous.instructor_id
+                                  RETURNING i.*, to_jsonb(previous) AS audit_before;""", 
+                               (instructor_id, instructor_update.first_name, instructor_update.last_name, 
+                                instructor_update.email, instructor_update.department_id))
                 
                 updated_instructor = cursor.fetchone()
                 
                 if not updated_instructor:
                     raise HTTPException(status_code=404, detail="Instructor not found")
+                before = updated_instructor.pop("audit_before")
+                record_change(cursor, "instructors", instructor_id, "update", updated_instructor)
+                audit.record(con, "instructors", instructor_id, "update", before, updated_instructor)
             except psycopg2.errors.ForeignKeyViolation:
                 raise HTTPException(status_code=400, detail="Provided department_id not valid")
             except psycopg2.errors.UniqueViolation:
@@ -382,68 +975,642 @@ def update_instructor(instructor_id: int, instructor_update: InstructorUpdate):
 
 
 
-#PATCH endpoints (funkar inte som det ska =( jag har även GPT-at men hittar inte felet!)
-            # OCH JAG HAR STRÄVAT EFTER VG DEN GÅNGEN!!!
-@app.patch("/instructors/", response_model=InstructorPatch)
-def instructor_patch(instructor_id: int, instructors: InstructorPatch):
+# Partially update an instructor
+@app.patch("/instructors/{instructor_id}")
+def patch_instructor(instructor_id: int, instructor_patch: InstructorPatch, response: Response,
+                     if_match: Optional[str] = Header(None)):
+    """
+    Updates only the supplied fields of an instructor.
+    Send If-Match with the row version (ETag) to avoid overwriting concurrent changes.
+    """
+    try:
+        return patch_row("instructors", "instructor_id", instructor_id,
+                         instructor_patch.model_dump(exclude_unset=True),
+                         parse_if_match(if_match), response, "Instructor not found")
+    except psycopg2.errors.UniqueViolation:
+        raise HTTPException(status_code=400, detail="Email already exists")
+
+
+# Old PATCH path with the id as query parameter, kept for existing clients
+@app.patch("/instructors/", response_model=InstructorPatch, deprecated=True)
+def instructor_patch(instructor_id: int, instructors: InstructorPatch, response: Response):
     """
     Partially updates an instructor's data.
-    Returns the updated instructor object.
+    Use PATCH /instructors/{instructor_id} instead.
     """
-    con = get_connection()
-  
-    with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            cursor.execute("SELECT * FROM Instructors WHERE instructor_id = %s", (instructor_id,))
-            instructor = cursor.fetchone()
-            if not instructor:
-                raise HTTPException(status_code=404, detail="Instructor not found")
-            
-            email = instructors.email if instructors.email is not None else instructor["email"]
-            department_id = instructors.department_id if instructors.department_id is not None else instructor["department_id"]
-
-            update_query = """
-                UPDATE Instructors
-                SET email = %s, department_id = %s
-                WHERE instructor_id = %s
-                returning *;
-            """
-            cursor.execute(update_query, (email,department_id, instructor_id))
-            updated_instructor = cursor.fetchone()
+    return patch_instructor(instructor_id, instructors, response, if_match=None)
 
-           
-            if not updated_instructor:
-                raise HTTPException(status_code=400, detail="Instructor update failed")
-    return updated_instructor
 
-  
 
 @app.get("/departments", status_code=status.HTTP_200_OK, tags= ["list_endpoints"])
-def list_departments():
-    con = get_connection()
-    with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            department_query = """select * from departments;"""
-            cursor.execute(department_query)
-            result = cursor.fetchall()
+def list_departments(modified_since: Optional[datetime] = None):
+    if modified_since is not None:
+        return list_modified(
+            "SELECT * FROM departments WHERE updated_at >= %s ORDER BY updated_at;",
+            "departments", modified_since)
 
-    return result
+    return sharding.fetch_each(department_statements("""
+        SELECT * FROM departments
+        WHERE (%(skip)s::int[] IS NULL OR department_id <> ALL(%(skip)s));
+    """))
 
 @app.get("/enrollments", status_code=status.HTTP_200_OK, tags= ["list_endpoints"])
-def list_enrollments():
-    con = get_connection()
-    with con:
-        with con.cursor(cursor_factory=RealDictCursor) as cursor:
-            enrollment_query = """SELECT 
+def list_enrollments(request: Request, response: Response,
+                     modified_since: Optional[datetime] = None,
+                     student_id: Optional[List[int]] = Query(None),
+                     course_id: Optional[List[int]] = Query(None),
+                     grade: Optional[List[str]] = Query(None),
+                     enrollment_date_from: Optional[date] = None,
+                     enrollment_date_to: Optional[date] = None,
+                     sort: Optional[str] = None,
+                     limit: Optional[int] = Query(None, ge=1, le=MAX_LIMIT),
+                     offset: int = Query(0, ge=0, le=MAX_OFFSET)):
+    """
+    Fetch enrollments with student and course names, one page at a time (see list_students).
+    Filters (grade=A&grade=B, date range, ids), sort and limit/offset return one page.
+    """
+    conditions = [
+        ("enrollments.student_id", "in", student_id),
+        ("enrollments.course_id", "in", course_id),
+        ("enrollments.grade", "in", grade),
+        ("enrollments.enrollment_date", ">=", enrollment_date_from),
+        ("enrollments.enrollment_date", "<=", enrollment_date_to),
+    ]
+    if modified_since is not None:
+        if has_filters(conditions, sort, limit, offset):
+            raise HTTPException(status_code=400, detail="modified_since cannot be combined with filters")
+        return list_modified(
+            """SELECT 
             enrollments.enrollment_id,
             students.first_name || ' ' || students.last_name AS student_name,
             courses.name AS course_name,
             enrollments.enrollment_date,
-            enrollments.grade
+            enrollments.grade,
+            enrollments.updated_at
             FROM enrollments
             JOIN students ON enrollments.student_id = students.student_id
-            JOIN courses ON enrollments.course_id = courses.course_id;"""
-            cursor.execute(enrollment_query)
-            result = cursor.fetchall()
+            JOIN courses ON enrollments.course_id = courses.course_id
+            WHERE enrollments.updated_at >= %s
+            ORDER BY enrollments.updated_at;""",
+            "enrollments", modified_since)
+
+    # Unfiltered requests get the first DEFAULT_LIMIT rows too, see filtered_list
+    return filtered_list(
+        """SELECT
+        enrollments.enrollment_id,
+        students.first_name || ' ' || students.last_name AS student_name,
+        courses.name AS course_name,
+        enrollments.enrollment_date,
+        enrollments.grade
+        FROM enrollments
+        JOIN students ON enrollments.student_id = students.student_id
+        JOIN courses ON enrollments.course_id = courses.course_id""", conditions,
+        {"enrollment_id": "enrollments.enrollment_id",
+         "enrollment_date": "enrollments.enrollment_date",
+         "grade": "enrollments.grade"},
+        "enrollments.enrollment_id", sort, limit, offset, request, response)
+
+
+# ----------------------- Catalogue  ---------------------------
+
+def parse_if_none_match(if_none_match: Optional[str]) -> List[str]:
+    """Parses an If-None-Match header into bare entity tags ('*' matches everything)."""
+    if not if_none_match:
+        return []
+    tags = []
+    for value in if_none_match.split(","):
+        value = value.strip()
+        if value.startswith("W/"):
+            value = value[2:]
+        tags.append(value.strip('"'))
+    return tags
+
+
+# Departments with their courses and instructors
+@app.get("/catalogue", status_code=status.HTTP_200_OK)
+def get_catalogue(if_none_match: Optional[str] = Header(None)):
+    """
+    Returns every department with its courses and instructors nested, built by
+    Postgres in one statement (per shard). The ETag is the catalogue's data_versions
+    counter, which every transaction changing a department, course or instructor
+    bumps when it commits; a matching If-None-Match gets 304 without building the body.
+    """
+    tags = parse_if_none_match(if_none_match)
+    statements = department_statements("")
+    # Shard tags never match the combined tag a client holds, so shards always build
+    query_tags = tags if len(statements) == 1 else []
+
+    def build(skip):
+        def run(con):
+            with con.cursor() as cursor:
+                # The CASE skips the aggregation entirely when the client's copy is current.
+                # The database oid tells a recreated database (counter from the start) apart.
+                cursor.execute("""
+                    WITH stamp AS (
+                        SELECT md5(concat_ws('|',
+                            (SELECT oid FROM pg_database WHERE datname = current_database()),
+                            version, %(skip)s::text
+                        )) AS etag
+                        FROM data_versions WHERE name = 'catalogue'
+                    )
+                    SELECT etag,
+                        CASE WHEN etag = ANY(%(tags)s) THEN NULL ELSE (
+                            SELECT coalesce(json_agg(json_build_object(
+                                'department_id', d.department_id,
+                                'name', d.name,
+                                'location', d.location,
+                                'courses', coalesce(c.courses, '[]'),
+                                'instructors', coalesce(i.instructors, '[]')
+                            ) ORDER BY d.department_id), '[]')::text
+                            FROM departments d
+                            LEFT JOIN (
+                                SELECT department_id, json_agg(json_build_object(
+                                    'course_id', course_id,
+                                    'name', name,
+                                    'credits', credits,
+                                    'capacity', capacity,
+                                    'enrolled_count', enrolled_count
+                                ) ORDER BY course_id) AS courses
+                                FROM courses GROUP BY department_id
+                            ) c ON c.department_id = d.department_id
+                            LEFT JOIN (
+                                SELECT department_id, json_agg(json_build_object(
+                                    'instructor_id', instructor_id,
+                                    'first_name', first_name,
+                                    'last_name', last_name,
+                                    'email', email
+                                ) ORDER BY instructor_id) AS instructors
+                                FROM instructors GROUP BY department_id
+                            ) i ON i.department_id = d.department_id
+                            WHERE %(skip)s::int[] IS NULL OR d.department_id <> ALL(%(skip)s)
+                        ) END AS catalogue
+                    FROM stamp;
+                """, {"tags": query_tags, "skip": skip})
+                return cursor.fetchone()
+        return run
+
+    results = sharding.run_each([(database, build(params["skip"])) for database, _, params in statements])
+    if len(results) == 1:
+        etag, catalogue = results[0]
+    else:
+        etag = hashlib.md5("|".join(tag for tag, _ in results).encode()).hexdigest()
+        parts = [body[1:-1] for _, body in results if body != "[]"]
+        catalogue = "[" + ",".join(parts) + "]"
+
+    headers = {"ETag": f'"{etag}"', "Cache-Control": "public, no-cache"}
+    if catalogue is None or etag in tags or "*" in tags:
+        return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=headers)
+    # Already JSON text, built by Postgres; no need to decode and re-encode it here
+    return Response(content=catalogue, media_type="application/json", headers=headers)
+
+
+# ----------------------- Enrollments  ---------------------------
+
+# Enroll a student in a course
+@app.post("/courses/{course_id}/enrollments")
+def enroll_student(course_id: int, enrollment: EnrollmentCreate,
+                   idempotency_key: Optional[str] = Header(None)):
+    """
+    Registers a student for a course, if the course has a free seat.
+    Taking the seat is one conditional UPDATE of the course's seat counter, which only
+    locks that course row, so concurrent registrations cannot overbook it.
+    Retries with the same Idempotency-Key return the first response.
+    """
+    enrollment_date, = partitions.ensure_enrollment_partitions([enrollment.enrollment_date])
+    with get_connection() as con:
+        previous = claim_idempotency_key(con, idempotency_key, f"POST /courses/{course_id}/enrollments",
+                                         enrollment.model_dump())
+        if previous is not None:
+            return previous
+
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("""
+                UPDATE courses SET enrolled_count = enrolled_count + 1
+                WHERE course_id = %s AND (capacity IS NULL OR enrolled_count < capacity)
+                RETURNING course_id;
+            """, (course_id,))
+            if not cursor.fetchone():
+                cursor.execute("SELECT 1 FROM courses WHERE course_id = %s;", (course_id,))
+                if not cursor.fetchone():
+                    raise HTTPException(status_code=404, detail="Course not found")
+                raise HTTPException(status_code=409, detail="Course is full")
+
+            # Registrations for this course are serialized by the row lock above,
+            # so the NOT EXISTS check cannot race with another registration. The unique
+            # index of an unpartitioned enrollments table still catches rows written
+            # around the API (see setup.create_tables).
+            try:
+                cursor.execute("""
+                    INSERT INTO enrollments (student_id, course_id, enrollment_date)
+                    SELECT student_id, %s, %s FROM students
+                    WHERE student_id = %s
+                      AND NOT EXISTS (SELECT 1 FROM enrollments
+                                      WHERE student_id = %s AND course_id = %s)
+                    RETURNING *;
+                """, (course_id, enrollment_date, enrollment.student_id,
+                      enrollment.student_id, course_id))
+                inserted = cursor.fetchone()
+            except psycopg2.errors.UniqueViolation:
+                raise HTTPException(status_code=409, detail="Student already enrolled")
+
+            if not inserted:
+                cursor.execute("SELECT 1 FROM students WHERE student_id = %s;", (enrollment.student_id,))
+                if not cursor.fetchone():
+                    raise HTTPException(status_code=404, detail="Student not found")
+                raise HTTPException(status_code=409, detail="Student already enrolled")
+
+        if idempotency_key:
+            return idempotency.store(con, idempotency_key, inserted)
+    return inserted
+
+
+# Enroll a whole cohort in a course
+@app.post("/courses/{course_id}/enrollments/batch")
+def enroll_cohort(course_id: int, cohort: CohortEnrollment,
+                  idempotency_key: Optional[str] = Header(None)):
+    """
+    Registers a list of students for a course in one transaction.
+    Students that are already enrolled or do not exist are skipped and reported.
+    If the new students do not all fit, nobody is enrolled (409).
+    """
+    enrollment_date, = partitions.ensure_enrollment_partitions([cohort.enrollment_date])
+    with get_connection() as con:
+        previous = claim_idempotency_key(con, idempotency_key, f"POST /courses/{course_id}/enrollments/batch",
+                                         cohort.model_dump())
+        if previous is not None:
+            return previous
+
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(
+                "SELECT capacity, enrolled_count FROM courses WHERE course_id = %s FOR UPDATE;",
+                (course_id,))
+            course = cursor.fetchone()
+            if not course:
+                raise HTTPException(status_code=404, detail="Course not found")
+
+            cursor.execute("""
+                INSERT INTO enrollments (student_id, course_id, enrollment_date)
+                SELECT student_id, %s, %s FROM students
+                WHERE student_id = ANY(%s)
+                  AND NOT EXISTS (SELECT 1 FROM enrollments
+                                  WHERE enrollments.student_id = students.student_id
+                                    AND enrollments.course_id = %s)
+                RETURNING student_id;
+            """, (course_id, enrollment_date, cohort.student_ids, course_id))
+            enrolled = sorted(row["student_id"] for row in cursor.fetchall())
+
+            if (course["capacity"] is not None
+                    and course["enrolled_count"] + len(enrolled) > course["capacity"]):
+                raise HTTPException(
+                    status_code=409,
+                    detail=f"Course has {course['capacity'] - course['enrolled_count']} free seats, "
+                           f"{len(enrolled)} requested")
+
+            cursor.execute("UPDATE courses SET enrolled_count = enrolled_count + %s WHERE course_id = %s;",
+                           (len(enrolled), course_id))
+
+            cursor.execute("SELECT student_id FROM students WHERE student_id = ANY(%s);", (cohort.student_ids,))
+            existing = {row["student_id"] for row in cursor.fetchall()}
+
+        result = {
+            "course_id": course_id,
+            "enrolled": enrolled,
+            "already_enrolled": sorted(existing - set(enrolled)),
+            "unknown_students": sorted(set(cohort.student_ids) - existing),
+        }
+        if idempotency_key:
+            return idempotency.store(con, idempotency_key, result)
+    return result
+
+
+# ----------------------- Grades  ---------------------------
+
+VALID_GRADES = {1.0, 2.0, 3.0, 4.0, 5.0}
+
+
+# Post grades for a whole course
+@app.post("/courses/{course_id}/grades")
+def submit_grades(course_id: int, submission: GradeSubmission):
+    """
+    Sets the grades of many students in a course with one upsert into student_courses.
+    Returns an outcome per row: created, updated, unchanged, invalid_grade,
+    duplicate or student_not_found. Student averages are updated by triggers.
+    """
+    results = []
+    accepted = {}
+    for entry in submission.grades:
+        result = {"student_id": entry.student_id, "grade": entry.grade}
+        results.append(result)
+        if entry.grade not in VALID_GRADES:
+            result["outcome"] = "invalid_grade"
+        elif entry.student_id in accepted:
+            result["outcome"] = "duplicate"
+        else:
+            accepted[entry.student_id] = result
+
+    # Sorted so concurrent submissions lock rows in the same order
+    student_ids = sorted(accepted)
+    grades = [accepted[student_id]["grade"] for student_id in student_ids]
+
+    with get_connection() as con:
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute("SELECT 1 FROM courses WHERE course_id = %s;", (course_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Course not found")
+
+            # student_courses is partitioned, so xmax cannot tell inserts from updates;
+            # the rows that existed before the upsert can (same snapshot)
+            cursor.execute("""
+                WITH input AS (
+                    SELECT * FROM unnest(%s::int[], %s::numeric[]) AS t(student_id, grade)
+                ), existing AS (
+                    SELECT student_id FROM student_courses
+                    WHERE course_id = %s AND student_id = ANY(%s)
+                ), upserted AS (
+                    INSERT INTO student_courses (student_id, course_id, grade)
+                    SELECT input.student_id, %s, input.grade
+                    FROM input JOIN students ON students.student_id = input.student_id
+                    ORDER BY input.student_id
+                    ON CONFLICT (student_id, course_id) DO UPDATE SET grade = EXCLUDED.grade
+                    WHERE student_courses.grade IS DISTINCT FROM EXCLUDED.grade
+                    RETURNING student_id
+                )
+                SELECT input.student_id,
+                       CASE WHEN upserted.student_id IS NOT NULL AND existing.student_id IS NULL THEN 'created'
+                            WHEN upserted.student_id IS NOT NULL THEN 'updated'
+                            WHEN students.student_id IS NOT NULL THEN 'unchanged'
+                            ELSE 'student_not_found' END AS outcome
+                FROM input
+                LEFT JOIN existing ON existing.student_id = input.student_id
+                LEFT JOIN upserted ON upserted.student_id = input.student_id
+                LEFT JOIN students ON students.student_id = input.student_id;
+            """, (student_ids, grades, course_id, student_ids, course_id))
+
+            for row in cursor.fetchall():
+                accepted[row["student_id"]]["outcome"] = row["outcome"]
+
+    summary = {}
+    for result in results:
+        summary[result["outcome"]] = summary.get(result["outcome"], 0) + 1
+    return {"course_id": course_id, "summary": summary, "results": results}
+
+
+# ----------------------- Prerequisites and recommendations  ---------------------------
+
+def prerequisites_of(cursor, course_id: int) -> dict:
+    cursor.execute(
+        "SELECT prerequisite_id FROM course_prerequisites WHERE course_id = %s ORDER BY prerequisite_id;",
+        (course_id,))
+    direct = [row[0] for row in cursor.fetchall()]
+    cursor.execute("""
+        WITH RECURSIVE required (course_id) AS (
+            SELECT prerequisite_id FROM course_prerequisites WHERE course_id = %s
+            UNION
+            SELECT p.prerequisite_id FROM course_prerequisites p JOIN required r ON p.course_id = r.course_id
+        )
+        SELECT course_id FROM required ORDER BY course_id;
+    """, (course_id,))
+    return {"course_id": course_id, "prerequisites": direct,
+            "all_prerequisites": [row[0] for row in cursor.fetchall()]}
+
+
+# Prerequisites of a course
+@app.get("/courses/{course_id}/prerequisites")
+def get_course_prerequisites(course_id: int):
+    """
+    The direct prerequisites of a course and all courses needed before it
+    (prerequisites of prerequisites included).
+    """
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM courses WHERE course_id = %s;", (course_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Course not found")
+            return prerequisites_of(cursor, course_id)
+
+
+# Replace the prerequisites of a course
+@app.put("/courses/{course_id}/prerequisites")
+def set_course_prerequisites(course_id: int, update: PrerequisiteUpdate):
+    """
+    Replaces the direct prerequisites of a course.
+    Rejected with 409 if it would make the prerequisite graph cyclic.
+    """
+    prerequisite_ids = sorted(set(update.prerequisite_ids))
+    if course_id in prerequisite_ids:
+        raise HTTPException(status_code=409, detail="A course cannot be its own prerequisite")
+
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            # One writer at a time, so two concurrent changes cannot close a cycle between them
+            cursor.execute("LOCK TABLE course_prerequisites IN SHARE ROW EXCLUSIVE MODE;")
+            cursor.execute("SELECT course_id FROM courses WHERE course_id = ANY(%s);",
+                           (prerequisite_ids + [course_id],))
+            missing = set(prerequisite_ids + [course_id]) - {row[0] for row in cursor.fetchall()}
+            if missing:
+                raise HTTPException(status_code=404, detail=f"Courses not found: {sorted(missing)}")
+
+            # A cycle means the course is already required by one of its new prerequisites
+            cursor.execute("""
+                WITH RECURSIVE required (course_id) AS (
+                    SELECT unnest(%s::int[])
+                    UNION
+                    SELECT p.prerequisite_id FROM course_prerequisites p JOIN required r ON p.course_id = r.course_id
+                )
+                SELECT 1 FROM required WHERE course_id = %s LIMIT 1;
+            """, (prerequisite_ids, course_id))
+            if cursor.fetchone():
+                raise HTTPException(status_code=409, detail="Prerequisites would form a cycle")
+
+            cursor.execute("DELETE FROM course_prerequisites WHERE course_id = %s;", (course_id,))
+            cursor.execute("""
+                INSERT INTO course_prerequisites (course_id, prerequisite_id)
+                SELECT %s, unnest(%s::int[]);
+            """, (course_id, prerequisite_ids))
+            return prerequisites_of(cursor, course_id)
+
+
+# Course recommendations for a student
+@app.get("/students/{student_id}/recommendations")
+def recommend_courses(student_id: int, limit: int = Query(10, ge=1, le=100)):
+    """
+    Courses the student has not taken yet and has the prerequisites for, ranked
+    by how often students with a similar history took them (see recommend.py).
+    The model is refreshed in the background every REFRESH_SECONDS (see warm_up);
+    until it is loaded the answer is 503.
+    """
+    import recommend
+    if not recommend.course_model.loaded:
+        raise HTTPException(status_code=503, detail="Recommendations are not available yet")
+
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            cursor.execute("SELECT 1 FROM students WHERE student_id = %s;", (student_id,))
+            if not cursor.fetchone():
+                raise HTTPException(status_code=404, detail="Student not found")
+
+    ranked = recommend.course_model.recommend(student_id, limit)
+    courses = {row["course_id"]: row for row in sharding.fetch_each(department_statements("""
+        SELECT course_id, name, credits FROM courses
+        WHERE course_id = ANY(%(courses)s)
+          AND (%(skip)s::int[] IS NULL OR department_id IS NULL OR department_id <> ALL(%(skip)s));
+    """, params={"courses": [course_id for course_id, _ in ranked]}))}
+    return [{**courses[course_id], "score": score} for course_id, score in ranked if course_id in courses]
+
+
+# ----------------------- Change feed  ---------------------------
+
+# Changes since a cursor
+@app.get("/changes", status_code=status.HTTP_200_OK)
+def list_changes(since: str = "0-0", limit: int = Query(500, ge=1, le=5000)):
+    """
+    Returns the create/update/delete events for students, courses and instructors
+    committed after the cursor, plus the cursor to continue from.
+    A cursor older than the retained events gets 410 (see retention.py).
+    Example usage: /changes?since=0-0
+    """
+    try:
+        cursor = parse_cursor(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    con = get_connection()
+    with con:
+        events, next_cursor = fetch_changes(con, since, limit)
+        try:
+            retention.check_cursor(con, cursor)
+        except retention.HistoryExpired as e:
+            raise HTTPException(status_code=410, detail=str(e))
+    return {"events": events, "cursor": next_cursor}
+
+
+# Live stream of changes (server-sent events)
+@app.get("/changes/stream")
+def stream_change_events(since: str = "0-0", last_event_id: Optional[str] = Header(None)):
+    """
+    Streams change events as server-sent events. Reconnecting clients continue
+    from the Last-Event-ID header. Answers 503 when CHANGE_STREAMS_MAX streams are open;
+    poll /changes instead or retry later. 410 for a cursor older than the retained events.
+    """
+    since = last_event_id or since
+    try:
+        cursor = parse_cursor(since)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    with get_connection() as con:
+        try:
+            retention.check_cursor(con, cursor)
+        except retention.HistoryExpired as e:
+            raise HTTPException(status_code=410, detail=str(e))
+
+    try:
+        stream = stream_changes(since)
+    except TooManyStreams:
+        raise HTTPException(status_code=503, detail="Too many change streams open",
+                            headers={"Retry-After": "5"})
+    return StreamingResponse(stream, media_type="text/event-stream")
+
+
+# ----------------------- Admin: profiling  ---------------------------
+
+def require_admin(x_admin_token: Optional[str] = Header(None)):
+    """Admin endpoints need X-Admin-Token matching ADMIN_TOKEN; without ADMIN_TOKEN they are disabled."""
+    token = load_config()["admin_token"]
+    if not token:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token, token):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+# Per-route wall, CPU and wait time
+@app.get("/admin/profile/routes", dependencies=[Depends(require_admin)], tags=["admin"])
+def profile_routes():
+    """
+    Per-route request count with handler wall, CPU and wait (wall minus CPU) time,
+    slowest first. Covers this worker process since start or the last reset.
+    """
+    return profiling.route_stats.summary()
+
+
+# Most requested ids
+@app.get("/admin/profile/hot-ids", dependencies=[Depends(require_admin)], tags=["admin"])
+def profile_hot_ids(top: int = Query(10, ge=1, le=1000)):
+    """The most frequently requested student, course and instructor ids."""
+    return profiling.hot_ids.top(top)
+
+
+# Sampling profiler
+@app.get("/admin/profile/stacks", dependencies=[Depends(require_admin)], tags=["admin"],
+         response_class=PlainTextResponse)
+def profile_stacks(seconds: float = Query(5, gt=0, le=profiling.MAX_SAMPLE_SECONDS),
+                   interval_ms: float = Query(10, ge=1, le=1000),
+                   app_only: bool = True):
+    """
+    Samples all request threads for the given window and returns collapsed stacks
+    ("frame;frame;frame count"), ready for flamegraph.pl or speedscope.
+    Example usage: /admin/profile/stacks?seconds=10 > stacks.txt
+    """
+    return profiling.sample_stacks(seconds, interval_ms / 1000, app_only)
+
+
+# Statement timeouts and cancelled queries
+@app.get("/admin/queries", dependencies=[Depends(require_admin)], tags=["admin"])
+def query_stats():
+    """Per-route counts of statement timeouts and of queries cancelled after a client disconnect."""
+    return timeouts.query_stats.summary()
+
+
+# Reset the statistics
+@app.delete("/admin/profile", dependencies=[Depends(require_admin)], tags=["admin"])
+def reset_profile():
+    profiling.route_stats.reset()
+    profiling.hot_ids.reset()
+    timeouts.query_stats.reset()
+    return {"message": "Profiling statistics reset."}
+
+
+# ----------------------- Admin: audit log  ---------------------------
+
+AUDIT_WINDOW = timedelta(days=30)
+MAX_AUDIT_WINDOW = timedelta(days=366)
+
+
+@app.get("/admin/audit", dependencies=[Depends(require_admin)], tags=["admin"])
+def audit_history(request: Request, response: Response,
+                  entity: Optional[str] = Query(None, pattern="^(students|courses|instructors)$"),
+                  entity_id: Optional[int] = None,
+                  actor: Optional[str] = None,
+                  since: Optional[datetime] = None,
+                  until: Optional[datetime] = None,
+                  limit: int = Query(100, ge=1, le=MAX_LIMIT),
+                  offset: int = Query(0, ge=0, le=MAX_OFFSET)):
+    """
+    Who changed what, newest first, with the row before and after each change.
+    The time window (default the last 30 days, at most a year) limits the scan
+    to the monthly partitions of audit_log it covers. Events are written about
+    a second after the change (see audit.py).
+    Example usage: /admin/audit?entity=students&entity_id=4&since=2025-01-01
+    """
+    until = until or datetime.now(timezone.utc)
+    if until.tzinfo is None:
+        until = until.replace(tzinfo=timezone.utc)
+    since = since or until - AUDIT_WINDOW
+    if since.tzinfo is None:
+        since = since.replace(tzinfo=timezone.utc)
+    if not timedelta(0) <= until - since <= MAX_AUDIT_WINDOW:
+        raise HTTPException(status_code=400, detail="since must be before until and at most a year earlier")
+
+    conditions = [
+        ("recorded_at", ">=", since),
+        ("recorded_at", "<=", until),
+        ("entity", "=", entity),
+        ("entity_id", "=", entity_id),
+        ("actor", "=", actor),
+    ]
+    return filtered_list(
+        "SELECT audit_id, recorded_at, actor, entity, entity_id, operation, before, after FROM audit_log",
+        conditions, {"recorded_at": "recorded_at"}, "audit_id", "-recorded_at", limit, offset,
+        request, response)
+
 
-    return result
\ No newline at end of file
+profiling.instrument(app)
@@ -0,0 +1,175 @@
+# partitions.py
+
+"""
+Partitioning of the two tables that grow with the history: enrollments and
+student_courses.
+
+enrollments is range partitioned by enrollment_date, one partition per year
+(enrollments_2024, ...). create_tables creates the current and the next year,
+the seeds the years they insert, and the enroll endpoints call
+ensure_enrollment_partitions() before their transaction for the date they are
+about to write (today when none is given), so a back-dated or future
+enrollment gets its partition too.
+That runs in its own short transaction: creating a partition locks the parent
+table, which must not be held for the rest of a request. Years already
+created are cached per process; a partition dropped while the API runs is
+only recreated after a restart.
+
+student_courses is hash partitioned by student_id (STUDENT_COURSES_PARTITIONS
+in setup.py), all partitions created up front.
+
+Queries that filter on enrollment_date or student_id only scan the matching
+partitions, old years can be detached or dropped instead of deleted, and
+vacuum and index maintenance work per partition.
+
+Databases created before partitioning keep their plain tables (the API works
+on both) until migrated:
+
+    python partitions.py --database university_db
+"""
+
+import sys
+import threading
+from datetime import date
+
+from psycopg2 import sql
+
+from setup import (ENSURE_ENROLLMENT_PARTITIONS_QUERY, REBUILD_GRADE_STATS_QUERY, create_tables,
+                   get_connection, load_config)
+
+PARTITIONED_TABLES = ("enrollments", "student_courses")
+
+_lock = threading.Lock()
+_enrollment_years = set()
+
+
+def ensure_enrollment_partitions(days):
+    """
+    Creates the missing yearly enrollments partitions for the given dates and
+    returns the dates, None replaced by today. Insert those rather than
+    CURRENT_DATE: the database's date (time zone, clock) can already be in a
+    year whose partition was never created.
+    """
+    days = [day or date.today() for day in days]
+    years = {day.year for day in days}
+    with _lock:
+        years -= _enrollment_years
+    if not years:
+        return days
+    with get_connection() as con:
+        with con.cursor() as cursor:
+            for year in sorted(years):
+                cursor.execute("SELECT ensure_enrollment_partition(%s);", (date(year, 1, 1),))
+    # Only after the commit, a rolled back CREATE TABLE must be retried
+    with _lock:
+        _enrollment_years.update(years)
+    return days
+
+
+def forget():
+    """Clears the cache of created partitions (after dropping partitions or the database)."""
+    with _lock:
+        _enrollment_years.clear()
+
+
+def unpartitioned_tables(con):
+    """The tables of PARTITIONED_TABLES that are still plain tables."""
+    with con.cursor() as cursor:
+        cursor.execute("""
+            SELECT relname FROM pg_class
+            WHERE relname = ANY(%s) AND relkind = 'r' AND relnamespace = 'public'::regnamespace;
+        """, (list(PARTITIONED_TABLES),))
+        return {row[0] for row in cursor.fetchall()}
+
+
+def migrate(database_name):
+    """
+    Converts plain enrollments/student_courses tables into partitioned ones, in
+    one transaction: the old tables are renamed, create_tables creates the new
+    ones (with their indexes and triggers), the rows are copied and the old
+    tables dropped. Writes to both tables wait until it commits.
+    Returns the names of the migrated tables.
+    """
+    con = get_connection(database_name, pooled=False)
+    try:
+        with con:
+            tables = unpartitioned_tables(con)
+            if not tables:
+                return set()
+            with con.cursor() as cursor:
+                cursor.execute(sql.SQL("LOCK TABLE {} IN ACCESS EXCLUSIVE MODE;").format(
+                    sql.SQL(", ").join(sql.Identifier(table) for table in sorted(tables))))
+                if "enrollments" in tables:
+                    cursor.execute("SELECT COUNT(*) FROM enrollments WHERE enrollment_date IS NULL;")
+                    missing = cursor.fetchone()[0]
+                    if missing:
+                        raise ValueError(f"{missing} enrollments have no enrollment_date, "
+                                         "set one before partitioning")
+
+                # Free the names (table, indexes, sequence) for the new tables
+                for table in tables:
+                    old = f"{table}_unpartitioned"
+                    cursor.execute("SELECT indexname FROM pg_indexes WHERE schemaname = 'public' AND tablename = %s;",
+                                   (table,))
+                    for (index,) in cursor.fetchall():
+                        cursor.execute(sql.SQL("ALTER INDEX {} RENAME TO {};").format(
+                            sql.Identifier(index), sql.Identifier(f"{index}_unpartitioned")))
+                    cursor.execute("SELECT pg_get_serial_sequence(%s, column_name) FROM information_schema.columns "
+                                   "WHERE table_schema = 'public' AND table_name = %s;", (table, table))
+                    for (sequence,) in cursor.fetchall():
+                        if sequence:
+                            cursor.execute(sql.SQL("ALTER SEQUENCE {} RENAME TO {};").format(
+                                sql.SQL(sequence), sql.Identifier(f"{sequence.split('.')[-1]}_unpartitioned")))
+                    cursor.execute(sql.SQL("ALTER TABLE {} RENAME TO {};").format(
+                        sql.Identifier(table), sql.Identifier(old)))
+
+            create_tables(database_name, con)
+
+            with con.cursor() as cursor:
+                for table in sorted(tables):
+                    old = f"{table}_unpartitioned"
+                    if table == "enrollments":
+                        cursor.execute("SELECT MIN(enrollment_date), MAX(enrollment_date) FROM enrollments_unpartitioned;")
+                        first, last = cursor.fetchone()
+                        if first is not None:
+                            cursor.execute(ENSURE_ENROLLMENT_PARTITIONS_QUERY, (first, last))
+                    # Explicit columns: the old table may have them in a different order
+                    cursor.execute("SELECT column_name FROM information_schema.columns "
+                                   "WHERE table_schema = 'public' AND table_name = %s ORDER BY ordinal_position;",
+                                   (table,))
+                    columns = sql.SQL(", ").join(sql.Identifier(row[0]) for row in cursor.fetchall())
+                    cursor.execute(sql.SQL("INSERT INTO {} ({}) SELECT {} FROM {};").format(
+                        sql.Identifier(table), columns, columns, sql.Identifier(old)))
+                    cursor.execute(sql.SQL("DROP TABLE {};").format(sql.Identifier(old)))
+
+                if "enrollments" in tables:
+                    cursor.execute("""
+                        SELECT setval(pg_get_serial_sequence('enrollments', 'enrollment_id'),
+                                      COALESCE(MAX(enrollment_id), 0) + 1, false)
+                        FROM enrollments;
+                    """)
+                # The copy went through the grade triggers once more
+                cursor.execute(REBUILD_GRADE_STATS_QUERY)
+        return tables
+    finally:
+        con.close()
+
+
+def main(argv=None):
+    import argparse  # only the command line needs it, not the API importing this module
+
+    parser = argparse.ArgumentParser(description="Partition the enrollments and student_courses tables.")
+    parser.add_argument("--database", default=None)
+    args = parser.parse_args(argv)
+
+    database_name = args.database or load_config()["database"]
+    migrated = migrate(database_name)
+    if migrated:
+        print(f"Partitioned {', '.join(sorted(migrated))} in {database_name}.")
+    else:
+        print(f"{database_name} is already partitioned.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,326 @@
+# plan_check.py
+
+"""
+Query plan regression checker.
+
+Extracts every SQL statement issued by the handlers in main.py, runs
+EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) for each of them against a large
+generated dataset and compares plan shape, cost and buffer counts with the
+committed baseline (plan_baseline.json).
+
+Usage:
+    python plan_check.py --database plan_check_db --seed --update-baseline
+    python plan_check.py --database plan_check_db --seed
+
+Write statements are executed inside a transaction that is rolled back.
+Exits with status 1 when a regression is found.
+"""
+
+import argparse
+import ast
+import json
+import os
+import re
+import sys
+from datetime import date
+
+from setup import clear_data, create_tables, get_connection, seed_large_data
+
+MAIN_MODULE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+BASELINE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "plan_baseline.json")
+
+# A plan regresses when cost or buffers grow by more than this factor ...
+COST_TOLERANCE = 1.5
+BUFFER_TOLERANCE = 1.5
+# ... and by more than this absolute amount (tiny plans are noisy).
+MIN_COST_INCREASE = 50
+MIN_BUFFER_INCREASE = 50
+
+# Statements EXPLAIN cannot run, left out of the check
+UTILITY_COMMANDS = {"LOCK", "SET"}
+
+# Sample parameters for every statement, keyed by "<handler>#<n>" where n is
+# the position of the statement inside the handler. Values are picked so the
+# statements hit rows in the generated dataset. Named parameters (%(name)s) take a dict.
+SAMPLE_PARAMS = {
+    "warm_up#0": (),
+    "list_students#0": (),
+    "search_students#0": ("%ar%", "%ar%"),
+    "autocomplete_students#0": (),
+    "get_student#0": (4242,),
+    "delete_student#0": (4242,),
+    "delete_student_by_name#0": ("Jacob", "Student4244"),
+    "create_student#0": ("Plan", "Check", "plan.check@yh.se", "2024-01-01"),
+    "update_student#0": (4242, "Plan", "Check", "plan.check@yh.se", "2024-01-01"),
+    "get_average_grade#0": (4242,),
+    "list_course#0": (),
+    "list_courses_by_department#0": (7,),
+    "delete_course#0": (42,),
+    "create_course#0": ("Plan Check", 5, 7, 30),
+    "update_course#0": (42, "Plan Check", 5, 7),
+    "list_instructors#0": (),
+    "get_instructor#0": (42,),
+    "create_instructor#0": ("Plan", "Check", "plan.check@university.se", 7),
+    "update_instructor#0": (42, "Plan", "Check", "plan.check@university.se", 7),
+    "list_departments#0": {"skip": [1, 2]},
+    "list_enrollments#0": (),
+    "list_modified#0": (),
+    "list_modified#1": ("students", "2100-01-01"),
+    "get_catalogue#0": {"tags": [], "skip": [1, 2]},
+    "enroll_student#0": (42,),
+    "enroll_student#1": (42,),
+    "enroll_student#2": (42, date(2024, 9, 1), 4242, 4242, 42),
+    "enroll_student#3": (4242,),
+    "enroll_cohort#0": (42,),
+    "enroll_cohort#1": (42, date(2024, 9, 1), list(range(4000, 4100)), 42),
+    "enroll_cohort#2": (100, 42),
+    "enroll_cohort#3": (list(range(4000, 4100)),),
+    "submit_grades#0": (42,),
+    "submit_grades#1": (list(range(4000, 4500)), [1 + i % 5 for i in range(500)], 42,
+                        list(range(4000, 4500)), 42),
+    "prerequisites_of#0": (500,),
+    "prerequisites_of#1": (500,),
+    "get_course_prerequisites#0": (500,),
+    "set_course_prerequisites#0": ([10, 20, 500],),
+    "set_course_prerequisites#1": ([10, 20], 500),
+    "set_course_prerequisites#2": (500,),
+    "set_course_prerequisites#3": (500, [10, 20]),
+    "recommend_courses#0": (4242,),
+    "recommend_courses#1": {"courses": [1, 2, 3, 4, 5, 6, 7, 8, 9, 10], "skip": [1, 2]},
+}
+
+
+# Statements main.py builds dynamically (psycopg2.sql), in a representative shape.
+EXTRA_STATEMENTS = {
+    "patch_row#students": "WITH previous AS (SELECT * FROM students WHERE student_id = %s FOR UPDATE) "
+                          "UPDATE students AS t SET email = %s, version = t.version + 1 FROM previous "
+                          "WHERE t.student_id = previous.student_id AND t.version = %s "
+                          "RETURNING t.*, to_jsonb(previous) AS audit_before;",
+    "patch_row#courses": "WITH previous AS (SELECT * FROM courses WHERE course_id = %s FOR UPDATE) "
+                         "UPDATE courses AS t SET credits = %s, version = t.version + 1 FROM previous "
+                         "WHERE t.course_id = previous.course_id "
+                         "RETURNING t.*, to_jsonb(previous) AS audit_before;",
+    "patch_row#instructors": "WITH previous AS (SELECT * FROM instructors WHERE instructor_id = %s FOR UPDATE) "
+                             "UPDATE instructors AS t SET department_id = %s, version = t.version + 1 "
+                             "FROM previous WHERE t.instructor_id = previous.instructor_id "
+                             "RETURNING t.*, to_jsonb(previous) AS audit_before;",
+    "bulk_delete#select": "SELECT student_id FROM students WHERE enrollment_date < %s ORDER BY student_id;",
+    "bulk_delete#cascade": "DELETE FROM student_courses WHERE student_id = ANY(%s);",
+    "bulk_delete#prerequisites": "DELETE FROM course_prerequisites WHERE course_id = ANY(%s) "
+                                 "OR prerequisite_id = ANY(%s);",
+    "bulk_delete#enrollments": "DELETE FROM enrollments WHERE course_id = ANY(%s);",
+    "bulk_delete#delete": "DELETE FROM students WHERE student_id = ANY(%s) "
+                          "RETURNING student_id, to_jsonb(students);",
+    "fetch_changes#0": "WITH horizon AS (SELECT LEAST(%s::bigint, (SELECT MIN(xip) FROM "
+                       "txid_snapshot_xip(txid_current_snapshot()) AS xip WHERE xip >= %s), "
+                       "txid_snapshot_xmax(txid_current_snapshot())) AS txid) "
+                       "SELECT event_id, change_events.txid, entity, entity_id, operation, payload, created_at, "
+                       "change_events.txid >= horizon.txid AS held_back FROM change_events, horizon "
+                       "WHERE (change_events.txid, event_id) > (%s, %s) "
+                       "ORDER BY change_events.txid, event_id LIMIT %s;",
+    "list_modified#students": "SELECT * FROM students WHERE updated_at >= %s ORDER BY updated_at;",
+    "filtered_list#students": "SELECT * FROM students WHERE enrollment_date >= %s AND enrollment_date <= %s "
+                              "ORDER BY last_name ASC, student_id ASC LIMIT %s OFFSET %s;",
+    "filtered_list#courses": "SELECT * FROM courses WHERE department_id = ANY(%s) AND credits >= %s "
+                             "ORDER BY credits DESC, course_id ASC LIMIT %s OFFSET %s;",
+    "filtered_list#enrollments": "SELECT enrollments.enrollment_id, courses.name AS course_name, "
+                                 "enrollments.enrollment_date, enrollments.grade FROM enrollments "
+                                 "JOIN students ON enrollments.student_id = students.student_id "
+                                 "JOIN courses ON enrollments.course_id = courses.course_id "
+                                 "WHERE enrollments.course_id = ANY(%s) AND enrollments.grade = ANY(%s) "
+                                 "ORDER BY enrollments.enrollment_id ASC LIMIT %s OFFSET %s;",
+    # Date range within one year: only that year's enrollments partition is scanned
+    "filtered_list#enrollments_dates": "SELECT enrollments.enrollment_id, courses.name AS course_name, "
+                                       "enrollments.enrollment_date, enrollments.grade FROM enrollments "
+                                       "JOIN students ON enrollments.student_id = students.student_id "
+                                       "JOIN courses ON enrollments.course_id = courses.course_id "
+                                       "WHERE enrollments.enrollment_date >= %s AND enrollments.enrollment_date <= %s "
+                                       "ORDER BY enrollments.enrollment_id ASC LIMIT %s OFFSET %s;",
+}
+SAMPLE_PARAMS.update({
+    "patch_row#students": (4242, "plan.check@yh.se", 1),
+    "patch_row#courses": (42, 5),
+    "patch_row#instructors": (42, 7),
+    "bulk_delete#select": ("2020-02-01",),
+    "bulk_delete#cascade": (list(range(4000, 4500)),),
+    "bulk_delete#prerequisites": (list(range(400, 450)), list(range(400, 450))),
+    "bulk_delete#enrollments": (list(range(400, 450)),),
+    "bulk_delete#0": (list(range(4000, 4500)),),
+    "bulk_delete#delete": (list(range(4000, 4500)),),
+    "fetch_changes#0": (None, 0, 0, 0, 501),
+    "list_modified#students": ("2100-01-01",),
+    "filtered_list#students": ("2021-03-01", "2021-03-31", 100, 0),
+    "filtered_list#courses": ([7, 8], 5, 100, 0),
+    "filtered_list#enrollments": ([42, 43], ["A", "B"], 100, 0),
+    "filtered_list#enrollments_dates": ("2022-03-01", "2022-03-31", 100, 0),
+})
+
+
+# Calls that take SQL, and the position of the statement argument
+SQL_ARGUMENT = {"execute": 0, "fetch_all": 1, "department_statements": 0}
+
+
+def extract_statements(path=MAIN_MODULE):
+    """
+    Returns {"<handler>#<n>": sql} for every cursor.execute() / sharding.fetch_all() /
+    department_statements() call in main.py whose statement is a string literal or a variable bound to one.
+    """
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read(), filename=path)
+
+    statements = {}
+    for node in tree.body:
+        if not isinstance(node, ast.FunctionDef):
+            continue
+
+        literals = {}
+        calls = []
+        for child in ast.walk(node):
+            if (isinstance(child, ast.Assign) and isinstance(child.value, ast.Constant)
+                    and isinstance(child.value.value, str)):
+                for target in child.targets:
+                    if isinstance(target, ast.Name):
+                        literals[target.id] = child.value.value
+            elif (isinstance(child, ast.Call) and isinstance(child.func, ast.Attribute)
+                    and child.func.attr in SQL_ARGUMENT and len(child.args) > SQL_ARGUMENT[child.func.attr]):
+                calls.append(child)
+
+        calls.sort(key=lambda call: (call.lineno, call.col_offset))
+        for call in calls:
+            arg = call.args[SQL_ARGUMENT[call.func.attr]]
+            if isinstance(arg, ast.Constant) and isinstance(arg.value, str):
+                sql = arg.value
+            elif isinstance(arg, ast.Name) and arg.id in literals:
+                sql = literals[arg.id]
+            else:
+                continue
+            if sql.split(None, 1)[0].upper() in UTILITY_COMMANDS:
+                continue
+            index = sum(1 for key in statements if key.startswith(f"{node.name}#"))
+            statements[f"{node.name}#{index}"] = " ".join(sql.split())
+
+    return statements
+
+
+def summarize_plan(plan_json):
+    """Reduces EXPLAIN JSON output to the fields we compare."""
+    top = plan_json[0]
+    nodes = []
+
+    def walk(plan):
+        nodes.append({
+            "node": plan["Node Type"],
+            "relation": plan.get("Relation Name"),
+            "index": plan.get("Index Name"),
+        })
+        for child in plan.get("Plans", []):
+            walk(child)
+
+    walk(top["Plan"])
+    return {
+        "nodes": nodes,
+        "total_cost": top["Plan"]["Total Cost"],
+        "buffers": top["Plan"].get("Shared Hit Blocks", 0) + top["Plan"].get("Shared Read Blocks", 0),
+        "execution_ms": round(top.get("Execution Time", 0.0), 3),
+    }
+
+
+def explain_all(database_name, statements):
+    """Runs EXPLAIN ANALYZE for every statement. Returns (results, errors)."""
+    results = {}
+    errors = {}
+    con = get_connection(database_name)
+    try:
+        for key, sql in statements.items():
+            params = SAMPLE_PARAMS.get(key)
+            if isinstance(params, dict):
+                outdated = set(params) != set(re.findall(r"%\((\w+)\)s", sql))
+            else:
+                outdated = params is None or len(params) != sql.count("%s")
+            if outdated:
+                errors[key] = "no (or outdated) sample parameters in SAMPLE_PARAMS"
+                continue
+            try:
+                with con.cursor() as cursor:
+                    cursor.execute("EXPLAIN (ANALYZE, BUFFERS, FORMAT JSON) " + sql.rstrip(" ;"), params)
+                    plan_json = cursor.fetchone()[0]
+                summary = summarize_plan(plan_json)
+                summary["sql"] = sql
+                results[key] = summary
+            except Exception as e:
+                errors[key] = str(e).strip()
+            finally:
+                con.rollback()
+    finally:
+        con.close()
+    return results, errors
+
+
+def _seq_scans(summary):
+    return {n["relation"] for n in summary["nodes"] if n["node"] == "Seq Scan" and n["relation"]}
+
+
+def compare(baseline, current):
+    """Returns a list of human readable regressions."""
+    regressions = []
+    for key, now in sorted(current.items()):
+        before = baseline.get(key)
+        if before is None:
+            regressions.append(f"{key}: new statement without baseline (run with --update-baseline)")
+            continue
+
+        for relation in sorted(_seq_scans(now) - _seq_scans(before)):
+            regressions.append(f"{key}: new Seq Scan on {relation}")
+
+        if (now["total_cost"] > before["total_cost"] * COST_TOLERANCE
+                and now["total_cost"] - before["total_cost"] > MIN_COST_INCREASE):
+            regressions.append(
+                f"{key}: total cost {before['total_cost']} -> {now['total_cost']}")
+
+        if (now["buffers"] > before["buffers"] * BUFFER_TOLERANCE
+                and now["buffers"] - before["buffers"] > MIN_BUFFER_INCREASE):
+            regressions.append(f"{key}: buffers {before['buffers']} -> {now['buffers']}")
+
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Check main.py query plans against a baseline.")
+    parser.add_argument("--database", default=os.getenv("PLAN_CHECK_DATABASE", "plan_check_db"))
+    parser.add_argument("--seed", action="store_true", help="(re)create tables and generate the large dataset")
+    parser.add_argument("--students", type=int, default=100_000)
+    parser.add_argument("--update-baseline", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.seed:
+        create_tables(args.database)
+        clear_data(args.database)
+        seed_large_data(args.database, students=args.students)
+
+    statements = extract_statements()
+    statements.update(EXTRA_STATEMENTS)
+    current, errors = explain_all(args.database, statements)
+
+    for key, error in sorted(errors.items()):
+        print(f"ERROR {key}: {error}")
+
+    if args.update_baseline:
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(current, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written with {len(current)} statements.")
+        return 1 if errors else 0
+
+    with open(BASELINE_FILE, encoding="utf-8") as f:
+        baseline = json.load(f)
+
+    regressions = compare(baseline, current)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+
+    print(f"Checked {len(current)} statements: {len(regressions)} regressions, {len(errors)} errors.")
+    return 1 if regressions or errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
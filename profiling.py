@@ -0,0 +1,147 @@
+# profiling.py
+
+"""
+In-process profiling for the admin endpoints in main.py.
+
+- RouteStats: per-route request count, wall time and CPU time of the handler.
+  Wait time (database, locks, pool) is wall minus CPU.
+- HotIds: how often each student, course and instructor id is requested.
+- sample_stacks: a sampling profiler over sys._current_frames() that returns
+  stacks in the collapsed "frame;frame;frame count" format understood by
+  flamegraph.pl and speedscope.
+
+Statistics are per process; with serve.py every worker keeps its own.
+"""
+
+import functools
+import inspect
+import os
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from fastapi.routing import APIRoute
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+HOT_ID_PARAMS = {"student_id": "students", "course_id": "courses", "instructor_id": "instructors"}
+MAX_SAMPLE_SECONDS = 60
+
+
+class RouteStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = defaultdict(lambda: {"requests": 0, "wall_ms": 0.0, "cpu_ms": 0.0})
+
+    def record(self, route, wall, cpu):
+        with self._lock:
+            stats = self._stats[route]
+            stats["requests"] += 1
+            stats["wall_ms"] += wall * 1000
+            stats["cpu_ms"] += cpu * 1000
+
+    def summary(self):
+        """Per route totals and averages, slowest (total wall time) first."""
+        with self._lock:
+            items = [(route, dict(stats)) for route, stats in self._stats.items()]
+        result = []
+        for route, stats in sorted(items, key=lambda item: -item[1]["wall_ms"]):
+            wait_ms = max(stats["wall_ms"] - stats["cpu_ms"], 0.0)
+            result.append({
+                "route": route,
+                "requests": stats["requests"],
+                "wall_ms": round(stats["wall_ms"], 3),
+                "cpu_ms": round(stats["cpu_ms"], 3),
+                "wait_ms": round(wait_ms, 3),
+                "avg_wall_ms": round(stats["wall_ms"] / stats["requests"], 3),
+                "avg_cpu_ms": round(stats["cpu_ms"] / stats["requests"], 3),
+            })
+        return result
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+
+class HotIds:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = {entity: Counter() for entity in HOT_ID_PARAMS.values()}
+
+    def record(self, params):
+        with self._lock:
+            for param, entity in HOT_ID_PARAMS.items():
+                if isinstance(params.get(param), int):
+                    self._counts[entity][params[param]] += 1
+
+    def top(self, n):
+        with self._lock:
+            return {entity: [{"id": key, "requests": count} for key, count in counts.most_common(n)]
+                    for entity, counts in self._counts.items()}
+
+    def reset(self):
+        with self._lock:
+            for counts in self._counts.values():
+                counts.clear()
+
+
+route_stats = RouteStats()
+hot_ids = HotIds()
+
+
+def _timed(call, route):
+    @functools.wraps(call)
+    def wrapper(**kwargs):
+        wall, cpu = time.perf_counter(), time.thread_time()
+        try:
+            return call(**kwargs)
+        finally:
+            route_stats.record(route, time.perf_counter() - wall, time.thread_time() - cpu)
+            hot_ids.record(kwargs)
+    return wrapper
+
+
+def instrument(app):
+    """
+    Wraps every synchronous endpoint so its wall and CPU time (measured in the
+    worker thread that runs it) and the ids it was called with are recorded.
+    Call after all routes are declared.
+    """
+    for route in app.routes:
+        if isinstance(route, APIRoute) and not getattr(route.dependant.call, "_profiled", False):
+            if not inspect.iscoroutinefunction(route.dependant.call):
+                label = f"{','.join(sorted(route.methods))} {route.path}"
+                route.dependant.call = _timed(route.dependant.call, label)
+                route.dependant.call._profiled = True
+
+
+def _frame_label(frame):
+    code = frame.f_code
+    return f"{os.path.basename(code.co_filename)}:{code.co_name}"
+
+
+def sample_stacks(seconds, interval, app_only=True):
+    """
+    Samples the stacks of all other threads every interval seconds for the
+    given number of seconds. Returns collapsed stacks ("a;b;c count") sorted by
+    count. With app_only, only stacks passing through this project's modules
+    are kept (drops idle pool threads and the event loop).
+    """
+    seconds = min(seconds, MAX_SAMPLE_SECONDS)
+    own = threading.get_ident()
+    stacks = Counter()
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        for thread_id, frame in sys._current_frames().items():
+            if thread_id == own:
+                continue
+            labels = []
+            in_app = False
+            while frame is not None:
+                labels.append(_frame_label(frame))
+                in_app = in_app or frame.f_code.co_filename.startswith(APP_DIR)
+                frame = frame.f_back
+            if in_app or not app_only:
+                stacks[";".join(reversed(labels))] += 1
+        time.sleep(interval)
+    return "".join(f"{stack} {count}\n" for stack, count in stacks.most_common())
@@ -0,0 +1,277 @@
+# recommend.py
+
+"""
+Course recommendations from the completion history in student_courses.
+
+The history is kept in memory as a sparse student x course matrix. Two
+courses are similar when the same students take both (cosine of their
+co-enrollment counts), and a student's candidate courses are scored by their
+similarity to the courses the student has already taken:
+
+    scores = history @ similarity        (students x courses, one sparse product)
+
+A course is only recommended when the student has not taken it yet and has
+completed (has a grade in) every prerequisite in course_prerequisites. Ties,
+including students without any history, are broken by popularity. Courses
+nobody has taken and that have no prerequisites are not known to the model.
+
+The model loads everything once and then refreshes incrementally: rows of
+student_courses changed since the last watermark (updated_at) and tombstones
+of deleted rows. The matrices are rebuilt from memory, by the refresh, only
+when something changed; requests only read them. The API refreshes from a
+background thread (start_refresher). recommend_all computes the
+recommendations of every student in batches;
+`python recommend.py --output recommendations.jsonl` writes them out.
+"""
+
+import argparse
+import json
+import logging
+import sys
+import threading
+import time
+
+import numpy as np
+from scipy import sparse
+
+from setup import get_connection, load_config
+
+REFRESH_SECONDS = 30
+BATCH_SIZE = 2_000
+
+logger = logging.getLogger(__name__)
+
+
+class CourseModel:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._history = {}            # student_id -> {course_id: completed}
+        self._prerequisites = {}      # course_id -> set of prerequisite course_ids
+        self._watermark = None
+        self._changed = False
+        self._matrices = None
+
+    @property
+    def loaded(self):
+        return self._matrices is not None
+
+    def clear(self):
+        with self._refresh_lock, self._lock:
+            self._reset()
+
+    def _apply(self, student_id, course_id, completed):
+        """Returns whether the history changed (replayed rows do not)."""
+        courses = self._history.setdefault(student_id, {})
+        changed = courses.get(course_id) != completed
+        courses[course_id] = completed
+        return changed
+
+    def _remove(self, student_id, course_id):
+        courses = self._history.get(student_id)
+        if courses is None or course_id not in courses:
+            return False
+        del courses[course_id]
+        if not courses:
+            del self._history[student_id]
+        return True
+
+    def refresh(self, con):
+        """
+        Reads the changes since the last refresh (everything the first time)
+        and rebuilds the matrices when something changed.
+        The watermark is held back to the oldest open transaction, like
+        main.list_modified, and rows at the watermark are read again, so late
+        commits are not missed; replays are harmless.
+        Returns the number of changes applied.
+        """
+        with self._refresh_lock:
+            count = self._refresh(con)
+            if self._changed or self._matrices is None:
+                matrices = self._build()
+                with self._lock:
+                    self._matrices = matrices
+                    self._changed = False
+            return count
+
+    def _refresh(self, con):
+        with con.cursor() as cursor:
+            cursor.execute("""
+                SELECT LEAST(now(), MIN(xact_start)) FROM pg_stat_activity
+                WHERE datname = current_database() AND pid <> pg_backend_pid();
+            """)
+            watermark = cursor.fetchone()[0]
+
+            if self._watermark is None:
+                cursor.execute("SELECT student_id, course_id, grade IS NOT NULL, updated_at FROM student_courses;")
+                changes = [(row[3], row) for row in cursor.fetchall()]
+            else:
+                cursor.execute("""
+                    SELECT student_id, course_id, grade IS NOT NULL, updated_at
+                    FROM student_courses WHERE updated_at >= %s;
+                """, (self._watermark,))
+                changes = [(row[3], row) for row in cursor.fetchall()]
+                cursor.execute("""
+                    SELECT (row_key->>'student_id')::int, (row_key->>'course_id')::int, NULL, deleted_at
+                    FROM tombstones WHERE table_name = 'student_courses' AND deleted_at >= %s;
+                """, (self._watermark,))
+                changes += [(row[3], row) for row in cursor.fetchall()]
+
+            cursor.execute("SELECT course_id, prerequisite_id FROM course_prerequisites;")
+            prerequisites = {}
+            for course_id, prerequisite_id in cursor.fetchall():
+                prerequisites.setdefault(course_id, set()).add(prerequisite_id)
+
+        with self._lock:
+            # Deletions and (re)insertions in the order they happened
+            changed = False
+            for _, (student_id, course_id, completed, _) in sorted(changes, key=lambda change: change[0]):
+                if completed is None:
+                    changed |= self._remove(student_id, course_id)
+                else:
+                    changed |= self._apply(student_id, course_id, completed)
+            self._changed |= changed or prerequisites != self._prerequisites
+            self._prerequisites = prerequisites
+            self._watermark = watermark
+        return len(changes)
+
+    def _build(self):
+        """Sparse matrices of the current history."""
+        with self._lock:
+            course_ids = sorted({c for courses in self._history.values() for c in courses}
+                                | set(self._prerequisites)
+                                | {p for required in self._prerequisites.values() for p in required})
+            columns = {course_id: i for i, course_id in enumerate(course_ids)}
+            student_ids = sorted(self._history)
+            rows, cols, completed = [], [], []
+            for i, student_id in enumerate(student_ids):
+                for course_id, done in self._history[student_id].items():
+                    rows.append(i)
+                    cols.append(columns[course_id])
+                    completed.append(done)
+            shape = (len(student_ids), len(course_ids))
+            history = sparse.csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, cols)), shape=shape)
+            done = np.asarray(completed, dtype=bool)
+            completions = sparse.csr_matrix(
+                (np.ones(int(done.sum()), dtype=np.float32),
+                 (np.asarray(rows, dtype=np.int64)[done], np.asarray(cols, dtype=np.int64)[done])),
+                shape=shape)
+
+            # Cosine similarity of co-enrollment, without a course's similarity to itself
+            co_enrollment = (history.T @ history).tocsr()
+            popularity = co_enrollment.diagonal()
+            norm = sparse.diags(1 / np.sqrt(np.maximum(popularity, 1)))
+            similarity = (norm @ co_enrollment @ norm).tolil()
+            similarity.setdiag(0)
+
+            prerequisite_rows, prerequisite_cols = [], []
+            for course_id, required in self._prerequisites.items():
+                for prerequisite_id in required:
+                    prerequisite_rows.append(columns[course_id])
+                    prerequisite_cols.append(columns[prerequisite_id])
+            requires = sparse.csr_matrix(
+                (np.ones(len(prerequisite_rows), dtype=np.float32), (prerequisite_rows, prerequisite_cols)),
+                shape=(len(course_ids), len(course_ids)))
+
+            return {
+                "course_ids": np.asarray(course_ids),
+                "student_rows": {student_id: i for i, student_id in enumerate(student_ids)},
+                "student_ids": student_ids,
+                "history": history,
+                "completions": completions,
+                "similarity": similarity.tocsr(),
+                "requires": requires.T.tocsr(),
+                "prerequisite_counts": np.asarray(requires.sum(axis=1)).ravel(),
+                "popularity": popularity,
+            }
+
+    def _rank(self, matrices, history, completions, limit):
+        """Top limit (course_id, score) per row of the given history/completions slices."""
+        scores = (history @ matrices["similarity"]).toarray()
+        met = (completions @ matrices["requires"]).toarray()
+        eligible = (met >= matrices["prerequisite_counts"]) & (history.toarray() == 0)
+        course_ids = matrices["course_ids"]
+        popularity = matrices["popularity"]
+        results = []
+        for row_scores, row_eligible in zip(scores, eligible):
+            candidates = np.flatnonzero(row_eligible)
+            # Highest score first, then most popular, then lowest course id
+            order = np.lexsort((course_ids[candidates], -popularity[candidates], -row_scores[candidates]))
+            results.append([(int(course_ids[candidates[i]]), round(float(row_scores[candidates[i]]), 4))
+                            for i in order[:limit]])
+        return results
+
+    def _current(self):
+        matrices = self._matrices
+        if matrices is None:
+            raise RuntimeError("The course model is not loaded, call refresh first")
+        return matrices
+
+    def recommend(self, student_id, limit=10):
+        """[(course_id, score)] for one student, best first."""
+        matrices = self._current()
+        row = matrices["student_rows"].get(student_id)
+        if row is None:
+            empty = sparse.csr_matrix((1, len(matrices["course_ids"])), dtype=np.float32)
+            return self._rank(matrices, empty, empty, limit)[0]
+        return self._rank(matrices, matrices["history"][row], matrices["completions"][row], limit)[0]
+
+    def recommend_all(self, limit=10, batch_size=BATCH_SIZE):
+        """Yields (student_id, [(course_id, score)]) for every student with a history, in batches."""
+        matrices = self._current()
+        student_ids = matrices["student_ids"]
+        for start in range(0, len(student_ids), batch_size):
+            stop = start + batch_size
+            ranked = self._rank(matrices, matrices["history"][start:stop],
+                                matrices["completions"][start:stop], limit)
+            yield from zip(student_ids[start:stop], ranked)
+
+
+course_model = CourseModel()
+
+
+def start_refresher(interval=None):
+    """Starts a daemon thread refreshing course_model every interval seconds. Set the returned Event to stop it."""
+    interval = REFRESH_SECONDS if interval is None else interval
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                with get_connection() as con:
+                    course_model.refresh(con)
+            except Exception:
+                logger.exception("Refreshing the course model failed")
+
+    threading.Thread(target=run, name="course-model-refresher", daemon=True).start()
+    return stop
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Write course recommendations for every student.")
+    parser.add_argument("--database", default=None)
+    parser.add_argument("--output", default="recommendations.jsonl")
+    parser.add_argument("--limit", type=int, default=10)
+    args = parser.parse_args(argv)
+
+    model = CourseModel()
+    started = time.perf_counter()
+    con = get_connection(args.database or load_config()["database"], pooled=False)
+    try:
+        model.refresh(con)
+    finally:
+        con.close()
+    count = 0
+    with open(args.output, "w", encoding="utf-8") as output:
+        for student_id, courses in model.recommend_all(args.limit):
+            output.write(json.dumps({"student_id": student_id, "courses": courses}) + "\n")
+            count += 1
+    print(f"Wrote recommendations for {count} students in {time.perf_counter() - started:.1f}s")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,135 @@
+# retention.py
+
+"""
+Retention of the sync history: the change_events outbox (GET /changes) and the
+deletion tombstones (modified_since on the list endpoints, recommend.py, export.py).
+
+Both tables only grow, so rows older than HISTORY_RETENTION_DAYS (default 30) are
+pruned in the background (see start_pruner). pruned_history keeps the newest
+pruned row of each table: the change_events cursor and the tombstones deleted_at.
+A `since` cursor or `modified_since` watermark from before that point would
+silently miss changes, so it is refused (410 Gone in main.py); the client has to
+sync from scratch. Cursors and watermarks stay valid for HISTORY_RETENTION_DAYS
+after they were handed out. The default cursor 0-0 starts at the oldest
+retained event.
+
+Check after reading the history, in the same transaction: a prune that
+committed before the read is then always seen.
+"""
+
+import logging
+import threading
+
+from setup import get_connection, load_config
+
+PRUNE_BATCH_SIZE = 10_000
+
+logger = logging.getLogger(__name__)
+
+
+class HistoryExpired(LookupError):
+    pass
+
+
+# One batch per statement: of the oldest rows (in the order they are read), the ones
+# older than %(days)s are deleted, and the table's mark moves to the newest of them.
+# The scan stops after %(batch)s rows, so no index on the timestamp is needed; a row
+# of a long transaction can keep newer ones a little longer.
+PRUNE_QUERIES = {
+    "change_events": """
+        WITH pruned AS (
+            DELETE FROM change_events WHERE event_id IN (
+                SELECT event_id FROM (
+                    SELECT event_id, created_at FROM change_events
+                    ORDER BY txid, event_id LIMIT %(batch)s
+                ) AS oldest
+                WHERE created_at < now() - make_interval(days => %(days)s))
+            RETURNING txid, event_id
+        ), newest AS (
+            SELECT txid, event_id FROM pruned ORDER BY txid DESC, event_id DESC LIMIT 1
+        ), marked AS (
+            INSERT INTO pruned_history AS history (table_name, txid, event_id)
+            SELECT 'change_events', txid, event_id FROM newest
+            ON CONFLICT (table_name) DO UPDATE SET txid = EXCLUDED.txid, event_id = EXCLUDED.event_id
+            WHERE (history.txid, history.event_id) < (EXCLUDED.txid, EXCLUDED.event_id)
+        )
+        SELECT COUNT(*) FROM pruned;
+    """,
+    "tombstones": """
+        WITH pruned AS (
+            DELETE FROM tombstones WHERE tombstone_id IN (
+                SELECT tombstone_id FROM (
+                    SELECT tombstone_id, deleted_at FROM tombstones
+                    ORDER BY tombstone_id LIMIT %(batch)s
+                ) AS oldest
+                WHERE deleted_at < now() - make_interval(days => %(days)s))
+            RETURNING deleted_at
+        ), marked AS (
+            INSERT INTO pruned_history AS history (table_name, deleted_at)
+            SELECT 'tombstones', MAX(deleted_at) FROM pruned HAVING COUNT(*) > 0
+            ON CONFLICT (table_name) DO UPDATE SET deleted_at = GREATEST(history.deleted_at, EXCLUDED.deleted_at)
+        )
+        SELECT COUNT(*) FROM pruned;
+    """,
+}
+
+
+def prune(days=None, batch_size=PRUNE_BATCH_SIZE):
+    """
+    Deletes change events and tombstones older than days (HISTORY_RETENTION_DAYS) in
+    batches, one transaction each. Returns {table: rows deleted}.
+    """
+    days = load_config()["history_retention_days"] if days is None else days
+    deleted = {}
+    for table, query in PRUNE_QUERIES.items():
+        deleted[table] = 0
+        while True:
+            with get_connection() as con:
+                with con.cursor() as cursor:
+                    cursor.execute(query, {"days": days, "batch": batch_size})
+                    count = cursor.fetchone()[0]
+            deleted[table] += count
+            if count < batch_size:
+                break
+    return deleted
+
+
+def check_cursor(con, since):
+    """Raises HistoryExpired when change events after the cursor (txid, event_id) were pruned."""
+    if since == (0, 0):
+        return
+    with con.cursor() as cursor:
+        cursor.execute("""
+            SELECT txid || '-' || event_id FROM pruned_history
+            WHERE table_name = 'change_events' AND (txid, event_id) > (%s, %s);
+        """, since)
+        row = cursor.fetchone()
+    if row:
+        raise HistoryExpired(f"Events up to {row[0]} were pruned; sync from scratch")
+
+
+def check_watermark(con, modified_since):
+    """Raises HistoryExpired when tombstones at or after modified_since were pruned."""
+    with con.cursor() as cursor:
+        cursor.execute("""
+            SELECT deleted_at FROM pruned_history
+            WHERE table_name = 'tombstones' AND deleted_at >= %s;
+        """, (modified_since,))
+        row = cursor.fetchone()
+    if row:
+        raise HistoryExpired(f"Deletions up to {row[0].isoformat()} were pruned; sync from scratch")
+
+
+def start_pruner(interval=3600):
+    """Starts a daemon thread pruning the history every interval seconds. Set the returned Event to stop it."""
+    stop = threading.Event()
+
+    def run():
+        while not stop.wait(interval):
+            try:
+                prune()
+            except Exception:
+                logger.exception("Pruning the change history failed")
+
+    threading.Thread(target=run, name="history-pruner", daemon=True).start()
+    return stop
@@ -2,7 +2,7 @@
 
 from pydantic import BaseModel, Field, EmailStr
 from datetime import date
-from typing import Optional,Union
+from typing import List, Optional, Union
 
 class StudentCreate(BaseModel):
     first_name: str = Field(max_length=200, min_length=1)
@@ -21,6 +21,7 @@ class CourseCreate(BaseModel):
     name: str = Field(max_length=200, min_length=1)
     credits: int
     department_id: int
+    capacity: Optional[int] = Field(None, ge=0)
 
 
 class StudentUpdate(BaseModel):
@@ -46,7 +47,60 @@ class AverageGradeResponse(BaseModel):
     student_id: int
     average_grade: Optional[float]
 
+class StudentPatch(BaseModel):
+    first_name: Optional[str] = Field(None, max_length=200, min_length=1)
+    last_name: Optional[str] = Field(None, max_length=200, min_length=1)
+    email: Optional[EmailStr] = None
+    enrollment_date: Optional[date] = None
+
+
+class CoursePatch(BaseModel):
+    name: Optional[str] = Field(None, max_length=200, min_length=1)
+    credits: Optional[int] = None
+    department_id: Optional[int] = None
+    capacity: Optional[int] = Field(None, ge=0)
+
+
 class InstructorPatch(BaseModel):
+    first_name: Optional[str] = Field(None, max_length=200, min_length=1)
+    last_name: Optional[str] = Field(None, max_length=200, min_length=1)
     email: Optional[EmailStr] = None
     department_id: Optional[int] = None
 
+
+
+class StudentBulkDelete(BaseModel):
+    student_ids: Optional[List[int]] = None
+    enrolled_before: Optional[date] = None
+    dry_run: bool = False
+    chunk_size: int = Field(500, ge=1, le=10000)
+
+
+class CourseBulkDelete(BaseModel):
+    course_ids: Optional[List[int]] = None
+    department_id: Optional[int] = None
+    dry_run: bool = False
+    chunk_size: int = Field(500, ge=1, le=10000)
+
+
+class EnrollmentCreate(BaseModel):
+    student_id: int
+    enrollment_date: Optional[date] = None
+
+
+class CohortEnrollment(BaseModel):
+    student_ids: List[int] = Field(min_length=1, max_length=5000)
+    enrollment_date: Optional[date] = None
+
+
+class GradeEntry(BaseModel):
+    student_id: int
+    grade: float
+
+
+class GradeSubmission(BaseModel):
+    grades: List[GradeEntry] = Field(min_length=1, max_length=20000)
+
+
+class PrerequisiteUpdate(BaseModel):
+    prerequisite_ids: List[int] = Field(max_length=100)
@@ -0,0 +1,115 @@
+# serve.py
+
+"""
+Production entry point: runs main:app in several uvicorn worker processes.
+
+The connection budget (Postgres max_connections minus superuser slots and
+--reserve for scripts and admin sessions) is split over the workers, so
+workers x connections per worker never exceeds it. One extra worker's share is
+kept free for rolling restarts, when an old and a new worker briefly overlap.
+
+A worker's share first covers its dedicated connections: the autocomplete
+index's LISTEN connection and up to CHANGE_STREAMS_MAX change streams
+(changefeed.stream_changes refuses more). The rest is split over its pools:
+the API pool and, with SHARDS, one pool per shard on the same server (shards
+given as DSNs are on other servers and not counted here).
+
+Signals (sent to the serve.py process):
+    SIGHUP   rolling restart: every worker is replaced by a new one, one at a
+             time. uvicorn's supervisor asks the new worker over a pipe whether
+             its server has started, which it has once the lifespan startup
+             (main.warm_up, what /health/ready waits for) has finished, and only
+             then drains the old one. It is not an HTTP probe: the workers share
+             one socket, so a request cannot pick the new worker. uvicorn
+             versions without that check (no Process.wait_until_ready) retire
+             the old worker without waiting; serve.py warns about it.
+    SIGTERM  graceful shutdown: stop accepting, finish in-flight requests
+             (up to --graceful-timeout seconds), close the pools
+
+Usage:
+    python serve.py --workers 4 --port 8000
+"""
+
+import argparse
+import os
+import sys
+
+import uvicorn
+from uvicorn.supervisors import Multiprocess
+from uvicorn.supervisors.multiprocess import Process
+
+from setup import get_connection, load_config
+from sharding import is_local, shard_map
+
+
+def connection_budget(reserve):
+    """Connections the API may use in total: max_connections minus reserved slots."""
+    with get_connection(load_config()["database"], pooled=False) as con:
+        with con.cursor() as cursor:
+            cursor.execute("""
+                SELECT current_setting('max_connections')::int
+                     - current_setting('superuser_reserved_connections')::int;
+            """)
+            available = cursor.fetchone()[0]
+    con.close()
+    return available - reserve
+
+
+def pool_sizes(workers, budget, pool_min, pool_max, pools=1, dedicated=0):
+    """
+    Returns (min, max) size of each pool. The budget is shared by the
+    workers plus one extra during a rolling restart. A worker's share, minus
+    its dedicated (unpooled) connections, is split over its pools (the API
+    pool and the local shard pools).
+    """
+    share = (budget // (workers + 1) - dedicated) // pools
+    if share < 1:
+        raise ValueError(f"A connection budget of {budget} is too small for {workers} workers "
+                         f"with {pools} pools and {dedicated} dedicated connections each")
+    size = min(pool_max, share)
+    return min(pool_min, size), size
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run the API with several worker processes.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--reserve", type=int, default=10,
+                        help="connections kept free for scripts and admin sessions")
+    parser.add_argument("--graceful-timeout", type=int, default=30)
+    args = parser.parse_args(argv)
+
+    config = load_config()
+    # The shard pools are sized like the API pool (sharding.connect)
+    local_shards = [database for database in shard_map().databases if database is not None and is_local(database)]
+    # The autocomplete LISTEN connection plus the change streams (see changefeed.iter_changes)
+    dedicated = 1 + config["change_streams_max"]
+    pool_min, pool_max = pool_sizes(args.workers, connection_budget(args.reserve),
+                                    config["pool_min"], config["pool_max"],
+                                    pools=1 + len(local_shards), dedicated=dedicated)
+    # Read by load_config in the workers, ahead of DB_POOL_MIN/DB_POOL_MAX from .env
+    os.environ["SERVE_POOL_MIN"] = str(pool_min)
+    os.environ["SERVE_POOL_MAX"] = str(pool_max)
+    print(f"{args.workers} workers, {1 + len(local_shards)} pools of {pool_min}..{pool_max} "
+          f"and {dedicated} dedicated connections each")
+
+    server_config = uvicorn.Config(
+        "main:app",
+        host=args.host,
+        port=args.port,
+        workers=args.workers,
+        timeout_graceful_shutdown=args.graceful_timeout,
+        # How long a rolling restart waits for a new worker's startup (see the module docstring)
+        timeout_worker_healthcheck=30,
+    )
+    if not hasattr(Process, "wait_until_ready"):
+        print(f"uvicorn {uvicorn.__version__} does not wait for new workers to start: "
+              "SIGHUP restarts briefly run with one worker less", file=sys.stderr)
+    # The supervisor is used for a single worker too, so SIGHUP reloads always work
+    Multiprocess(server_config, sockets=[server_config.bind_socket()]).run()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
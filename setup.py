@@ -1,24 +1,251 @@
 # setup.py
 
+import contextvars
+import json
 import os
+import queue
+import select
+import threading
+from functools import lru_cache
+
 import psycopg2
-from dotenv import load_dotenv
+import psycopg2.extensions
+
+
+@lru_cache(maxsize=None)
+def load_config():
+    """
+    Reads .env and the environment once, on first use instead of at import time.
+    """
+    from dotenv import load_dotenv
+
+    load_dotenv(override=True)
+    return {
+        "database": os.getenv("DATABASE"),
+        "password": os.getenv("PASSWORD"),
+        # serve.py sets SERVE_POOL_* per worker; .env (override=True) must not undo that
+        "pool_min": int(os.getenv("SERVE_POOL_MIN") or os.getenv("DB_POOL_MIN", "2")),
+        "pool_max": int(os.getenv("SERVE_POOL_MAX") or os.getenv("DB_POOL_MAX", "20")),
+        "admin_token": os.getenv("ADMIN_TOKEN"),
+        "shards": os.getenv("SHARDS"),
+        "idempotency_ttl": int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(24 * 3600))),
+        "statement_timeout_ms": int(os.getenv("STATEMENT_TIMEOUT_MS", "30000")),
+        "route_timeouts": json.loads(os.getenv("ROUTE_TIMEOUTS") or "{}"),
+        "change_streams_max": int(os.getenv("CHANGE_STREAMS_MAX", "10")),
+        "history_retention_days": int(os.getenv("HISTORY_RETENTION_DAYS", "30")),
+        "autocomplete_max_terms": int(os.getenv("AUTOCOMPLETE_MAX_TERMS", "1000000")),
+    }
+
+
+class PoolError(Exception):
+    pass
+
+
+# Timeout and cancellation scope of the current API request (timeouts.RequestQueries)
+current_queries = contextvars.ContextVar("current_queries", default=None)
+
+
+class AppConnection(psycopg2.extensions.connection):
+    """
+    Connection used by the API. When it comes from the pool, leaving its `with`
+    block (or calling close()) hands it back to the pool instead of closing it.
+    During a request, cursor() also applies the route's statement timeout (see timeouts.py).
+    """
+    _pool = None
+    _returned = True
+    _queries = None
+    _on_commit = None
+
+    def on_commit(self, callback):
+        """Runs callback after the transaction of this `with` block commits; dropped on rollback."""
+        if self._on_commit is None:
+            self._on_commit = []
+        self._on_commit.append(callback)
+
+    def cursor(self, *args, **kwargs):
+        queries = current_queries.get()
+        if queries is not None:
+            queries.attach(self)
+        return super().cursor(*args, **kwargs)
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        callbacks, self._on_commit = self._on_commit or [], None
+        try:
+            result = super().__exit__(exc_type, exc_value, traceback)
+            if exc_type is None:
+                for callback in callbacks:
+                    callback()
+            return result
+        finally:
+            self._release()
+
+    def close(self):
+        if self._pool is None:
+            super().close()
+        else:
+            self._release()
+
+    def _release(self):
+        if self._returned:
+            return False
+        self._returned = True
+        if self._queries is not None:
+            self._queries.detach(self)
+            self._queries = None
+        self._pool.putconn(self)
+        return True
+
+
+class ConnectionPool:
+    """
+    Thread-safe connection pool. min_size connections are opened up front (pre-warmed),
+    at most max_size exist at once, idle ones are kept for reuse and callers wait
+    when all are in use.
+    """
+
+    def __init__(self, min_size, max_size, database_name=None):
+        self.database_name = database_name
+        self.closed = False
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(max_size)
+        for _ in range(min_size):
+            self._idle.put(self._connect())
+
+    def _connect(self):
+        con = _connect(self.database_name)
+        con._pool = self
+        return con
+
+    def getconn(self, timeout=30):
+        if self.closed:
+            raise PoolError("Connection pool is closed")
+        if not self._slots.acquire(timeout=timeout):
+            raise PoolError("Timed out waiting for a database connection")
+        try:
+            con = None
+            while con is None:
+                try:
+                    con = self._idle.get_nowait()
+                except queue.Empty:
+                    con = self._connect()
+                    break
+                if not _is_alive(con):
+                    psycopg2.extensions.connection.close(con)
+                    con = None
+        except Exception:
+            self._slots.release()
+            raise
+        con._returned = False
+        return con
+
+    def putconn(self, con):
+        try:
+            status = con.info.transaction_status if not con.closed else None
+            if self.closed or status in (None, psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN):
+                psycopg2.extensions.connection.close(con)
+                return
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                con.rollback()
+            self._idle.put(con)
+        finally:
+            self._slots.release()
+
+    def closeall(self):
+        self.closed = True
+        while True:
+            try:
+                psycopg2.extensions.connection.close(self._idle.get_nowait())
+            except queue.Empty:
+                break
+
+
+def _is_alive(con):
+    """
+    An idle connection has nothing to read. If the server has closed it (restart,
+    pg_terminate_backend, DROP DATABASE ... WITH (FORCE)) the socket is readable.
+    """
+    return not con.closed and not select.select([con], [], [], 0)[0]
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _connect(database_name):
+    """database_name is a database on the local server or a full DSN / URI (shards)."""
+    config = load_config()
+    params = {
+        "dbname": os.getenv("APP_DATABASE", "university_db"),
+        "user": "postgres",
+        "password": config["password"],
+        "host": "localhost",
+        "port": "5432",
+    }
+    if database_name and ("=" in database_name or "://" in database_name):
+        params.update(psycopg2.extensions.parse_dsn(database_name))
+    elif database_name:
+        params["dbname"] = database_name
+    return psycopg2.connect(**params, connection_factory=AppConnection)
+
+
+def open_pool():
+    """Opens the API's connection pool (DB_POOL_MIN..DB_POOL_MAX connections)."""
+    global _pool
+    config = load_config()
+    with _pool_lock:
+        if _pool is None:
+            _pool = ConnectionPool(config["pool_min"], config["pool_max"])
+    return _pool
+
+
+def pool_is_open():
+    return _pool is not None
 
-load_dotenv(override=True)
 
-DATABASE_NAME = os.getenv("DATABASE")
-PASSWORD = os.getenv("PASSWORD")
+def close_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _pool.closeall()
+            _pool = None
 
 
-def get_connection(database_name="university_db"):
-    """Returnerar en anslutning till databasen"""
-    return psycopg2.connect(
-        dbname=database_name,
-        user="postgres",
-        password=PASSWORD,
-        host="localhost",
-        port="5432",
-    )
+def get_connection(database_name=None, pooled=True):
+    """
+    Returnerar en anslutning till databasen.
+    The API uses APP_DATABASE (default university_db); tests point it at their own database.
+    While the pool is open (see main.lifespan) API connections come from the pool.
+    """
+    pool = _pool
+    if pool is None or database_name is not None or not pooled:
+        return _connect(database_name)
+    return pool.getconn()
+
+
+# Keeps courses.enrolled_count in line with enrollments inserted directly (seeding)
+RECOUNT_ENROLLMENTS_QUERY = """
+    UPDATE courses SET enrolled_count = (
+        SELECT COUNT(*) FROM enrollments WHERE enrollments.course_id = courses.course_id
+    );
+"""
+
+# Yearly enrollments partitions covering the dates from %s to %s
+ENSURE_ENROLLMENT_PARTITIONS_QUERY = """
+    SELECT ensure_enrollment_partition(year::date)
+    FROM generate_series(date_trunc('year', %s::date), %s::date, interval '1 year') AS year;
+"""
+
+# Rebuilds student_grade_stats from scratch (covers grades written without the triggers)
+REBUILD_GRADE_STATS_QUERY = """
+    INSERT INTO student_grade_stats (student_id, grade_sum, grade_count)
+    SELECT student_id, COALESCE(SUM(grade), 0), COUNT(grade)
+    FROM student_courses GROUP BY student_id
+    ON CONFLICT (student_id) DO UPDATE
+    SET grade_sum = EXCLUDED.grade_sum, grade_count = EXCLUDED.grade_count;
+"""
+
+# Hash partitions of student_courses (by student_id)
+STUDENT_COURSES_PARTITIONS = 8
 
 
 def clear_data(database_name):
@@ -26,7 +253,9 @@ def clear_data(database_name):
     with con:
         with con.cursor() as cursor:
             cursor.execute("""
-                TRUNCATE TABLE student_courses, enrollments, students, instructors, courses, departments 
+                TRUNCATE TABLE student_courses, enrollments, students, instructors, courses, departments,
+                    change_events, tombstones, pruned_history, idempotency_keys, student_grade_stats,
+                    course_prerequisites, audit_log
                 RESTART IDENTITY CASCADE;
             """)
     print("Data cleared successfully.")
@@ -77,6 +306,7 @@ def seed_data(database_name):
             """)
 
             # Insert Enrollments
+            cursor.execute(ENSURE_ENROLLMENT_PARTITIONS_QUERY, ("2023-01-01", "2025-12-31"))
             cursor.execute("""
                 INSERT INTO enrollments (student_id, course_id, enrollment_date, grade) VALUES 
                     (1, 1, '2024-08-21', 'A'), 
@@ -86,6 +316,7 @@ def seed_data(database_name):
                     (5, 4, '2023-09-01', 'B'),
                     (6, 2, '2025-01-20', 'A');
             """)
+            cursor.execute(RECOUNT_ENROLLMENTS_QUERY)
 
 
             # Insert student_courses
@@ -105,20 +336,104 @@ def seed_data(database_name):
                     (2, 3, 5), 
                     (2, 1, 3);
             """)
+
+            # Insert course_prerequisites (Linear Algebra needs Calculus, Data Science needs Python and Linear Algebra)
+            cursor.execute("""
+                INSERT INTO course_prerequisites (course_id, prerequisite_id) VALUES
+                    (3, 4),
+                    (5, 1),
+                    (5, 3);
+            """)
         
     print("Data seeded successfully.")
 
 
+def seed_large_data(database_name, students=100_000, courses=1_000, instructors=2_000, departments=50):
+    """
+    Generated (deterministic) data for benchmarks and query plan checks.
+    Every student gets three enrollments and four graded courses.
+    """
+    con = get_connection(database_name)
+    with con:
+        with con.cursor() as cursor:
+            cursor.execute("""
+                INSERT INTO departments (name, location)
+                SELECT 'Department ' || d, 'Building ' || d
+                FROM generate_series(1, %s) AS d;
+            """, (departments,))
+
+            cursor.execute("""
+                INSERT INTO courses (name, credits, department_id)
+                SELECT 'Course ' || c, 3 + c %% 5, 1 + c %% %s
+                FROM generate_series(1, %s) AS c;
+            """, (departments, courses))
+
+            cursor.execute("""
+                INSERT INTO instructors (first_name, last_name, email, department_id)
+                SELECT 'Instructor', 'No' || i, 'instructor' || i || '@university.se', 1 + i %% %s
+                FROM generate_series(1, %s) AS i;
+            """, (departments, instructors))
+
+            cursor.execute("""
+                INSERT INTO students (first_name, last_name, email, enrollment_date)
+                SELECT (ARRAY['Anna', 'Armando', 'Bob', 'Jesper', 'Jacob',
+                              'Maryam', 'Mahta', 'Sara', 'Tobias', 'Arina'])[1 + s %% 10],
+                       'Student' || s,
+                       'student' || s || '@yh.se',
+                       DATE '2020-01-01' + (s %% 2000)
+                FROM generate_series(1, %s) AS s;
+            """, (students,))
+
+            cursor.execute(ENSURE_ENROLLMENT_PARTITIONS_QUERY, ("2020-01-01", "2025-12-31"))
+            cursor.execute("""
+                INSERT INTO enrollments (student_id, course_id, enrollment_date, grade)
+                SELECT s, 1 + (s * 7 + k * 13) %% %s,
+                       DATE '2020-01-01' + ((s + k * 120) %% 2000),
+                       (ARRAY['A', 'B', 'C', 'D', 'F'])[1 + (s + k) %% 5]
+                FROM generate_series(1, %s) AS s, generate_series(0, 2) AS k;
+            """, (courses, students))
+            cursor.execute(RECOUNT_ENROLLMENTS_QUERY)
+
+            cursor.execute("""
+                INSERT INTO student_courses (student_id, course_id, grade)
+                SELECT s, 1 + (s * 7 + k * 13) %% %s, 1 + (s + k) %% 5
+                FROM generate_series(1, %s) AS s, generate_series(0, 3) AS k;
+            """, (courses, students))
+
+            # Every tenth course requires the one before it
+            cursor.execute("""
+                INSERT INTO course_prerequisites (course_id, prerequisite_id)
+                SELECT c, c - 1 FROM generate_series(10, %s, 10) AS c;
+            """, (courses,))
+
+    # ANALYZE cannot run inside a transaction block
+    con.autocommit = True
+    with con.cursor() as cursor:
+        cursor.execute("ANALYZE;")
+    con.close()
+
+    print(f"Large dataset seeded successfully ({students} students).")
+
+
 # Create tables if not exists
-def create_tables(DATABASE_NAME):
-    con = get_connection(DATABASE_NAME)
+def create_tables(DATABASE_NAME, con=None):
+    """
+    Creates what is missing of the schema. With con, runs in its transaction
+    and leaves committing to the caller (see partitions.migrate).
+    """
+    owns_connection = con is None
+    if owns_connection:
+        con = get_connection(DATABASE_NAME)
 
     create_courses_table_query = """
     CREATE TABLE IF NOT EXISTS Courses (
         course_id SERIAL PRIMARY KEY,
         name VARCHAR(150) UNIQUE,
         credits INT,
-        department_id INT
+        department_id INT,
+        version INT NOT NULL DEFAULT 1,
+        capacity INT,
+        enrolled_count INT NOT NULL DEFAULT 0
     );
     """
 
@@ -128,7 +443,8 @@ def create_tables(DATABASE_NAME):
         first_name VARCHAR(100),
         last_name VARCHAR(100),
         email VARCHAR(200),
-        department_id INT
+        department_id INT,
+        version INT NOT NULL DEFAULT 1
     );
     """
 
@@ -138,7 +454,8 @@ def create_tables(DATABASE_NAME):
         first_name VARCHAR(150),
         last_name VARCHAR(150),
         email VARCHAR(255) UNIQUE,
-        enrollment_date DATE
+        enrollment_date DATE,
+        version INT NOT NULL DEFAULT 1
     );
     """
 
@@ -150,16 +467,39 @@ def create_tables(DATABASE_NAME):
     );
     """
 
+    # One partition per year of enrollment_date (see partitions.py); the
+    # primary key has to include the partition key
     create_enrollments_table_query = """
     CREATE TABLE IF NOT EXISTS Enrollments (
-        enrollment_id SERIAL PRIMARY KEY,
+        enrollment_id SERIAL,
         student_id INT,
         course_id INT,
-        enrollment_date DATE,
-        grade CHAR(1) CHECK (grade IN ('A', 'B', 'C', 'D', 'F'))
-    );
+        enrollment_date DATE NOT NULL,
+        grade CHAR(1) CHECK (grade IN ('A', 'B', 'C', 'D', 'F')),
+        PRIMARY KEY (enrollment_id, enrollment_date)
+    ) PARTITION BY RANGE (enrollment_date);
     """
 
+    create_enrollment_partition_function_query = """
+    CREATE OR REPLACE FUNCTION ensure_enrollment_partition(day DATE) RETURNS void AS $$
+    DECLARE
+        first_day DATE := date_trunc('year', day);
+    BEGIN
+        -- Databases created before partitioning keep their plain table until migrated
+        IF NOT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'enrollments'::regclass) THEN
+            RETURN;
+        END IF;
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF enrollments FOR VALUES FROM (%L) TO (%L)',
+            'enrollments_' || to_char(first_day, 'YYYY'), first_day, (first_day + interval '1 year')::date);
+    EXCEPTION WHEN duplicate_table THEN
+        -- Created concurrently by another worker
+        NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+
+    # Hash partitioned by student, so per-student reads and vacuum touch one partition
     create_student_courses_table_query = """
     CREATE TABLE IF NOT EXISTS student_courses (
                 student_id int,
@@ -168,9 +508,193 @@ def create_tables(DATABASE_NAME):
                 PRIMARY KEY (student_id, course_id),
                 FOREIGN KEY (student_id) REFERENCES Students(student_id) ON DELETE CASCADE,
                 FOREIGN KEY (course_id) REFERENCES Courses(course_id) ON DELETE CASCADE
-            );
+            ) PARTITION BY HASH (student_id);
             """
 
+    # Prerequisite graph over courses (acyclic, enforced in main.set_course_prerequisites)
+    create_course_prerequisites_table_query = """
+    CREATE TABLE IF NOT EXISTS course_prerequisites (
+        course_id INT REFERENCES Courses(course_id) ON DELETE CASCADE,
+        prerequisite_id INT REFERENCES Courses(course_id) ON DELETE CASCADE,
+        PRIMARY KEY (course_id, prerequisite_id),
+        CHECK (course_id <> prerequisite_id)
+    );
+    """
+
+    # Outbox for the change feed (see changefeed.py)
+    create_change_events_table_query = """
+    CREATE TABLE IF NOT EXISTS change_events (
+        event_id BIGSERIAL PRIMARY KEY,
+        txid BIGINT NOT NULL DEFAULT txid_current(),
+        entity VARCHAR(50) NOT NULL,
+        entity_id INT NOT NULL,
+        operation VARCHAR(10) NOT NULL,
+        payload JSONB,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """
+
+    # Append-only audit trail (see audit.py), one partition per month
+    create_audit_log_table_query = """
+    CREATE TABLE IF NOT EXISTS audit_log (
+        audit_id BIGINT GENERATED ALWAYS AS IDENTITY,
+        recorded_at TIMESTAMPTZ NOT NULL,
+        actor VARCHAR(255),
+        entity VARCHAR(50) NOT NULL,
+        entity_id INT NOT NULL,
+        operation VARCHAR(10) NOT NULL,
+        before JSONB,
+        after JSONB
+    ) PARTITION BY RANGE (recorded_at);
+    """
+
+    create_audit_log_functions_query = """
+    CREATE OR REPLACE FUNCTION ensure_audit_partition(month TIMESTAMPTZ) RETURNS void AS $$
+    DECLARE
+        first_day DATE := date_trunc('month', month AT TIME ZONE 'UTC');
+    BEGIN
+        EXECUTE format(
+            'CREATE TABLE IF NOT EXISTS %I PARTITION OF audit_log FOR VALUES FROM (%L) TO (%L)',
+            'audit_log_' || to_char(first_day, 'YYYY_MM'),
+            first_day::timestamp AT TIME ZONE 'UTC',
+            (first_day + interval '1 month')::timestamp AT TIME ZONE 'UTC');
+    EXCEPTION WHEN duplicate_table THEN
+        -- Created concurrently by another worker
+        NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    CREATE OR REPLACE FUNCTION reject_audit_change() RETURNS trigger AS $$
+    BEGIN
+        RAISE EXCEPTION 'audit_log is append-only';
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+
+    # Responses of requests sent with an Idempotency-Key (see idempotency.py)
+    create_idempotency_keys_table_query = """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        idempotency_key VARCHAR(255) PRIMARY KEY,
+        response JSONB,
+        created_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """
+
+    # Running grade sum/count per student, kept up to date by statement-level triggers
+    # on student_courses so averages never need a scan of all grades
+    create_student_grade_stats_table_query = """
+    CREATE TABLE IF NOT EXISTS student_grade_stats (
+        student_id INT PRIMARY KEY,
+        grade_sum DECIMAL(12,1) NOT NULL DEFAULT 0,
+        grade_count INT NOT NULL DEFAULT 0
+    );
+    """
+
+    create_grade_stats_function_query = """
+    CREATE OR REPLACE FUNCTION apply_grade_stats() RETURNS trigger AS $$
+    BEGIN
+        -- Each branch may only reference the transition tables of its own event
+        IF TG_OP = 'INSERT' THEN
+            INSERT INTO student_grade_stats AS stats (student_id, grade_sum, grade_count)
+            SELECT student_id, COALESCE(SUM(grade), 0), COUNT(grade)
+            FROM new_rows GROUP BY student_id ORDER BY student_id
+            ON CONFLICT (student_id) DO UPDATE
+            SET grade_sum = stats.grade_sum + EXCLUDED.grade_sum,
+                grade_count = stats.grade_count + EXCLUDED.grade_count;
+        ELSIF TG_OP = 'DELETE' THEN
+            INSERT INTO student_grade_stats AS stats (student_id, grade_sum, grade_count)
+            SELECT student_id, -COALESCE(SUM(grade), 0), -COUNT(grade)
+            FROM old_rows GROUP BY student_id ORDER BY student_id
+            ON CONFLICT (student_id) DO UPDATE
+            SET grade_sum = stats.grade_sum + EXCLUDED.grade_sum,
+                grade_count = stats.grade_count + EXCLUDED.grade_count;
+        ELSE
+            INSERT INTO student_grade_stats AS stats (student_id, grade_sum, grade_count)
+            SELECT student_id, COALESCE(SUM(grade), 0), SUM(counted)
+            FROM (
+                SELECT student_id, grade, (grade IS NOT NULL)::int AS counted FROM new_rows
+                UNION ALL
+                SELECT student_id, -grade, -(grade IS NOT NULL)::int FROM old_rows
+            ) AS deltas
+            GROUP BY student_id ORDER BY student_id
+            ON CONFLICT (student_id) DO UPDATE
+            SET grade_sum = stats.grade_sum + EXCLUDED.grade_sum,
+                grade_count = stats.grade_count + EXCLUDED.grade_count;
+        END IF;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+
+    # Deleted rows, so incremental sync (modified_since) can report deletions
+    create_tombstones_table_query = """
+    CREATE TABLE IF NOT EXISTS tombstones (
+        tombstone_id BIGSERIAL PRIMARY KEY,
+        table_name VARCHAR(50) NOT NULL,
+        row_key JSONB NOT NULL,
+        deleted_at TIMESTAMPTZ NOT NULL DEFAULT now()
+    );
+    """
+
+    # Newest pruned change event and tombstone (see retention.py)
+    create_pruned_history_table_query = """
+    CREATE TABLE IF NOT EXISTS pruned_history (
+        table_name VARCHAR(50) PRIMARY KEY,
+        txid BIGINT,
+        event_id BIGINT,
+        deleted_at TIMESTAMPTZ
+    );
+    """
+
+    create_sync_functions_query = """
+    CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger AS $$
+    BEGIN
+        NEW.updated_at := now();
+        RETURN NEW;
+    END;
+    $$ LANGUAGE plpgsql;
+
+    -- Trigger arguments are the primary key columns of the table
+    CREATE OR REPLACE FUNCTION record_tombstones() RETURNS trigger AS $$
+    BEGIN
+        INSERT INTO tombstones (table_name, row_key)
+        SELECT TG_TABLE_NAME,
+               (SELECT jsonb_object_agg(k, to_jsonb(old_row) -> k) FROM unnest(TG_ARGV) AS k)
+        FROM old_rows AS old_row;
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+
+    # Counters bumped by every transaction that changes their tables (see /catalogue)
+    create_data_versions_query = """
+    CREATE TABLE IF NOT EXISTS data_versions (
+        name VARCHAR(50) PRIMARY KEY,
+        version BIGINT NOT NULL DEFAULT 0,
+        txid BIGINT
+    );
+
+    -- Trigger argument is the counter. Runs at commit (deferred), once per transaction:
+    -- later rows find txid already set, and the row lock is held only while committing.
+    CREATE OR REPLACE FUNCTION bump_data_version() RETURNS trigger AS $$
+    BEGIN
+        UPDATE data_versions SET version = version + 1, txid = txid_current()
+        WHERE name = TG_ARGV[0] AND txid IS DISTINCT FROM txid_current();
+        RETURN NULL;
+    END;
+    $$ LANGUAGE plpgsql;
+    """
+
+    # Primary key columns of every table that supports incremental sync
+    sync_tables = {
+        "students": ["student_id"],
+        "courses": ["course_id"],
+        "instructors": ["instructor_id"],
+        "departments": ["department_id"],
+        "enrollments": ["enrollment_id"],
+        "student_courses": ["student_id", "course_id"],
+    }
+
     with con.cursor() as cursor:
         cursor.execute(create_courses_table_query)
         print("Courses table created.")
@@ -185,23 +709,154 @@ def create_tables(DATABASE_NAME):
         print("Departments table created.")
 
         cursor.execute(create_enrollments_table_query)
+        cursor.execute(create_enrollment_partition_function_query)
+        cursor.execute("""
+            SELECT ensure_enrollment_partition(CURRENT_DATE);
+            SELECT ensure_enrollment_partition((CURRENT_DATE + interval '1 year')::date);
+        """)
         print("Enrollments table created.")
 
         cursor.execute(create_student_courses_table_query)
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'student_courses'::regclass;")
+        if cursor.fetchone():
+            for remainder in range(STUDENT_COURSES_PARTITIONS):
+                cursor.execute(f"""
+                    CREATE TABLE IF NOT EXISTS student_courses_p{remainder} PARTITION OF student_courses
+                    FOR VALUES WITH (MODULUS {STUDENT_COURSES_PARTITIONS}, REMAINDER {remainder});
+                """)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_student_courses_course ON student_courses (course_id);")
         print("student_courses table created.")
 
+        cursor.execute(create_course_prerequisites_table_query)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_course_prerequisites_prerequisite "
+                       "ON course_prerequisites (prerequisite_id);")
+        print("course_prerequisites table created.")
+
+        cursor.execute(create_change_events_table_query)
+        print("change_events table created.")
+
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_student_id ON Enrollments (student_id);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_course_id ON Enrollments (course_id);")
         cursor.execute("CREATE INDEX IF NOT EXISTS inst_email ON Instructors (email);")
         cursor.execute("CREATE INDEX IF NOT EXISTS idx_email ON Students (email);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_change_events_cursor ON change_events (txid, event_id);")
+
+        # Columns the list endpoints filter and sort on (see filters.py)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_courses_department ON Courses (department_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_courses_credits ON Courses (credits);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_instructors_department ON Instructors (department_id);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_last_name ON Students (last_name);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_students_enrollment_date ON Students (enrollment_date);")
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_enrollments_date ON Enrollments (enrollment_date);")
+
+        # Row versions for optimistic concurrency (If-Match on PATCH), added to existing databases too
+        for table in ("Courses", "Instructors", "Students"):
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN IF NOT EXISTS version INT NOT NULL DEFAULT 1;")
+
+        # updated_at maintained by triggers, deletions recorded as tombstones
+        cursor.execute(create_tombstones_table_query)
+        cursor.execute("CREATE INDEX IF NOT EXISTS idx_tombstones_sync ON tombstones (table_name, deleted_at);")
+        cursor.execute(create_pruned_history_table_query)
+        cursor.execute(create_sync_functions_query)
+        for table, key_columns in sync_tables.items():
+            keys = ", ".join(f"'{column}'" for column in key_columns)
+            cursor.execute(f"""
+                ALTER TABLE {table} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMPTZ NOT NULL DEFAULT now();
+                CREATE INDEX IF NOT EXISTS idx_{table}_updated_at ON {table} (updated_at);
+
+                DROP TRIGGER IF EXISTS {table}_touch_updated_at ON {table};
+                CREATE TRIGGER {table}_touch_updated_at BEFORE UPDATE ON {table}
+                    FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+                DROP TRIGGER IF EXISTS {table}_tombstones ON {table};
+                CREATE TRIGGER {table}_tombstones AFTER DELETE ON {table}
+                    REFERENCING OLD TABLE AS old_rows
+                    FOR EACH STATEMENT EXECUTE FUNCTION record_tombstones({keys});
+            """)
+        print("Sync triggers created.")
+
+        # ALWAYS: shards (logical replication subscribers) count the changes they apply too
+        cursor.execute(create_data_versions_query)
+        cursor.execute("INSERT INTO data_versions (name) VALUES ('catalogue') ON CONFLICT DO NOTHING;")
+        for table in ("departments", "courses", "instructors"):
+            cursor.execute(f"""
+                DROP TRIGGER IF EXISTS {table}_catalogue_version ON {table};
+                CREATE CONSTRAINT TRIGGER {table}_catalogue_version
+                    AFTER INSERT OR UPDATE OR DELETE ON {table}
+                    DEFERRABLE INITIALLY DEFERRED
+                    FOR EACH ROW EXECUTE FUNCTION bump_data_version('catalogue');
+                ALTER TABLE {table} ENABLE ALWAYS TRIGGER {table}_catalogue_version;
+
+                DROP TRIGGER IF EXISTS {table}_catalogue_version_truncate ON {table};
+                CREATE TRIGGER {table}_catalogue_version_truncate AFTER TRUNCATE ON {table}
+                    FOR EACH STATEMENT EXECUTE FUNCTION bump_data_version('catalogue');
+                ALTER TABLE {table} ENABLE ALWAYS TRIGGER {table}_catalogue_version_truncate;
+            """)
+        print("Catalogue version triggers created.")
+
+        # Course capacity (NULL = unlimited) and a seat counter for registration
+        cursor.execute("ALTER TABLE Courses ADD COLUMN IF NOT EXISTS capacity INT;")
+        cursor.execute("ALTER TABLE Courses ADD COLUMN IF NOT EXISTS enrolled_count INT NOT NULL DEFAULT 0;")
+        # A unique index on a partitioned table must contain enrollment_date, so there it is
+        # not unique and duplicates are prevented by the course row lock in
+        # main.enroll_student/enroll_cohort. Plain (not yet migrated) tables keep the unique one.
+        cursor.execute("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'enrollments'::regclass;")
+        if cursor.fetchone():
+            cursor.execute("CREATE INDEX IF NOT EXISTS idx_enrollments_student_course "
+                           "ON Enrollments (student_id, course_id);")
+        else:
+            cursor.execute("""
+                CREATE UNIQUE INDEX IF NOT EXISTS uq_enrollments_student_course ON Enrollments (student_id, course_id);
+                DROP INDEX IF EXISTS idx_enrollments_student_course;
+            """)
+        cursor.execute(create_idempotency_keys_table_query)
+        cursor.execute("""
+            ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS fingerprint BYTEA;
+            ALTER TABLE idempotency_keys ADD COLUMN IF NOT EXISTS expires_at TIMESTAMPTZ NOT NULL
+                DEFAULT now() + interval '24 hours';
+            CREATE INDEX IF NOT EXISTS idx_idempotency_keys_expires ON idempotency_keys (expires_at);
+        """)
+        print("idempotency_keys table created.")
+
+        cursor.execute(create_audit_log_table_query)
+        cursor.execute(create_audit_log_functions_query)
+        cursor.execute("""
+            CREATE INDEX IF NOT EXISTS idx_audit_log_entity ON audit_log (entity, entity_id, recorded_at);
+            CREATE INDEX IF NOT EXISTS idx_audit_log_actor ON audit_log (actor, recorded_at);
+            SELECT ensure_audit_partition(now());
+            SELECT ensure_audit_partition(now() + interval '1 month');
+
+            DROP TRIGGER IF EXISTS audit_log_append_only ON audit_log;
+            CREATE TRIGGER audit_log_append_only BEFORE UPDATE OR DELETE ON audit_log
+                FOR EACH ROW EXECUTE FUNCTION reject_audit_change();
+        """)
+        print("audit_log table created.")
+
+        cursor.execute(create_student_grade_stats_table_query)
+        cursor.execute(create_grade_stats_function_query)
+        for event, transitions in (("INSERT", "NEW TABLE AS new_rows"),
+                                   ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+                                   ("DELETE", "OLD TABLE AS old_rows")):
+            trigger = f"student_courses_grade_stats_{event.lower()}"
+            cursor.execute(f"""
+                DROP TRIGGER IF EXISTS {trigger} ON student_courses;
+                CREATE TRIGGER {trigger} AFTER {event} ON student_courses
+                    REFERENCING {transitions}
+                    FOR EACH STATEMENT EXECUTE FUNCTION apply_grade_stats();
+            """)
+        # Rebuild from scratch, covers grades written before the triggers existed
+        cursor.execute(REBUILD_GRADE_STATS_QUERY)
+        print("student_grade_stats table created.")
 
 
-    if con:
+    if owns_connection:
         con.commit()
         con.close()
 
 
 if __name__ == "__main__":
+    DATABASE_NAME = load_config()["database"]
+
     # 1. create tables
     create_tables(DATABASE_NAME)
     print("Tables created successfully.")
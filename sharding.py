@@ -0,0 +1,164 @@
+# sharding.py
+
+"""
+Department-scoped sharding for departments, courses and instructors.
+
+SHARDS maps each shard (a database name on the local server or a full DSN)
+to the department ids it holds, as JSON:
+
+    SHARDS='{"university_a": ["1-10", 15], "postgresql://campus-b/university": ["11-14", "16-50"]}'
+
+Without SHARDS there is one shard, the API database, and everything behaves
+as before. Queries for one department go straight to its shard; list queries
+run on every shard in parallel and the results are merged. Departments that
+no shard holds are read from the API database (see ShardMap.routes).
+
+Shards are read replicas. The API database stays the primary that holds every
+department, course and instructor: all writes go there, and so do reads that
+need its transactions (modified_since, the change feed) or its foreign keys
+(enrollments, grades and prerequisites reference courses). Each shard has to
+be kept in sync with logical replication of its departments' rows (see the
+README), so shard reads can lag behind a write by the replication delay.
+
+Every worker process opens one pool per shard; serve.py counts the pools of
+shards on the API's server (database names, not DSNs) against its budget.
+"""
+
+import contextvars
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+from psycopg2.extras import RealDictCursor
+
+from setup import ConnectionPool, get_connection, load_config, pool_is_open
+
+_executor = ThreadPoolExecutor(max_workers=32, thread_name_prefix="shard")
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def _parse_departments(values):
+    departments = set()
+    for value in values:
+        if isinstance(value, str) and "-" in value:
+            low, high = (int(part) for part in value.split("-", 1))
+            departments.update(range(low, high + 1))
+        else:
+            departments.add(int(value))
+    return departments
+
+
+class ShardMap:
+    def __init__(self, spec=None):
+        self._by_department = {}
+        if not spec:
+            # None = the API database (pooled), see connect()
+            self.databases = [None]
+            return
+        for database, values in spec.items():
+            for department_id in _parse_departments(values):
+                if department_id in self._by_department:
+                    raise ValueError(f"Department {department_id} is mapped to more than one shard")
+                self._by_department[department_id] = database
+        # Ordered by lowest department id, so concatenated results stay roughly in order
+        self.databases = sorted(spec, key=lambda database: min(
+            (d for d, db in self._by_department.items() if db == database), default=0))
+
+    @property
+    def sharded(self):
+        return self.databases != [None]
+
+    def database_for(self, department_id):
+        """The shard holding a department, None (the API database) when no shard does."""
+        return self._by_department.get(department_id)
+
+    def routes(self, department_ids):
+        """
+        Where to read the departments (None = all) from: [(database, condition)], where the
+        condition ("in" or "not in", department ids) restricts the query on that database,
+        None for no restriction. Unmapped departments are read from the API database
+        (None); for all departments it returns only the ones no shard holds.
+        """
+        if not self.sharded:
+            return [(None, None)]
+        if department_ids is None:
+            return ([(database, None) for database in self.databases]
+                    + [(None, ("not in", sorted(self._by_department)))])
+        wanted = {}
+        for department_id in department_ids:
+            wanted.setdefault(self._by_department.get(department_id), []).append(department_id)
+        return [(database, ("in", wanted[database]))
+                for database in self.databases + [None] if database in wanted]
+
+
+@lru_cache(maxsize=None)
+def shard_map():
+    spec = load_config()["shards"]
+    return ShardMap(json.loads(spec) if spec else None)
+
+
+def connect(database):
+    """
+    Connection to a shard. Pooled (one pool per shard) while the API pool is
+    open, otherwise a plain connection.
+    """
+    if database is None or not pool_is_open():
+        return get_connection(database)
+    with _pools_lock:
+        pool = _pools.get(database)
+        if pool is None:
+            config = load_config()
+            pool = _pools[database] = ConnectionPool(config["pool_min"], config["pool_max"], database)
+    return pool.getconn()
+
+
+def is_local(database):
+    """Whether a shard is a database on the API's server (a name rather than a DSN)."""
+    return database is None or not ("=" in database or "://" in database)
+
+
+def close_pools():
+    with _pools_lock:
+        for pool in _pools.values():
+            pool.closeall()
+        _pools.clear()
+
+
+def run_each(calls):
+    """Calls function(con) for every (database, function), in parallel when there are several. Returns the results in order."""
+    def run(database, function):
+        con = connect(database)
+        try:
+            with con:
+                return function(con)
+        finally:
+            # Back to its pool, or closed when unpooled
+            con.close()
+
+    if len(calls) == 1:
+        return [run(*calls[0])]
+    # Each shard query runs in the request's context, so its timeout and cancellation apply
+    futures = [_executor.submit(contextvars.copy_context().run, run, database, function)
+               for database, function in calls]
+    return [future.result() for future in futures]
+
+
+def _fetcher(query, params):
+    def fetch(con):
+        with con.cursor(cursor_factory=RealDictCursor) as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+    return fetch
+
+
+def fetch_each(statements):
+    """Runs (database, query, params) statements, in parallel when there are several. Returns all rows concatenated."""
+    results = run_each([(database, _fetcher(query, params)) for database, query, params in statements])
+    return [row for rows in results for row in rows]
+
+
+def fetch_all(databases, query, params=()):
+    """Runs a query on the shards and returns all rows (dicts) concatenated."""
+    return fetch_each([(database, query, params) for database in databases])
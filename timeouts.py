@@ -0,0 +1,162 @@
+# timeouts.py
+
+"""
+Per-route statement timeouts and cancellation of abandoned queries.
+
+QueryControlMiddleware gives every HTTP request a RequestQueries object (in
+setup.current_queries). Each connection that opens a cursor during the request
+is attached to it; at the start of every transaction it runs
+
+    SET LOCAL statement_timeout = <timeout of the route>
+
+so the limit ends with the transaction and pooled connections are not left
+with it. Timeouts are STATEMENT_TIMEOUT_MS (default 30 s) unless the route
+has its own in ROUTE_TIMEOUTS_MS, which ROUTE_TIMEOUTS (JSON) can override:
+
+    ROUTE_TIMEOUTS='{"GET /enrollments": 2000, "GET /students/filter": 500}'
+
+When the client of a GET request disconnects, the queries still running for
+it are cancelled on the server (PQcancel). Timeouts (answered with 504) and
+cancellations are counted per route, see /admin/queries.
+"""
+
+import asyncio
+import threading
+from collections import Counter
+
+from fastapi.concurrency import run_in_threadpool
+import psycopg2
+from psycopg2 import extensions
+
+from setup import current_queries, load_config
+
+ROUTE_TIMEOUTS_MS = {
+    "GET /students": 5_000,
+    "GET /students/filter": 2_000,
+    "GET /students/autocomplete": 1_000,
+    "GET /enrollments": 5_000,
+    "GET /catalogue": 10_000,
+}
+CANCELLABLE_METHODS = ("GET", "HEAD")
+
+
+def route_label(scope):
+    """"GET /students/{student_id}" for the matched route, the raw path before routing."""
+    route = scope.get("route")
+    return f"{scope['method']} {route.path if route is not None else scope['path']}"
+
+
+def route_timeout(label):
+    """Statement timeout in milliseconds for a route label (0 = no limit)."""
+    config = load_config()
+    timeouts = {**ROUTE_TIMEOUTS_MS, **config["route_timeouts"]}
+    return int(timeouts.get(label, config["statement_timeout_ms"]))
+
+
+class QueryStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._timeouts = Counter()
+        self._cancellations = Counter()
+
+    def record(self, label, cancelled):
+        with self._lock:
+            (self._cancellations if cancelled else self._timeouts)[label] += 1
+
+    def summary(self):
+        with self._lock:
+            return {"timeouts": dict(self._timeouts.most_common()),
+                    "cancellations": dict(self._cancellations.most_common())}
+
+    def reset(self):
+        with self._lock:
+            self._timeouts.clear()
+            self._cancellations.clear()
+
+
+query_stats = QueryStats()
+
+
+class RequestQueries:
+    """The connections a request is using, so its timeout can be set and its queries cancelled."""
+
+    def __init__(self, scope):
+        self.scope = scope
+        self.cancelled = False
+        self._lock = threading.Lock()
+        self._connections = set()
+
+    def attach(self, con):
+        """Called by AppConnection.cursor(): sets the timeout when a transaction is about to start."""
+        with self._lock:
+            self._connections.add(con)
+        con._queries = self
+        if con.autocommit or con.info.transaction_status != extensions.TRANSACTION_STATUS_IDLE:
+            return
+        # Routing has happened by the time the handler asks for a cursor
+        timeout = route_timeout(route_label(self.scope))
+        with extensions.cursor(con) as cursor:
+            cursor.execute("SET LOCAL statement_timeout = %s;", (timeout,))
+
+    def detach(self, con):
+        """Called when a pooled connection goes back to the pool."""
+        with self._lock:
+            self._connections.discard(con)
+
+    def cancel(self):
+        """Cancels whatever the attached connections are running."""
+        with self._lock:
+            self.cancelled = True
+            for con in self._connections:
+                if not con.closed:
+                    try:
+                        con.cancel()
+                    except psycopg2.Error:
+                        pass
+
+
+class QueryControlMiddleware:
+    """ASGI middleware binding a RequestQueries to each request and watching GET requests for disconnects."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        queries = RequestQueries(scope)
+        token = current_queries.set(queries)
+        try:
+            if scope["method"] not in CANCELLABLE_METHODS:
+                await self.app(scope, receive, send)
+                return
+
+            # Read the client's messages in the background and pass them on,
+            # so a disconnect is noticed while the handler is still running
+            messages = asyncio.Queue()
+            finished = False
+
+            async def watch():
+                while True:
+                    message = await receive()
+                    await messages.put(message)
+                    if message["type"] == "http.disconnect":
+                        # Servers also report a disconnect once the response is complete
+                        if not finished:
+                            await run_in_threadpool(queries.cancel)
+                        return
+
+            async def send_response(message):
+                nonlocal finished
+                if message["type"] == "http.response.body" and not message.get("more_body", False):
+                    finished = True
+                await send(message)
+
+            watcher = asyncio.create_task(watch())
+            try:
+                await self.app(scope, messages.get, send_response)
+            finally:
+                watcher.cancel()
+        finally:
+            current_queries.reset(token)